@@ -0,0 +1,258 @@
+# asgi.py
+# asyncio webhook server mode for the LINE bot (alternative to the Flask dev server in main.py).
+#
+# Run with any ASGI server, e.g.:
+#   uvicorn asgi:app --host 0.0.0.0 --port 8000
+#
+# One process only (no --workers N), for the same reason as in wsgi.py: locks, reservations,
+# reply tokens and processed event ids live in this process's memory.
+#
+# /callback is handled natively on the event loop: the signature is verified, the request is
+# acknowledged immediately, and each event is dispatched as an asyncio task. Image content is
+# downloaded from LINE with the async SDK client (aiohttp), so no thread waits on it. The message,
+# location and image handlers from main.py then run in a bounded thread pool, because
+# googleapiclient (Sheets/Drive) has no asyncio transport. Pillow work stays inside those threads.
+# Events of one user run one at a time in webhook order (a location before its images, the images
+# before "จบ"); only different users' events run in parallel.
+# Many hundreds of events can be in flight as cheap coroutines while only ASGI_HANDLER_THREADS
+# threads hold memory. All other paths (LIFF, OAuth, admin) are served by the Flask app through a
+# small WSGI bridge.
+
+import asyncio
+import contextlib
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApiBlob
+from linebot.v3.webhooks import MessageEvent, TextMessageContent, ImageMessageContent, LocationMessageContent
+
+import main
+
+ASGI_HANDLER_THREADS = int(os.getenv('ASGI_HANDLER_THREADS', '32'))
+ASGI_MAX_INFLIGHT_EVENTS = int(os.getenv('ASGI_MAX_INFLIGHT_EVENTS', '500'))
+main.log.debug(f"ASGI_HANDLER_THREADS = {ASGI_HANDLER_THREADS}, ASGI_MAX_INFLIGHT_EVENTS = {ASGI_MAX_INFLIGHT_EVENTS}")
+
+_handler_pool = ThreadPoolExecutor(max_workers=ASGI_HANDLER_THREADS, thread_name_prefix="asgi-handler")
+_state = {"inflight": 0, "sem": None, "blob_client": None, "blob_api": None, "tasks": set()}
+_user_turns = {}  # user_id -> [asyncio.Lock, events holding or waiting for it]
+
+
+def _handler_for(event):
+    """Pick the main.py handler for a webhook event (same routing as the WebhookHandler decorators)."""
+    if not isinstance(event, MessageEvent):
+        return None
+    msg = event.message
+    if isinstance(msg, TextMessageContent):
+        return main.handle_message
+    if isinstance(msg, LocationMessageContent):
+        return main.handle_location_message
+    if isinstance(msg, ImageMessageContent):
+        return main.handle_image_message
+    return None
+
+
+def _run_handler(func, event):
+    """Pool-thread side of one event, with the same bookkeeping as main.callback: a clean log
+    context, the row-position gate held shared, and the event's held reply token released for
+    notices once the handler is done."""
+    main._set_log_context(transaction_id=None, user_id=None)  # pool threads are reused
+    try:
+        with main._row_positions.shared():
+            func(event)
+    finally:
+        main._release_reply_tokens()
+        main._set_log_context(transaction_id=None, user_id=None)
+
+
+@contextlib.asynccontextmanager
+async def _user_turn(user_id):
+    """One user's events run one after another in webhook order (as handler.handle does for a body);
+    different users run in parallel. asyncio.Lock hands out turns first come, first served."""
+    if not user_id:
+        yield
+        return
+    ent = _user_turns.setdefault(user_id, [asyncio.Lock(), 0])
+    ent[1] += 1
+    try:
+        async with ent[0]:
+            yield
+    finally:
+        ent[1] -= 1
+        if not ent[1]:
+            _user_turns.pop(user_id, None)
+
+
+async def _prefetch_image(message_id):
+    try:
+        content = await _state["blob_api"].get_message_content(message_id)
+        main._prefetched_image_bytes[message_id] = bytes(content)
+    except Exception as e:
+        # Fall back to the handler's own (threaded) download
+        main.log.warning(f"async image prefetch failed for {message_id}: {e}")
+
+
+async def _dispatch(event):
+    """Run one event: prefetch image content asynchronously, then call the sync handler in the pool
+    once the user's earlier events are done."""
+    func = _handler_for(event)
+    if func is None:
+        return
+    loop = asyncio.get_running_loop()
+    message_id = getattr(event.message, "id", None)
+    prefetch = None
+    if func is main.handle_image_message and message_id and _state["blob_api"] is not None:
+        prefetch = asyncio.ensure_future(_prefetch_image(message_id))  # download while earlier events run
+    try:
+        async with _user_turn(getattr(getattr(event, "source", None), "user_id", None)), _state["sem"]:
+            _state["inflight"] += 1
+            try:
+                if prefetch is not None:
+                    await prefetch
+                await loop.run_in_executor(_handler_pool, _run_handler, func, event)
+            finally:
+                _state["inflight"] -= 1
+    except Exception as e:
+        main.log.error(f"asgi dispatch failed: {e}", exc_info=True)
+    finally:
+        if message_id:
+            main._prefetched_image_bytes.pop(message_id, None)
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        msg = await receive()
+        if msg["type"] == "http.request":
+            chunks.append(msg.get("body", b""))
+            if not msg.get("more_body"):
+                break
+        elif msg["type"] == "http.disconnect":
+            break
+    return b"".join(chunks)
+
+
+async def _send_simple(send, status, body=b"", content_type=b"text/plain; charset=utf-8"):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _callback(scope, receive, send):
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+    signature = headers.get("x-line-signature")
+    if not signature:
+        await _send_simple(send, 400, b"Missing X-Line-Signature")
+        return
+    body = (await _read_body(receive)).decode("utf-8")
+    try:
+        events = main.handler.parser.parse(body, signature)
+    except InvalidSignatureError:
+        main.log.error("Invalid LINE signature. Check LINE_CHANNEL_SECRET.")
+        await _send_simple(send, 400, b"Invalid signature")
+        return
+    # Acknowledge first so LINE never waits on Sheets/Drive; handlers reply with their reply token.
+    # Tasks start in body order and take their user's turn before awaiting anything (_user_turn).
+    for ev in events:
+        task = asyncio.create_task(_dispatch(ev))
+        _state["tasks"].add(task)
+        task.add_done_callback(_state["tasks"].discard)
+    await _send_simple(send, 200, b"OK")
+
+
+def _call_wsgi(scope, body):
+    """Run the Flask app for one request and collect (status, headers, body)."""
+    headers = [(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope.get("headers", [])]
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for name, value in headers:
+        if name.lower() == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name.lower() != "content-length":
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    result = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        result["status"] = int(status.split(" ", 1)[0])
+        result["headers"] = response_headers
+
+    chunks = main.app(environ, start_response)
+    try:
+        payload = b"".join(chunks)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    return result["status"], result["headers"], payload
+
+
+async def _wsgi_passthrough(scope, receive, send):
+    body = await _read_body(receive)
+    status, headers, payload = await asyncio.get_running_loop().run_in_executor(_handler_pool, _call_wsgi, scope, body)
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers]})
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            _state["sem"] = asyncio.Semaphore(ASGI_MAX_INFLIGHT_EVENTS)
+            _state["blob_client"] = AsyncApiClient(main.configuration)
+            _state["blob_api"] = AsyncMessagingApiBlob(_state["blob_client"])
+            # Google clients + reference caches warm in the background; /readyz reports progress
+            main.create_app()
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            if _state["tasks"]:
+                await asyncio.wait(list(_state["tasks"]), timeout=10)
+            if _state["blob_client"] is not None:
+                await _state["blob_client"].close()
+            main._shutdown_scheduler()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point."""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    if _state["sem"] is None:
+        # Server without lifespan support: initialise lazily on the running loop
+        _state["sem"] = asyncio.Semaphore(ASGI_MAX_INFLIGHT_EVENTS)
+        _state["blob_client"] = AsyncApiClient(main.configuration)
+        _state["blob_api"] = AsyncMessagingApiBlob(_state["blob_client"])
+    if scope["path"] == "/callback" and scope["method"] == "POST":
+        await _callback(scope, receive, send)
+    else:
+        await _wsgi_passthrough(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn  # only needed for this entry point
+
+    uvicorn.run(app, host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", "8000")))
@@ -0,0 +1,388 @@
+# bench_fakes.py
+# In-process stand-ins for LINE and Google APIs, used by bench_load.py and bench_micro.py.
+#
+#   FakeSheetsService  - spreadsheets().values() get/batchGet/append/update/batchUpdate over
+#                        in-memory grids (one grid per tab), spreadsheets().get/batchUpdate
+#                        (addSheet, deleteDimension), with configurable latency, injected 429s
+#                        and outages (ApiLatency.down -> every call fails with 503)
+#   FakeDriveService   - files().create / permissions().create stub
+#   FakeMessagingApi   - reply_message / push_message / multicast recorder
+#   FakeMessagingApiBlob - get_message_content serving sample JPEGs
+#
+# install(main) swaps these into an imported main module (services, LINE clients,
+# ensure_google_services) without touching the network.
+
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from googleapiclient.errors import HttpError
+import httplib2
+
+_A1_RE = re.compile(r"^([A-Z]*)(\d*)$")
+
+
+def col_to_index(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch) - 64)
+    return n - 1
+
+
+def index_to_col(idx):
+    s = ""
+    n = idx + 1
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+
+def parse_a1(range_name):
+    """'Sheet!B2:D5' -> (sheet, r0, c0, r1, c1) with 0-based inclusive bounds; None = open end."""
+    if "!" in range_name:
+        sheet, ref = range_name.rsplit("!", 1)
+    else:
+        sheet, ref = range_name, ""
+    sheet = sheet.strip("'")
+    if not ref:
+        return sheet, 0, 0, None, None
+    start, _, end = ref.partition(":")
+    m1 = _A1_RE.match(start.replace("$", ""))
+    m2 = _A1_RE.match((end or start).replace("$", ""))
+    c0 = col_to_index(m1.group(1)) if m1.group(1) else 0
+    r0 = int(m1.group(2)) - 1 if m1.group(2) else 0
+    c1 = col_to_index(m2.group(1)) if m2.group(1) else None
+    r1 = int(m2.group(2)) - 1 if m2.group(2) else None
+    return sheet, r0, c0, r1, c1
+
+
+class ApiLatency:
+    """Latency + error model for one fake API: mean seconds, +/- jitter, a 429 probability and an
+    outage switch (`down = True` makes every call fail with 503 until it is cleared)."""
+
+    def __init__(self, mean=0.0, jitter=0.0, error_rate=0.0, retry_after=1):
+        self.mean = mean
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = 0
+        self.throttled = 0
+        self.down = False
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def hit(self, what):
+        with self._lock:
+            self.calls += 1
+            throttle = self.error_rate and random.random() < self.error_rate
+            if throttle:
+                self.throttled += 1
+        delay = max(0.0, self.mean + random.uniform(-self.jitter, self.jitter))
+        if delay:
+            time.sleep(delay)
+        if self.down:
+            with self._lock:
+                self.failed += 1
+            resp = httplib2.Response({"status": 503})
+            raise HttpError(resp, b'{"error": {"code": 503, "message": "Backend unavailable (fake outage)"}}', uri=what)
+        if throttle:
+            resp = httplib2.Response({"status": 429, "retry-after": str(self.retry_after)})
+            raise HttpError(resp, b'{"error": {"code": 429, "message": "Quota exceeded (fake)"}}', uri=what)
+
+
+class _Request:
+    def __init__(self, latency, what, fn, body=None):
+        self._latency = latency
+        self._what = what
+        self._fn = fn
+        self.body = body
+        self.uri = what
+
+    def execute(self, num_retries=0):
+        self._latency.hit(self._what)
+        return self.postproc(None, json.dumps(self._fn()).encode("utf-8"))
+
+    @staticmethod
+    def postproc(resp, content):
+        """Like googleapiclient's JsonModel.response: the raw body goes through postproc."""
+        return json.loads(content)
+
+
+class FakeSheetsValues:
+    def __init__(self, service):
+        self.s = service
+
+    def _read(self, grids, range_name):
+        sheet, r0, c0, r1, c1 = parse_a1(range_name)
+        with self.s.lock:
+            grid = grids.get(sheet, [])
+            rows = grid[r0:(r1 + 1) if r1 is not None else None]
+            out = []
+            for row in rows:
+                out.append(list(row[c0:(c1 + 1) if c1 is not None else None]))
+        while out and not any(v not in ("", None) for v in out[-1]):
+            out.pop()
+        result = {"range": range_name, "majorDimension": "ROWS"}
+        if out:
+            result["values"] = out
+        return result
+
+    def _write(self, grids, range_name, values):
+        sheet, r0, c0, _r1, _c1 = parse_a1(range_name)
+        with self.s.lock:
+            grid = grids.setdefault(sheet, [])
+            for i, row in enumerate(values):
+                while len(grid) <= r0 + i:
+                    grid.append([])
+                target = grid[r0 + i]
+                while len(target) < c0 + len(row):
+                    target.append("")
+                for j, v in enumerate(row):
+                    target[c0 + j] = "" if v is None else v
+        return {"updatedRange": range_name, "updatedRows": len(values)}
+
+    def get(self, spreadsheetId=None, range=None, **kw):
+        grids = self.s.book(spreadsheetId)
+        return _Request(self.s.latency, f"get {range}", lambda: self._read(grids, range))
+
+    def batchGet(self, spreadsheetId=None, ranges=None, **kw):
+        grids = self.s.book(spreadsheetId)
+        return _Request(self.s.latency, f"batchGet {ranges}",
+                        lambda: {"valueRanges": [self._read(grids, r) for r in (ranges or [])]})
+
+    def append(self, spreadsheetId=None, range=None, body=None, **kw):
+        values = (body or {}).get("values", [])
+        grids = self.s.book(spreadsheetId)
+
+        def run():
+            sheet = parse_a1(range)[0]
+            with self.s.lock:
+                grid = grids.setdefault(sheet, [])
+                start = len(grid)
+                for row in values:
+                    grid.append(list(row))
+            width = max((len(r) for r in values), default=1)
+            updated = f"{sheet}!A{start + 1}:{index_to_col(width - 1)}{start + len(values)}"
+            return {"updates": {"updatedRange": updated, "updatedRows": len(values)}}
+        return _Request(self.s.latency, f"append {range}", run, body=str(body))
+
+    def update(self, spreadsheetId=None, range=None, body=None, **kw):
+        values = (body or {}).get("values", [])
+        grids = self.s.book(spreadsheetId)
+        return _Request(self.s.latency, f"update {range}", lambda: self._write(grids, range, values),
+                        body=str(body))
+
+    def batchUpdate(self, spreadsheetId=None, body=None, **kw):
+        data = (body or {}).get("data", [])
+        grids = self.s.book(spreadsheetId)
+        return _Request(self.s.latency, "batchUpdate",
+                        lambda: {"responses": [self._write(grids, d["range"], d["values"]) for d in data]},
+                        body=str(body))
+
+
+class _FakeSpreadsheets:
+    def __init__(self, service):
+        self.s = service
+
+    def values(self):
+        return FakeSheetsValues(self.s)
+
+    def get(self, spreadsheetId=None, fields=None, **kw):
+        grids = self.s.book(spreadsheetId)
+
+        def run():
+            with self.s.lock:
+                return {"sheets": [{"properties": {"sheetId": self.s.sheet_id(t), "title": t}}
+                                   for t in list(grids)]}
+        return _Request(self.s.latency, "spreadsheets.get", run)
+
+    def batchUpdate(self, spreadsheetId=None, body=None, **kw):
+        """addSheet and deleteDimension (ROWS) requests, applied in order like the real API."""
+        grids = self.s.book(spreadsheetId)
+
+        def run():
+            replies = []
+            with self.s.lock:
+                titles = {self.s.sheet_id(t): t for t in grids}
+                for req in (body or {}).get("requests", []):
+                    if "addSheet" in req:
+                        title = req["addSheet"]["properties"]["title"]
+                        if title in grids:
+                            resp = httplib2.Response({"status": 400})
+                            raise HttpError(resp, b'{"error": {"code": 400, "message": "sheet exists"}}',
+                                            uri="addSheet")
+                        grids[title] = []
+                        replies.append({"addSheet": {"properties": {"sheetId": self.s.sheet_id(title),
+                                                                    "title": title}}})
+                    elif "deleteDimension" in req:
+                        rng = req["deleteDimension"]["range"]
+                        grid = grids[titles[rng["sheetId"]]]
+                        del grid[rng["startIndex"]:rng["endIndex"]]
+                        replies.append({})
+            return {"replies": replies}
+        return _Request(self.s.latency, "spreadsheets.batchUpdate", run, body=str(body))
+
+
+class FakeSheetsService:
+    """`grids` is the default spreadsheet; add_spreadsheet() registers more (e.g. shards) by id."""
+
+    def __init__(self, grids=None, latency=None):
+        self.grids = grids or {}
+        self.books = {}
+        self.latency = latency or ApiLatency()
+        self.lock = threading.RLock()
+        self._sheet_ids = {}
+
+    def add_spreadsheet(self, spreadsheet_id, grids):
+        self.books[spreadsheet_id] = grids
+        return grids
+
+    def book(self, spreadsheet_id):
+        return self.books.get(spreadsheet_id, self.grids)
+
+    def sheet_id(self, title):
+        return self._sheet_ids.setdefault(title, len(self._sheet_ids) + 1)
+
+    def spreadsheets(self):
+        return _FakeSpreadsheets(self)
+
+
+class _FakeDriveFiles:
+    def __init__(self, service):
+        self.s = service
+
+    def create(self, body=None, media_body=None, fields=None, **kw):
+        def run():
+            fid = uuid.uuid4().hex
+            with self.s.lock:
+                self.s.created[fid] = (body or {}).get("name", "")
+            return {"id": fid, "webViewLink": f"https://drive.example/file/{fid}/view"}
+        return _Request(self.s.latency, "files.create", run)
+
+
+class _FakeDrivePermissions:
+    def __init__(self, service):
+        self.s = service
+
+    def create(self, fileId=None, body=None, **kw):
+        return _Request(self.s.latency, "permissions.create", lambda: {"id": "anyoneWithLink"})
+
+
+class FakeDriveService:
+    def __init__(self, latency=None):
+        self.latency = latency or ApiLatency()
+        self.created = {}  # file id -> name
+        self.lock = threading.Lock()
+
+    def files(self):
+        return _FakeDriveFiles(self)
+
+    def permissions(self):
+        return _FakeDrivePermissions(self)
+
+
+class FakeMessagingApi:
+    """Records replies/pushes; replies are kept per reply token so a driver can read them back."""
+
+    def __init__(self, latency=None):
+        self.latency = latency or ApiLatency()
+        self.lock = threading.Lock()
+        self.replies = {}
+        self.counts = {"reply": 0, "push": 0, "multicast": 0}
+
+    def _texts(self, messages):
+        return [getattr(m, "text", "") or "" for m in messages or []]
+
+    def reply_message(self, req, *a, **kw):
+        self.latency.hit("reply")
+        with self.lock:
+            self.counts["reply"] += 1
+            self.replies[req.reply_token] = self._texts(req.messages) + [
+                getattr(getattr(item, "action", None), "uri", "") or ""
+                for m in req.messages or [] for item in (getattr(getattr(m, "quick_reply", None), "items", None) or [])
+            ]
+        return {}
+
+    def push_message(self, req, *a, **kw):
+        self.latency.hit("push")
+        with self.lock:
+            self.counts["push"] += 1
+        return {}
+
+    def multicast(self, req, *a, **kw):
+        self.latency.hit("multicast")
+        with self.lock:
+            self.counts["multicast"] += 1
+        return {}
+
+    def pop_reply(self, reply_token):
+        with self.lock:
+            return self.replies.pop(reply_token, [])
+
+
+def make_sample_jpeg(width=1600, height=1200, seed=0, quality=90):
+    """A phone-photo-like JPEG (gradient + noise) so Pillow does realistic decode/resize work."""
+    from PIL import Image
+    rnd = random.Random(seed)
+    base = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40 + rnd.randint(0, 20))
+    img = Image.merge("RGB", (base, noise, base.transpose(Image.FLIP_LEFT_RIGHT)))
+    bio = io.BytesIO()
+    img.save(bio, "JPEG", quality=quality)
+    return bio.getvalue()
+
+
+class FakeMessagingApiBlob:
+    def __init__(self, images, latency=None):
+        self.images = images
+        self.latency = latency or ApiLatency()
+        self._i = 0
+
+    def get_message_content(self, message_id, *a, **kw):
+        self.latency.hit("content")
+        self._i += 1
+        return self.images[self._i % len(self.images)]
+
+
+def seed_grids(n_employees=100, n_sites=10, state="idle", lat0=13.7563, lon0=100.5018):
+    """Employees + Locations (+ empty CheckIns/Submissions with headers) for n users / n sites."""
+    employees = [["line_id", "name", "role", "state", "transaction_id"]]
+    for i in range(n_employees):
+        employees.append([f"U{i:032x}", f"Bench User {i}", "staff", state, ""])
+    locations = [["location_name", "site_group", "latitude", "longitude",
+                  "checkin_radius_meters", "submission_radius_meters", "radius_m"]]
+    for i in range(n_sites):
+        locations.append([f"Site {i}", f"G{i % 5}", f"{lat0 + i * 0.01:.6f}", f"{lon0 + i * 0.01:.6f}",
+                          "200", "200", "200"])
+    return {
+        "Employees": employees,
+        "Locations": locations,
+        "Roles": [["role"], ["staff"], ["supervisor"]],
+        "CheckIns": [["checkin_id", "created_at", "line_user_id", "location", "site_group",
+                      "image_1", "image_2", "image_3", "last_updated_at", "status", "warning_sent",
+                      "distance_m", "employee_name"]],
+        "Submissions": [["submit_id", "created_at", "line_user_id", "location", "site_group",
+                         "image_1", "image_2", "image_3", "last_updated_at", "status", "warning_sent",
+                         "distance_m", "hash_1", "hash_2", "hash_3", "dup_1", "dup_2", "dup_3",
+                         "employee_name"]],
+    }
+
+
+def install(main, sheets=None, drive=None, messaging=None, blob=None):
+    """Point an imported main module at the fakes (no Google/LINE network access)."""
+    if sheets is not None:
+        main.sheets_service = sheets
+    if drive is not None:
+        main.drive_service = drive
+    # LINE fakes go behind main's client wrapper, so rate limiting / retry / metrics are exercised
+    if messaging is not None:
+        main.line_bot_api = main._LineClient(messaging)
+    if blob is not None:
+        main.blob_api = main._LineClient(blob)
+    main.ensure_google_services = lambda: None
+    return main
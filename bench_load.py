@@ -0,0 +1,258 @@
+# bench_load.py
+# Offline load test: drives signed /callback webhooks through main.py's Flask app with LINE,
+# Sheets and Drive replaced by the in-process fakes from bench_fakes.py.
+#
+# Each worker is one employee doing, per iteration:
+#   "เช็คอิน" -> location (txn from the LIFF link in the reply) -> 3 images -> "จบ"
+# and the report shows events/sec plus p50/p95/p99 latency per event type.
+#
+#   python bench_load.py --workers 20 --iterations 5
+#   python bench_load.py --workers 50 --sheets-latency 0.25 --sheets-429 0.02 --drive-latency 0.6
+#   python bench_load.py --workers 50 --shards 4      # CheckIns/Submissions over 4 fake spreadsheets
+#   python bench_load.py --direct-location            # location via POST /liff/location instead of chat
+#   python bench_load.py --sheets-outage 1:6          # Sheets down from t=1s for 6s: breaker opens,
+#                                                     # writes queue, then replay; check-ins must still finish
+#
+# By default the Sheets/Drive rate limits are lifted (so the numbers show the code path itself);
+# pass --real-limits to keep main.py's configured SHEETS_*_RPS / DRIVE_RPS.
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+CHANNEL_SECRET = "bench-channel-secret"
+
+
+def _configure_env(args):
+    os.environ["LINE_CHANNEL_SECRET"] = CHANNEL_SECRET
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench-access-token")
+    os.environ["LIFF_ID"] = "bench-liff"  # replies then carry the txn in the LIFF URL
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("GOOGLE_SHEET_ID", "bench-sheet")
+    os.environ.setdefault("GOOGLE_DRIVE_FOLDER_ID", "bench-folder")
+    os.environ.setdefault("RUN_SCHEDULER", "0")
+    if args.shards > 1:
+        os.environ["SHEET_SHARD_IDS"] = ",".join(_shard_ids(args.shards))
+    if not args.real_limits:
+        for key in ("SHEETS_READ_RPS", "SHEETS_WRITE_RPS", "DRIVE_RPS"):
+            os.environ[key] = "100000"
+        os.environ["RATE_LIMIT_BURST"] = "100000"
+    if args.sheets_outage:
+        os.environ.setdefault("SHEETS_BREAKER_COOLDOWN_SEC", "2")
+
+
+def _shard_ids(n):
+    return [os.environ["GOOGLE_SHEET_ID"]] + [f"bench-shard-{k}" for k in range(1, n)]
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))
+    return ordered[idx]
+
+
+class Driver:
+    def __init__(self, main, messaging, lat, lon, direct_location=False):
+        self.main = main
+        self.direct_location = direct_location
+        self.messaging = messaging
+        self.lat = lat
+        self.lon = lon
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def _post(self, client, kind, user_id, message):
+        reply_token = uuid.uuid4().hex
+        body = json.dumps({
+            "destination": "Ubench",
+            "events": [{
+                "type": "message",
+                "mode": "active",
+                "timestamp": int(time.time() * 1000),
+                "source": {"type": "user", "userId": user_id},
+                "webhookEventId": uuid.uuid4().hex,
+                "deliveryContext": {"isRedelivery": False},
+                "replyToken": reply_token,
+                "message": dict(message, id=uuid.uuid4().hex[:18]),
+            }],
+        }, ensure_ascii=False)
+        signature = base64.b64encode(
+            hmac.new(CHANNEL_SECRET.encode(), body.encode("utf-8"), hashlib.sha256).digest()).decode()
+        t0 = time.perf_counter()
+        resp = client.post("/callback", data=body.encode("utf-8"), content_type="application/json",
+                           headers={"X-Line-Signature": signature})
+        dur = time.perf_counter() - t0
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(dur)
+            if resp.status_code != 200:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+        return self.messaging.pop_reply(reply_token)
+
+    def _post_location(self, client, token):
+        body = {"t": token, "lat": self.lat, "lon": self.lon, "acc": 10, "ts": int(time.time() * 1000)}
+        t0 = time.perf_counter()
+        resp = client.post("/liff/location", json=body)
+        dur = time.perf_counter() - t0
+        with self.lock:
+            self.latencies.setdefault("location_post", []).append(dur)
+            if resp.status_code != 200:
+                self.errors["location_post"] = self.errors.get("location_post", 0) + 1
+
+    def run_user(self, user_id, iterations):
+        client = self.main.app.test_client()
+        for _ in range(iterations):
+            replies = self._post(client, "text_checkin", user_id, {"type": "text", "text": "เช็คอิน", "quoteToken": "q"})
+            txn = token = ""
+            for text in replies:
+                m = re.search(r"[?&]txn=([^&\s]+)", text or "")
+                if m:
+                    txn = m.group(1)
+                m = re.search(r"[?&]t=([^&\s]+)", text or "")
+                if m:
+                    token = m.group(1)
+            if not txn:
+                with self.lock:
+                    self.errors["no_txn"] = self.errors.get("no_txn", 0) + 1
+                continue
+            if self.direct_location and token:
+                self._post_location(client, token)
+            else:
+                address = f"Lat:{self.lat}, Lon:{self.lon} (txn={txn}|acc=10|ts={int(time.time() * 1000)})"
+                self._post(client, "location", user_id, {"type": "location", "title": "bench", "address": address,
+                                                         "latitude": self.lat, "longitude": self.lon})
+            for _img in range(3):
+                self._post(client, "image", user_id, {"type": "image", "quoteToken": "q",
+                                                      "contentProvider": {"type": "line"}})
+            self._post(client, "text_finish", user_id, {"type": "text", "text": "จบ", "quoteToken": "q"})
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline /callback load test with fake LINE/Sheets/Drive")
+    parser.add_argument("--workers", type=int, default=10, help="concurrent simulated employees")
+    parser.add_argument("--iterations", type=int, default=3, help="check-in cycles per worker")
+    parser.add_argument("--sites", type=int, default=50)
+    parser.add_argument("--employees", type=int, default=500, help="rows in the fake Employees sheet")
+    parser.add_argument("--sheets-latency", type=float, default=0.05)
+    parser.add_argument("--sheets-jitter", type=float, default=0.02)
+    parser.add_argument("--sheets-429", type=float, default=0.0, help="probability of a 429 per Sheets call")
+    parser.add_argument("--drive-latency", type=float, default=0.2)
+    parser.add_argument("--line-latency", type=float, default=0.03)
+    parser.add_argument("--image-size", default="1600x1200")
+    parser.add_argument("--real-limits", action="store_true")
+    parser.add_argument("--shards", type=int, default=1, help="spreadsheets holding CheckIns/Submissions")
+    parser.add_argument("--direct-location", action="store_true", help="send the location step to /liff/location")
+    parser.add_argument("--sheets-outage", metavar="START:SECONDS",
+                        help="make every Sheets call fail (503) from START for SECONDS into the run")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    _configure_env(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bench_fakes
+    import main
+
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    grids = bench_fakes.seed_grids(n_employees=max(args.employees, args.workers), n_sites=args.sites)
+    sheets = bench_fakes.FakeSheetsService(grids, bench_fakes.ApiLatency(args.sheets_latency, args.sheets_jitter,
+                                                                          args.sheets_429))
+    books = [grids]
+    for shard_id in _shard_ids(args.shards)[1:]:
+        seeded = bench_fakes.seed_grids(n_employees=0, n_sites=0)
+        books.append(sheets.add_spreadsheet(shard_id, {k: seeded[k] for k in ("CheckIns", "Submissions")}))
+    drive = bench_fakes.FakeDriveService(bench_fakes.ApiLatency(args.drive_latency, args.drive_latency / 4))
+    messaging = bench_fakes.FakeMessagingApi(bench_fakes.ApiLatency(args.line_latency, args.line_latency / 4))
+    blob = bench_fakes.FakeMessagingApiBlob([bench_fakes.make_sample_jpeg(width, height, seed=i) for i in range(3)],
+                                            bench_fakes.ApiLatency(args.line_latency, args.line_latency / 4))
+    bench_fakes.install(main, sheets=sheets, drive=drive, messaging=messaging, blob=blob)
+
+    site_lat, site_lon = float(grids["Locations"][1][2]), float(grids["Locations"][1][3])
+    driver = Driver(main, messaging, site_lat, site_lon, direct_location=args.direct_location)
+    users = [row[0] for row in grids["Employees"][1:1 + args.workers]]
+
+    outage = None
+    if args.sheets_outage:
+        at, dur = (float(v) for v in args.sheets_outage.split(":"))
+
+        def outage_window():
+            time.sleep(at)
+            sheets.latency.down = True
+            time.sleep(dur)
+            sheets.latency.down = False
+        outage = threading.Thread(target=outage_window, daemon=True)
+        outage.start()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=driver.run_user, args=(u, args.iterations)) for u in users]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    if outage is not None:
+        # let the breaker close and the queued writes replay before counting rows
+        outage.join()
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            main.get_sheet_range("CheckIns", "A1:A1")  # half-open probe
+            if main._sheets_breaker_snapshot()["queued_writes"] == 0 and main._sheets_breaker_state() == "closed":
+                break
+            time.sleep(0.5)
+
+    all_lat = [v for vals in driver.latencies.values() for v in vals]
+    per_shard = [sum(1 for r in book["CheckIns"][1:] if len(r) > 9 and r[9] == "done") for book in books]
+    done = sum(per_shard)
+    report = {
+        "workers": args.workers,
+        "iterations": args.iterations,
+        "events": len(all_lat),
+        "elapsed_sec": round(elapsed, 3),
+        "events_per_sec": round(len(all_lat) / elapsed, 2) if elapsed else 0,
+        "checkins_done": done,
+        "checkins_expected": args.workers * args.iterations,
+        "checkins_per_shard": per_shard,
+        "errors": driver.errors,
+        "breaker": {k: v for k, v in main._sheets_breaker_snapshot().items()
+                    if k in ("state", "opened_count", "short_circuited", "replayed", "dropped", "queued_writes")},
+        "fake_calls": {"sheets": sheets.latency.calls, "sheets_429": sheets.latency.throttled,
+                       "drive": drive.latency.calls, "line": dict(messaging.counts)},
+        "latency_ms": {},
+    }
+    for kind, vals in sorted(driver.latencies.items()) + [("all", all_lat)]:
+        report["latency_ms"][kind] = {
+            "n": len(vals),
+            "mean": round(statistics.mean(vals) * 1000, 1) if vals else 0,
+            "p50": round(_percentile(vals, 0.50) * 1000, 1),
+            "p95": round(_percentile(vals, 0.95) * 1000, 1),
+            "p99": round(_percentile(vals, 0.99) * 1000, 1),
+        }
+
+    print(f"{report['events']} events in {report['elapsed_sec']}s -> {report['events_per_sec']} events/sec "
+          f"({done}/{report['checkins_expected']} check-ins done, errors={driver.errors or 0})")
+    print(f"{'event':>14} {'n':>6} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8}  (ms)")
+    for kind, s in report["latency_ms"].items():
+        print(f"{kind:>14} {s['n']:>6} {s['mean']:>8} {s['p50']:>8} {s['p95']:>8} {s['p99']:>8}")
+    print(f"fake API calls: {report['fake_calls']}")
+    if args.sheets_outage:
+        print(f"Sheets outage: {sheets.latency.failed} failed calls, breaker {report['breaker']}")
+    if args.shards > 1:
+        print(f"check-ins per shard: {per_shard}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,208 @@
+# bench_micro.py
+# Micro-benchmarks for main.py's hot helpers, with results appended to a history file so a
+# change to main.py can be compared against earlier runs.
+#
+#   python bench_micro.py                      # run everything, compare with the previous run
+#   python bench_micro.py --quick              # skip the 50k/100k-row sizes and phone photos
+#   python bench_micro.py -k employee          # only benchmarks whose name contains "employee"
+#   python bench_micro.py --fail-on-regression # exit 1 if any benchmark's min time grew over --threshold
+#
+# Sheets-backed helpers (get_employee_data, _find_duplicate_in_submissions) read from the
+# in-memory fake in bench_fakes.py with zero latency, so their numbers are scan + parse cost.
+# History: bench_results/micro.jsonl (one JSON line per run with git revision and main.py hash).
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_HISTORY = os.path.join(HERE, "bench_results", "micro.jsonl")
+
+
+def _configure_env():
+    os.environ.setdefault("LINE_CHANNEL_SECRET", "bench-channel-secret")
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench-access-token")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("RUN_SCHEDULER", "0")
+    for key in ("SHEETS_READ_RPS", "SHEETS_WRITE_RPS", "DRIVE_RPS", "RATE_LIMIT_BURST"):
+        os.environ[key] = "1000000"
+
+
+def _revision():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                             capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "main.py"], cwd=HERE,
+                               capture_output=True, text=True).stdout.strip()
+        return rev + ("+dirty" if dirty else "")
+    except Exception:
+        return "unknown"
+
+
+def build_benchmarks(main, fakes, quick=False):
+    """Return [(name, setup)]; setup() prepares data outside the timing and returns the timed callable."""
+    benches = []
+
+    # --- pure helpers ---
+    benches.append(("haversine_distance", lambda: lambda: main.haversine_distance(13.7563, 100.5018, 13.7367, 100.5231)))
+    addr = "Lat:13.756300, Lon:100.501800 (txn=3f1c2a9e-8b7d-4c6e-9a1f-0d2b3c4e5f60|acc=12|ts=1760000000000)"
+    benches.append(("_parse_meta_from_address", lambda: lambda: main._parse_meta_from_address(addr)))
+
+    def setup_txn():
+        txn = main._new_txn("U" + "0" * 32, "checkin")
+        return lambda: main._check_txn(txn, "U" + "0" * 32)
+    benches.append(("_check_txn", setup_txn))
+
+    # --- site matching (Locations cached in memory, worst case: no site within radius) ---
+    for n in (10, 1000) + (() if quick else (50000,)):
+        def setup_sites(n=n):
+            grids = fakes.seed_grids(n_employees=1, n_sites=n)
+            main.sheets_service = fakes.FakeSheetsService(grids)
+            main._refdata_invalidate(main.LOCATIONS_SHEET_NAME)
+            main.load_locations()
+            return lambda: main.match_site_by_location(1.0, 1.0)
+        benches.append((f"match_site_by_location[{n} sites]", setup_sites))
+
+    # --- employee lookup (last row = worst case) ---
+    for n in (100, 10000) + (() if quick else (100000,)):
+        def setup_emp_warm(n=n):
+            grids = fakes.seed_grids(n_employees=n, n_sites=1)
+            main.sheets_service = fakes.FakeSheetsService(grids)
+            main._refdata_invalidate("Employees")
+            target = grids["Employees"][-1][0]
+            main.get_employee_data(target)  # prime the Employees cache
+            return lambda: main.get_employee_data(target)
+        benches.append((f"get_employee_data[{n} employees, cached]", setup_emp_warm))
+
+        def setup_emp_cold(n=n):
+            grids = fakes.seed_grids(n_employees=n, n_sites=1)
+            main.sheets_service = fakes.FakeSheetsService(grids)
+            target = grids["Employees"][-1][0]
+
+            def run():
+                main._refdata_invalidate("Employees")
+                return main.get_employee_data(target)
+            return run
+        benches.append((f"get_employee_data[{n} employees, cold]", setup_emp_cold))
+
+    # --- duplicate scan over Submissions (no match = full scan) ---
+    for n in (1000, 10000) + (() if quick else (100000,)):
+        def setup_dup(n=n):
+            grids = fakes.seed_grids(n_employees=1, n_sites=1)
+            rows = grids[main.SUBMISSIONS_SHEET_NAME] = grids.pop("Submissions")
+            for i in range(n):
+                row = [f"S{i}", "2026-01-01 00:00:00", "U", "loc", "G", "u1", "u2", "u3", "", "done", "", "10",
+                       f"{i:016x}", f"{i + 1:016x}", f"{i + 2:016x}", "", "", "", "name"]
+                rows.append(row)
+            main.sheets_service = fakes.FakeSheetsService(grids)
+            return lambda: main._find_duplicate_in_submissions("ffffffffffffffff", exclude_submit_id="S0")
+        benches.append((f"_find_duplicate_in_submissions[{n} rows]", setup_dup))
+
+    # --- image pipeline ---
+    sizes = [("1600x1200", 1600, 1200)] + ([] if quick else [("4032x3024 phone", 4032, 3024)])
+    for label, w, h in sizes:
+        def setup_prepare(w=w, h=h):
+            data = fakes.make_sample_jpeg(w, h, quality=92)
+            return lambda: main._prepare_image_bytes(data, main.IMAGE_MAX_DIM, main.IMAGE_QUALITY_CHECKIN)
+        benches.append((f"_prepare_image_bytes[{label}]", setup_prepare))
+
+    def setup_ahash():
+        data = fakes.make_sample_jpeg(1600, 1200)
+        out_bio, _ext, _mime = main._prepare_image_bytes(data, main.IMAGE_MAX_DIM, main.IMAGE_QUALITY_SUBMISSION)
+        prepared = out_bio.getvalue()
+        return lambda: main._compute_image_ahash_from_jpeg_bytes(io.BytesIO(prepared))
+    benches.append(("_compute_image_ahash_from_jpeg_bytes", setup_ahash))
+    return benches
+
+
+def measure(fn, repeat, min_time):
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    # scale the loop count so one repeat takes about min_time
+    if elapsed:
+        number = max(1, int(number * min_time / elapsed))
+    runs = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {"median_us": round(statistics.median(runs) * 1e6, 3), "min_us": round(min(runs) * 1e6, 3),
+            "loops": number, "repeat": repeat}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for main.py helpers")
+    parser.add_argument("-k", dest="filter", default="", help="substring filter on benchmark names")
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per repeat")
+    parser.add_argument("--history", default=DEFAULT_HISTORY)
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--threshold", type=float, default=15.0, help="regression threshold in percent")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    _configure_env()
+    sys.path.insert(0, HERE)
+    import bench_fakes
+    import main
+
+    with open(os.path.join(HERE, "main.py"), "rb") as f:
+        main_hash = hashlib.sha1(f.read()).hexdigest()[:12]
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = [json.loads(ln) for ln in f if ln.strip()]
+
+    def previous_result(name):
+        # latest run that measured this benchmark (filtered runs only cover a subset)
+        for rec in reversed(history):
+            if name in rec.get("results", {}) and rec.get("quick") == args.quick:
+                return rec
+        return None
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<52} {'median':>12} {'min':>12} {'vs prev':>9}")
+    for name, entry in build_benchmarks(main, bench_fakes, quick=args.quick):
+        if args.filter and args.filter not in name:
+            continue
+        fn = entry()
+        fn()  # warm-up (lazy imports, caches)
+        res = measure(fn, args.repeat, args.min_time)
+        results[name] = res
+        delta = ""
+        prev_rec = previous_result(name)
+        prev = prev_rec["results"][name] if prev_rec else None
+        if prev and prev.get("min_us"):
+            # best-of-N is far less noisy than the median for sub-millisecond work
+            pct = (res["min_us"] - prev["min_us"]) / prev["min_us"] * 100
+            delta = f"{pct:+.1f}%"
+            if pct > args.threshold:
+                regressions.append((name, pct))
+        print(f"{name:<52} {res['median_us']:>10.2f}us {res['min_us']:>10.2f}us {delta:>9}")
+
+    record = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": _revision(), "main_sha1": main_hash,
+              "python": sys.version.split()[0], "quick": args.quick, "results": results}
+    if not args.no_save:
+        os.makedirs(os.path.dirname(args.history), exist_ok=True)
+        with open(args.history, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        print(f"\nSaved to {args.history} (revision {record['revision']})")
+    compared = {rec["revision"] for rec in (previous_result(n) for n in results) if rec}
+    if compared:
+        print(f"Compared with revision(s): {', '.join(sorted(compared))}")
+    if regressions:
+        print("Regressions over {:.0f}%: ".format(args.threshold)
+              + ", ".join(f"{n} ({p:+.1f}%)" for n, p in regressions))
+        if args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
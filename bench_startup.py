@@ -0,0 +1,111 @@
+# bench_startup.py
+# Cold-start budget check for main.py.
+#
+# Imports main.py in fresh interpreters with `-X importtime`, reports the slowest modules
+# (cumulative import time, like `python -X importtime` but sorted) and the median wall time
+# of `import main`, then compares it against a budget and an optional stored baseline.
+# Exits with status 1 when startup regressed, so it can run as a CI step:
+#
+#   python bench_startup.py                    # report + check against budget/baseline
+#   python bench_startup.py --update-baseline  # store current median as the new baseline
+#
+# Env / flags:
+#   STARTUP_BUDGET_SEC        hard ceiling for the median import time (default 3.0)
+#   STARTUP_REGRESSION_PCT    allowed growth over the baseline in percent (default 20)
+#   --runs N                  number of fresh-interpreter samples (default 5)
+#   --top N                   number of modules in the import-time report (default 15)
+#   --baseline PATH           baseline file (default startup_baseline.json)
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _sample_once():
+    """Return (wall_seconds, [(cumulative_us, self_us, module)]) for one fresh `import main`."""
+    env = dict(os.environ)
+    # main.py refuses to start without LINE credentials; dummies are enough for an import
+    env.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+    env.setdefault("LINE_CHANNEL_SECRET", "bench")
+    code = "import time; t = time.perf_counter(); import main; print('__WALL__', time.perf_counter() - t)"
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=HERE, env=env, capture_output=True, text=True)
+    outer = time.perf_counter() - start
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr[-4000:])
+        raise SystemExit(f"import main failed with exit code {proc.returncode}")
+    wall = outer
+    for line in proc.stdout.splitlines():
+        if line.startswith("__WALL__"):
+            wall = float(line.split()[1])
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        try:
+            _, rest = line.split(":", 1)
+            self_us, cumulative_us, name = rest.split("|", 2)
+            modules.append((int(cumulative_us), int(self_us), name.rstrip()))
+        except ValueError:
+            continue
+    return wall, modules
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Startup-time budget check for main.py")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--baseline", default=os.path.join(HERE, "startup_baseline.json"))
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    budget = float(os.getenv("STARTUP_BUDGET_SEC", "3.0"))
+    allowed_pct = float(os.getenv("STARTUP_REGRESSION_PCT", "20"))
+
+    walls = []
+    last_modules = []
+    for _ in range(max(1, args.runs)):
+        wall, last_modules = _sample_once()
+        walls.append(wall)
+    median = statistics.median(walls)
+
+    print(f"import main: median {median:.3f}s over {len(walls)} runs "
+          f"(min {min(walls):.3f}s, max {max(walls):.3f}s), budget {budget:.2f}s")
+    print(f"\nTop {args.top} modules by cumulative import time (last run):")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative_us, self_us, name in sorted(last_modules, reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {name}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"median_sec": round(median, 4), "python": sys.version.split()[0]}, f, indent=2)
+        print(f"\nBaseline updated: {args.baseline}")
+        return 0
+
+    failures = []
+    if median > budget:
+        failures.append(f"median {median:.3f}s exceeds budget {budget:.2f}s")
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            base = json.load(f).get("median_sec")
+        if base:
+            limit = base * (1 + allowed_pct / 100.0)
+            print(f"\nBaseline {base:.3f}s, allowed up to {limit:.3f}s (+{allowed_pct:.0f}%)")
+            if median > limit:
+                failures.append(f"median {median:.3f}s is more than {allowed_pct:.0f}% over baseline {base:.3f}s")
+    if failures:
+        print("\nFAIL: " + "; ".join(failures))
+        return 1
+    print("\nOK: startup within budget")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
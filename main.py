@@ -1,36 +1,38 @@
 # main2.py
 # This file will contain the main logic for the LINE Bot and backend.
 
-from flask import Flask, request, abort, redirect, url_for, session, Response, render_template_string
+from flask import Flask, request, abort, redirect, url_for, session, Response
 import os
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload # Import MediaIoBaseUpload
+# Heavy/rarely-needed libraries are imported lazily where used to keep cold start short:
+# googleapiclient.discovery/http, google_auth_httplib2/httplib2 and google.oauth2 (service
+# builders), google_auth_oauthlib (OAuth routes), Pillow (image helpers), APScheduler
+# (start_background_scheduler). See bench_startup.py for the startup-time budget.
 from googleapiclient.errors import HttpError
-from google_auth_httplib2 import AuthorizedHttp
-import httplib2
-import traceback 
 import sys # Import sys module
 import math # For Haversine distance calculation
-from datetime import datetime # For timestamp
+from datetime import datetime, timedelta, timezone # For timestamp
 import uuid # For unique IDs
 import io # Import io module
 # import imghdr # REMOVED imghdr
-from PIL import Image # Import Pillow for image type detection
 import threading  # For simple in-process locking
-from collections import defaultdict  # For lock registry
+from collections import defaultdict, deque  # For lock registry / queued writes
 import time
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures import Future, TimeoutError as FuturesTimeout
+import queue  # work queue for the elastic executor
 import re  # for tolerant text matching
-
-# OAuth imports
-from google.oauth2.credentials import Credentials # Added
-from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request
-import pickle # For storing token.pickle
-import os.path # For checking token.pickle file
+import random  # jitter for backoff / rate limiting
+import hmac  # constant-time admin token check / signed txn ids
+import hashlib  # stable hash for shard routing
+import logging
+import logging.handlers  # QueueHandler / QueueListener
+import atexit  # stop the log listener cleanly
+from contextlib import contextmanager
+import functools  # wraps for the row-position gate decorator
+
+import os.path # For checking token.json file
 import json # For saving token.json
+from html import escape as html_escape  # LIFF page config values
 import pathlib # For checking token.json path
 
 # Use v3 models for compatibility with newer SDK versions
@@ -38,7 +40,8 @@ from linebot.v3.messaging import (
     Configuration, ApiClient, MessagingApi, ReplyMessageRequest,
     TextMessage as V3TextMessage,
     MessagingApiBlob,  # Import MessagingApiBlob
-    PushMessageRequest  # For background notifications
+    PushMessageRequest,  # For background notifications
+    MulticastRequest,  # batched scheduler notices
 ) 
 
 # --- Quick Reply model imports for Quick Reply ---
@@ -50,7 +53,6 @@ from linebot.v3.messaging.models import (
     CameraAction,
     CameraRollAction,
 )
-from apscheduler.schedulers.background import BackgroundScheduler
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, ImageMessageContent, LocationMessageContent
 from linebot.v3.webhook import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError # Keep this for webhook handling
@@ -58,22 +60,140 @@ from linebot.v3.messaging.exceptions import ApiException  # For reply->push fall
 
 # Load environment variables from .env file
 load_dotenv()
-print(f"DEBUG: GOOGLE_SHEET_ID from os.getenv: {os.getenv('GOOGLE_SHEET_ID')}")
-print(f"DEBUG: GOOGLE_DRIVE_FOLDER_ID from os.getenv: {os.getenv('GOOGLE_DRIVE_FOLDER_ID')}")
-print(f"DEBUG: FLASK_SECRET_KEY from os.getenv: {os.getenv('FLASK_SECRET_KEY')}")
-print(f"DEBUG: GOOGLE_CLIENT_ID from os.getenv: {os.getenv('GOOGLE_CLIENT_ID')}")
-print(f"DEBUG: GOOGLE_CLIENT_SECRET from os.getenv: {os.getenv('GOOGLE_CLIENT_SECRET')}")
-print(f"DEBUG: GOOGLE_REDIRECT_URI from os.getenv: {os.getenv('GOOGLE_REDIRECT_URI')}")
-sys.stdout.flush()
+
+# --- Logging ---
+# Leveled JSON logs through a bounded queue: request threads only format + enqueue, a single
+# listener thread does the stdout writes. When the queue is full records are dropped and
+# counted instead of blocking the caller. DEBUG from hot paths (_hot_log) is sampled.
+# Each record carries transaction_id / user_id from the per-thread log context.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()            # json | text
+LOG_QUEUE_MAX = int(os.getenv('LOG_QUEUE_MAX', '10000'))
+LOG_HOT_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_HOT_DEBUG_SAMPLE_RATE', '0.1'))
+
+_log_ctx = threading.local()
+_LOG_STATS = {"enqueued": 0, "dropped": 0, "sampled_out": 0}
+
+
+def _set_log_context(**fields):
+    """Set transaction_id / user_id (or clear them with None) for logs from this thread."""
+    for k, v in fields.items():
+        setattr(_log_ctx, k, v)
+
+
+@contextmanager
+def _log_context(**fields):
+    prev = {k: getattr(_log_ctx, k, None) for k in fields}
+    _set_log_context(**fields)
+    try:
+        yield
+    finally:
+        _set_log_context(**prev)
+
+
+class _LogContextFilter(logging.Filter):
+    """Attach the caller's log context (runs in the logging thread, before the queue hop)."""
+    def filter(self, record):
+        record.transaction_id = getattr(record, "transaction_id", None) or getattr(_log_ctx, "transaction_id", None)
+        record.user_id = getattr(record, "user_id", None) or getattr(_log_ctx, "user_id", None)
+        return True
+
+
+class _DebugSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1.0 or random.random() < self.rate:
+            return True
+        _LOG_STATS["sampled_out"] += 1
+        return False
+
+
+class _JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key in ("transaction_id", "user_id"):
+            if getattr(record, key, None):
+                entry[key] = getattr(record, key)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        ctx = " ".join(f"{k}={getattr(record, k)}" for k in ("transaction_id", "user_id") if getattr(record, k, None))
+        line = f"{record.levelname}: {record.getMessage()}" + (f" [{ctx}]" if ctx else "")
+        return line + ("\n" + record.exc_text if record.exc_text else "")
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Render message + traceback in the caller thread (args may not be thread-safe later)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            _LOG_STATS["enqueued"] += 1
+        except queue.Full:
+            _LOG_STATS["dropped"] += 1
+
+
+def _setup_logging():
+    logger = logging.getLogger("senalocation")
+    if logger.handlers:
+        return logger
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(_JsonLogFormatter() if LOG_FORMAT == "json" else _TextLogFormatter())
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+    qh = _NonBlockingQueueHandler(log_queue)
+    qh.addFilter(_LogContextFilter())
+    logger.addHandler(qh)
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)  # drain remaining records on exit
+    logger.getChild("hot").addFilter(_DebugSampler(LOG_HOT_DEBUG_SAMPLE_RATE))
+    return logger
+
+
+log = _setup_logging()
+_hot_log = logging.getLogger("senalocation.hot")  # per-request/per-row paths; DEBUG is sampled
+
+
+def _logging_snapshot():
+    return dict(_LOG_STATS, level=LOG_LEVEL, format=LOG_FORMAT, hot_debug_sample_rate=LOG_HOT_DEBUG_SAMPLE_RATE)
+
+
+# Report only whether secrets are present; never echo their values
+log.debug("env " + ", ".join(
+    f"{k}={'set' if os.getenv(k) else 'NOT SET'}"
+    for k in ("GOOGLE_SHEET_ID", "GOOGLE_DRIVE_FOLDER_ID", "FLASK_SECRET_KEY",
+              "GOOGLE_CLIENT_ID", "GOOGLE_CLIENT_SECRET", "GOOGLE_REDIRECT_URI")))
 
 # --- LIFF / Anti-fraud Configuration ---
 LIFF_ID = os.getenv('LIFF_ID', '').strip()
 MAX_GPS_ACCURACY_M = int(os.getenv('MAX_GPS_ACCURACY_M', '50'))       # accept accuracy <= 50m
 MAX_LOCATION_AGE_SEC = int(os.getenv('MAX_LOCATION_AGE_SEC', '60'))   # client ts age <= 60 sec
-print(f"DEBUG: LIFF_ID = {'set' if LIFF_ID else 'NOT SET'}")
-print(f"DEBUG: MAX_GPS_ACCURACY_M = {MAX_GPS_ACCURACY_M}")
-print(f"DEBUG: MAX_LOCATION_AGE_SEC = {MAX_LOCATION_AGE_SEC}")
-sys.stdout.flush()
+LIFF_DIRECT_POST = os.getenv('LIFF_DIRECT_POST', '1') == '1'           # picker POSTs to /liff/location (chat message as fallback)
+log.debug(f"LIFF_ID = {'set' if LIFF_ID else 'NOT SET'}")
+log.debug(f"MAX_GPS_ACCURACY_M = {MAX_GPS_ACCURACY_M}")
+log.debug(f"MAX_LOCATION_AGE_SEC = {MAX_LOCATION_AGE_SEC}")
 
 # --- Flask App Initialization ---
 app = Flask(__name__) 
@@ -101,15 +221,13 @@ SERVICE_ACCOUNT_FILE = 'credentials.json' # Make sure this file is in the same d
 
 # --- Google Sheets Configuration ---
 SPREADSHEET_ID = os.getenv('GOOGLE_SHEET_ID') # You need to set this in your .env file
-print(f"DEBUG: SPREADSHEET_ID assigned: {SPREADSHEET_ID}") # New print
-sys.stdout.flush()
+log.debug(f"SPREADSHEET_ID assigned: {SPREADSHEET_ID}")
 
 # --- Google Drive Target Folder (OAuth) ---
 GOOGLE_DRIVE_FOLDER_ID = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
-print(f"DEBUG: GOOGLE_DRIVE_FOLDER_ID assigned: {GOOGLE_DRIVE_FOLDER_ID}")
+log.debug(f"GOOGLE_DRIVE_FOLDER_ID assigned: {GOOGLE_DRIVE_FOLDER_ID}")
 if not GOOGLE_DRIVE_FOLDER_ID:
-    print("WARNING: GOOGLE_DRIVE_FOLDER_ID not set in .env; Drive uploads will fail.")
-sys.stdout.flush()
+    log.warning("GOOGLE_DRIVE_FOLDER_ID not set in .env; Drive uploads will fail.")
 
 # --- Google Drive Configuration (OAuth) ---
 # These will be used for OAuth flow
@@ -119,25 +237,22 @@ GOOGLE_REDIRECT_URI = os.getenv('GOOGLE_REDIRECT_URI')
 
 # --- Check-in Timeout (seconds) ---
 CHECKIN_TIMEOUT_SECONDS = int(os.getenv('CHECKIN_TIMEOUT_SECONDS', '180'))
-print(f"DEBUG: CHECKIN_TIMEOUT_SECONDS = {CHECKIN_TIMEOUT_SECONDS}")
-sys.stdout.flush()
+log.debug(f"CHECKIN_TIMEOUT_SECONDS = {CHECKIN_TIMEOUT_SECONDS}")
 
 # --- Scheduler Configuration ---
 SCHEDULER_INTERVAL_SECONDS = int(os.getenv('SCHEDULER_INTERVAL_SECONDS', '30'))
 APP_TIMEZONE = os.getenv('APP_TIMEZONE', 'Asia/Bangkok')
 WARNING_BEFORE_SECONDS = int(os.getenv('WARNING_BEFORE_SECONDS', '10'))
-print(f"DEBUG: SCHEDULER_INTERVAL_SECONDS = {SCHEDULER_INTERVAL_SECONDS}")
-print(f"DEBUG: APP_TIMEZONE = {APP_TIMEZONE}")
-print(f"DEBUG: WARNING_BEFORE_SECONDS = {WARNING_BEFORE_SECONDS}")
-sys.stdout.flush()
+log.debug(f"SCHEDULER_INTERVAL_SECONDS = {SCHEDULER_INTERVAL_SECONDS}")
+log.debug(f"APP_TIMEZONE = {APP_TIMEZONE}")
+log.debug(f"WARNING_BEFORE_SECONDS = {WARNING_BEFORE_SECONDS}")
 
 
 # --- Google API call timeouts (seconds) ---
 SHEETS_EXECUTE_TIMEOUT_SEC = int(os.getenv('SHEETS_EXECUTE_TIMEOUT_SEC', '20'))  # hard cap per API call
 DRIVE_EXECUTE_TIMEOUT_SEC  = int(os.getenv('DRIVE_EXECUTE_TIMEOUT_SEC',  '15'))
-print(f"DEBUG: SHEETS_EXECUTE_TIMEOUT_SEC = {SHEETS_EXECUTE_TIMEOUT_SEC}")
-print(f"DEBUG: DRIVE_EXECUTE_TIMEOUT_SEC  = {DRIVE_EXECUTE_TIMEOUT_SEC}")
-sys.stdout.flush()
+log.debug(f"SHEETS_EXECUTE_TIMEOUT_SEC = {SHEETS_EXECUTE_TIMEOUT_SEC}")
+log.debug(f"DRIVE_EXECUTE_TIMEOUT_SEC  = {DRIVE_EXECUTE_TIMEOUT_SEC}")
 
 # --- Image compression settings ---
 IMAGE_MAX_DIM = int(os.getenv('IMAGE_MAX_DIM', '1600'))       # max width/height in px
@@ -150,51 +265,806 @@ IMAGE_QUALITY_SUBMISSION = int(os.getenv('IMAGE_QUALITY_SUBMISSION', '90'))
 # --- Robust retry/backoff config for Google Sheets ---
 SHEETS_MAX_ATTEMPTS = int(os.getenv('SHEETS_MAX_ATTEMPTS', '3'))
 SHEETS_BACKOFF_SECONDS = float(os.getenv('SHEETS_BACKOFF_SECONDS', '1.5'))
-print(f"DEBUG: SHEETS_MAX_ATTEMPTS = {SHEETS_MAX_ATTEMPTS}")
-print(f"DEBUG: SHEETS_BACKOFF_SECONDS = {SHEETS_BACKOFF_SECONDS}")
-sys.stdout.flush()
+log.debug(f"SHEETS_MAX_ATTEMPTS = {SHEETS_MAX_ATTEMPTS}")
+log.debug(f"SHEETS_BACKOFF_SECONDS = {SHEETS_BACKOFF_SECONDS}")
+
+# --- Client-side rate limiter (token bucket per API + method class) ---
+# Shared across threads so a burst of 429s slows everyone down together instead of each
+# thread backing off on its own and retrying in lockstep. Rates adapt (AIMD): halve on
+# 429 / Retry-After, creep back up on success. Scheduler/backfill traffic runs at
+# "background" priority and yields to interactive webhook calls.
+# Sheets default quota: 60 reads and 60 writes per minute per user (the bot calls as one user),
+# 300 per minute per project. Raise the RPS only with a larger quota or several identities.
+SHEETS_READ_RPS = float(os.getenv('SHEETS_READ_RPS', '1.0'))
+SHEETS_WRITE_RPS = float(os.getenv('SHEETS_WRITE_RPS', '1.0'))
+DRIVE_RPS = float(os.getenv('DRIVE_RPS', '10'))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '10'))
+RATE_LIMIT_MAX_WAIT_SEC = float(os.getenv('RATE_LIMIT_MAX_WAIT_SEC', '15'))  # background callers
+# Webhook callers hold a reply token (~1 min) across several calls; past this they go ahead
+# and let Google's 429 / the backoff decide instead of queueing the reply away.
+RATE_LIMIT_INTERACTIVE_MAX_WAIT_SEC = float(os.getenv('RATE_LIMIT_INTERACTIVE_MAX_WAIT_SEC', '3'))
+RATE_LIMIT_BACKGROUND_RESERVE = float(os.getenv('RATE_LIMIT_BACKGROUND_RESERVE', '0.3'))  # share of burst kept for interactive calls
+SHEETS_CLIENT_NUM_RETRIES = int(os.getenv('SHEETS_CLIENT_NUM_RETRIES', '0'))  # googleapiclient's own retries bypass the limiter
+log.debug(f"SHEETS_READ_RPS = {SHEETS_READ_RPS}, SHEETS_WRITE_RPS = {SHEETS_WRITE_RPS}, DRIVE_RPS = {DRIVE_RPS}")
+
+_rate_cond = threading.Condition()
+_rate_buckets = {}
+_rate_ctx = threading.local()
+
+def _rate_bucket(api: str, method_class: str):
+    """Return (and create if missing) the bucket for (api, method_class). Caller must hold _rate_cond."""
+    key = (api, method_class)
+    b = _rate_buckets.get(key)
+    if b is None:
+        if api == "drive":
+            max_rate = DRIVE_RPS
+        elif api == "line":
+            max_rate = LINE_RATE_LIMITS.get(method_class, LINE_RATE_LIMITS["other"])
+        else:
+            max_rate = SHEETS_READ_RPS if method_class == "read" else SHEETS_WRITE_RPS
+        capacity = max(1.0, LINE_RATE_BURST if api == "line" else RATE_LIMIT_BURST)
+        b = {
+            "max_rate": max_rate, "rate": max_rate, "capacity": capacity, "tokens": capacity, "ts": time.time(), "blocked_until": 0.0,
+            "acquired": 0, "acquired_background": 0, "throttled": 0, "overruns": 0,
+            "wait_total_sec": 0.0, "waiting_interactive": 0, "waiting_background": 0,
+        }
+        _rate_buckets[key] = b
+    return b
 
-def _sheets_exec_with_retry(request_callable, desc: str):
+def _current_api_priority() -> str:
+    return getattr(_rate_ctx, "priority", "interactive")
+
+@contextmanager
+def _api_priority(priority: str):
+    """Run Google API calls in this block at 'interactive' or 'background' priority."""
+    prev = getattr(_rate_ctx, "priority", None)
+    _rate_ctx.priority = priority
+    try:
+        yield
+    finally:
+        if prev is None:
+            del _rate_ctx.priority
+        else:
+            _rate_ctx.priority = prev
+
+def _rate_acquire(api: str, method_class: str = "read") -> float:
+    """
+    Block until a token is available for (api, method_class). Background callers leave
+    RATE_LIMIT_BACKGROUND_RESERVE of the burst for interactive callers and never jump ahead
+    of a waiting interactive caller. Gives up waiting after RATE_LIMIT_INTERACTIVE_MAX_WAIT_SEC
+    (interactive) / RATE_LIMIT_MAX_WAIT_SEC (background) and lets the call through (Google
+    remains the final arbiter). Returns seconds waited.
+    """
+    interactive = _current_api_priority() != "background"
+    waiting_key = "waiting_interactive" if interactive else "waiting_background"
+    start = time.time()
+    max_wait = RATE_LIMIT_INTERACTIVE_MAX_WAIT_SEC if interactive else RATE_LIMIT_MAX_WAIT_SEC
+    deadline = start + max_wait
+    with _rate_cond:
+        b = _rate_bucket(api, method_class)
+        b[waiting_key] += 1
+        try:
+            while True:
+                now = time.time()
+                b["tokens"] = min(b["capacity"], b["tokens"] + (now - b["ts"]) * b["rate"])
+                b["ts"] = now
+                floor = 0.0 if interactive else b["capacity"] * RATE_LIMIT_BACKGROUND_RESERVE
+                if (now >= b["blocked_until"] and b["tokens"] >= 1.0 + floor
+                        and (interactive or b["waiting_interactive"] == 0)):
+                    b["tokens"] -= 1.0
+                    b["acquired"] += 1
+                    if not interactive:
+                        b["acquired_background"] += 1
+                    break
+                if now >= deadline:
+                    b["overruns"] += 1
+                    log.warning(f"rate limiter wait exceeded {max_wait}s for {api}/{method_class}; proceeding")
+                    break
+                need = 1.0 + floor - b["tokens"]
+                wait = max(b["blocked_until"] - now, need / b["rate"] if need > 0 else 0.05)
+                _rate_cond.wait(min(wait + random.uniform(0, 0.05), deadline - now))
+        finally:
+            b[waiting_key] -= 1
+            waited = time.time() - start
+            b["wait_total_sec"] += waited
+            _rate_cond.notify_all()
+    return waited
+
+def _rate_note_success(api: str, method_class: str = "read"):
+    """Additive increase back toward the configured rate after a successful call."""
+    with _rate_cond:
+        b = _rate_bucket(api, method_class)
+        b["rate"] = min(b["max_rate"], b["rate"] + b["max_rate"] * 0.05)
+
+def _rate_note_throttled(api: str, method_class: str, retry_after_sec=None) -> float:
+    """
+    Multiplicative decrease on 429/quota errors and block the bucket until Retry-After
+    (or one second) plus jitter has passed. Returns the delay applied.
+    """
+    delay = (float(retry_after_sec) if retry_after_sec else 1.0) * random.uniform(1.0, 1.25)
+    with _rate_cond:
+        b = _rate_bucket(api, method_class)
+        b["rate"] = max(b["max_rate"] * 0.05, b["rate"] * 0.5)
+        b["tokens"] = 0.0
+        b["blocked_until"] = max(b["blocked_until"], time.time() + delay)
+        b["throttled"] += 1
+        _rate_cond.notify_all()
+    return delay
+
+def _http_error_throttle_info(exc):
+    """Return (is_throttled, retry_after_seconds_or_None) for a googleapiclient HttpError."""
+    if not isinstance(exc, HttpError):
+        return False, None
+    resp = getattr(exc, "resp", None)
+    status = getattr(resp, "status", None)
+    try:
+        status = int(status)
+    except Exception:
+        status = None
+    throttled = status == 429 or (status == 403 and "rateLimitExceeded" in str(exc))
+    retry_after = None
+    try:
+        raw = resp.get("retry-after") if resp is not None else None
+        retry_after = float(raw) if raw else None
+    except Exception:
+        retry_after = None
+    return throttled, retry_after
+
+def _rate_limiter_snapshot():
+    """Current throttling state of every bucket (for the admin endpoint / metrics)."""
+    now = time.time()
+    with _rate_cond:
+        return {
+            f"{api}/{cls}": {
+                "rate_per_sec": round(b["rate"], 3),
+                "max_rate_per_sec": b["max_rate"],
+                "tokens": round(min(b["capacity"], b["tokens"] + (now - b["ts"]) * b["rate"]), 2),
+                "blocked_for_sec": round(max(0.0, b["blocked_until"] - now), 2),
+                "acquired": b["acquired"],
+                "acquired_background": b["acquired_background"],
+                "throttled": b["throttled"],
+                "overruns": b["overruns"],
+                "wait_total_sec": round(b["wait_total_sec"], 2),
+                "waiting_interactive": b["waiting_interactive"],
+                "waiting_background": b["waiting_background"],
+            }
+            for (api, cls), b in _rate_buckets.items()
+        }
+
+# --- Circuit breaker around Google Sheets ---
+# After SHEETS_BREAKER_FAILURE_THRESHOLD consecutive failed attempts the breaker opens and
+# Sheets calls fail fast with SheetsCircuitOpen for SHEETS_BREAKER_COOLDOWN_SEC. Reads then
+# serve the last good copy of the tab; writes are queued locally and replayed in order once
+# a half-open probe succeeds. This keeps handlers inside the reply-token window.
+# Until the queue is empty again, new writes join it instead of going straight to Sheets, so
+# a replayed older write (e.g. status in_progress) can never land after a newer one (done).
+SHEETS_BREAKER_FAILURE_THRESHOLD = int(os.getenv('SHEETS_BREAKER_FAILURE_THRESHOLD', '5'))
+SHEETS_BREAKER_COOLDOWN_SEC = float(os.getenv('SHEETS_BREAKER_COOLDOWN_SEC', '30'))
+SHEETS_WRITE_QUEUE_MAX = int(os.getenv('SHEETS_WRITE_QUEUE_MAX', '1000'))
+SHEETS_REPLAY_MAX_ATTEMPTS = int(os.getenv('SHEETS_REPLAY_MAX_ATTEMPTS', '3'))
+log.debug(f"SHEETS_BREAKER_FAILURE_THRESHOLD = {SHEETS_BREAKER_FAILURE_THRESHOLD}, SHEETS_BREAKER_COOLDOWN_SEC = {SHEETS_BREAKER_COOLDOWN_SEC}")
+
+class SheetsCircuitOpen(RuntimeError):
+    """Raised instead of calling Sheets while the circuit breaker is open."""
+
+_breaker_lock = threading.Lock()
+_SHEETS_BREAKER = {"state": "closed", "failures": 0, "opened_at": 0.0, "probe_in_flight": False,
+                   "opened_count": 0, "short_circuited": 0, "replayed": 0, "dropped": 0}
+_pending_sheet_writes = deque()  # (kind, sheet_name, range_name, values, queued_at, predicted_row)
+_pending_writes_lock = threading.Lock()
+_drain_lock = threading.Lock()
+_drain_ctx = threading.local()  # .active: this thread is replaying the queue
+# An append queued before its tab's row count is known (after a restart, a shard nobody has read)
+# gets a placeholder row number far past any real row, so the finders and later writes can still
+# address the row; the replay remaps it to the real one (_remap_queued_row).
+_PLACEHOLDER_ROW_BASE = 10000000
+_placeholder_rows = {"last": _PLACEHOLDER_ROW_BASE}
+_queued_appends = {}  # (sheet_name, row_id) -> queued append item, until replayed or dropped
+
+def _breaker_before_call(desc: str):
+    """Raise SheetsCircuitOpen if the breaker is open; let exactly one probe through when half-open."""
+    with _breaker_lock:
+        st = _SHEETS_BREAKER
+        if st["state"] == "closed":
+            return
+        if st["state"] == "open" and time.time() - st["opened_at"] >= SHEETS_BREAKER_COOLDOWN_SEC:
+            st["state"] = "half_open"
+        if st["state"] == "half_open" and not st["probe_in_flight"]:
+            st["probe_in_flight"] = True
+            log.debug(f"Sheets breaker half-open; probing with {desc}")
+            return
+        st["short_circuited"] += 1
+    raise SheetsCircuitOpen(f"Sheets circuit open; skipped {desc}")
+
+def _breaker_record(ok: bool):
+    """Update breaker state after a real Sheets attempt."""
+    reopened = False
+    with _breaker_lock:
+        st = _SHEETS_BREAKER
+        was = st["state"]
+        st["probe_in_flight"] = False
+        if ok:
+            st["failures"] = 0
+            st["state"] = "closed"
+        else:
+            st["failures"] += 1
+            if was == "half_open" or st["failures"] >= SHEETS_BREAKER_FAILURE_THRESHOLD:
+                if was != "open":
+                    st["opened_count"] += 1
+                st["state"] = "open"
+                st["opened_at"] = time.time()
+                reopened = True
+    if ok and was != "closed":
+        log.info("Sheets breaker closed; replaying queued writes")
+        threading.Thread(target=_drain_pending_sheet_writes, daemon=True).start()
+    elif reopened and was != "open":
+        log.warning(f"Sheets breaker OPEN for {SHEETS_BREAKER_COOLDOWN_SEC}s (from {was})")
+
+def _is_breaker_failure(exc) -> bool:
+    """Timeouts, connection errors, 429 and 5xx count against the breaker; other 4xx do not."""
+    if isinstance(exc, HttpError):
+        try:
+            status = int(getattr(exc.resp, "status", 0))
+        except Exception:
+            status = 0
+        return status == 429 or status >= 500
+    return True
+
+def _sheets_breaker_state() -> str:
+    with _breaker_lock:
+        return _SHEETS_BREAKER["state"]
+
+def _parse_a1_start(range_name: str):
+    """'Sheet!F12:H12' -> (5, 12) as (0-based col, 1-based row); None if not a cell range."""
+    m = re.search(r"!\$?([A-Z]+)\$?(\d+)", range_name or "")
+    if not m:
+        return None
+    col = 0
+    for ch in m.group(1):
+        col = col * 26 + (ord(ch) - 64)
+    return col - 1, int(m.group(2))
+
+def _apply_write_to_cached_rows(sheet_name, kind, range_name, values):
+    """Mirror a queued write into the cached copies of the tab so degraded-mode reads see it.
+    For an append, returns the row it is expected to land on when replayed (a placeholder row if
+    the tab's length is not known)."""
+    caches = [c for c in (_SHEET_LAST_GOOD.get(sheet_name),) if c is not None]
+    ref = _REFDATA.get(sheet_name)
+    if ref and ref["rows"] is not None and ref["rows"] not in caches:
+        caches.append(ref["rows"])
+    predicted = None
+    if kind == "append":
+        known = max([len(rows) for rows in caches] + [_SHEET_ROW_COUNT.get(sheet_name, 0)])
+        if not known:
+            for rows in caches:
+                rows.append(list(values))
+            _placeholder_rows["last"] += 1
+            predicted = _placeholder_rows["last"]
+            with _row_snapshots_lock:
+                _remember_last_good_row_locked(sheet_name, predicted, values)
+            return predicted
+        predicted = known + 1
+        _note_sheet_rows(sheet_name, predicted)
+        col, row_1based = 0, predicted
+        with _row_snapshots_lock:
+            _remember_last_good_row_locked(sheet_name, predicted, values)
+    else:
+        start = _parse_a1_start(range_name)
+        if not start:
+            return None
+        col, row_1based = start
+        _patch_last_good_row(sheet_name, range_name, values)
+    for rows in caches:
+        _write_into_rows(rows, row_1based, col, values)
+    return predicted
+
+def _is_placeholder_row(row_1based) -> bool:
+    return bool(row_1based) and row_1based > _PLACEHOLDER_ROW_BASE
+
+def _targets_placeholder(range_name) -> bool:
+    """True for a range on a placeholder row whose queued append never got a real row (dropped)."""
+    return _is_placeholder_row((_parse_a1_start(range_name) or (0, 0))[1])
+
+def _write_into_rows(rows, row_1based, col, values):
+    if _is_placeholder_row(row_1based):
+        return  # a queued append's row with no place in this copy yet (it was appended to the end)
+    while len(rows) < row_1based:
+        rows.append([])
+    target = rows[row_1based - 1]
+    while len(target) < col + len(values):
+        target.append("")
+    target[col:col + len(values)] = list(values)
+
+def _overlay_pending_writes(sheet_name, rows):
+    """Rows of a fresh whole-tab read with this tab's still-queued writes applied on top: until the
+    replay has caught up, Sheets itself does not show them. Call with _pending_writes_lock held."""
+    for kind, sheet, range_name, values, _queued_at, predicted in _pending_sheet_writes:
+        if sheet != sheet_name:
+            continue
+        if kind == "append":
+            if predicted and not _is_placeholder_row(predicted):
+                _write_into_rows(rows, predicted, 0, values)
+            else:
+                rows.append(list(values))
+            continue
+        start = _parse_a1_start(range_name)
+        if start:
+            _write_into_rows(rows, start[1], start[0], values)
+    return rows
+
+def _writes_backlogged() -> bool:
+    """True while queued writes wait for replay (and we are not the replaying thread)."""
+    return bool(_pending_sheet_writes) and not getattr(_drain_ctx, "active", False)
+
+def _queue_sheet_write(kind, sheet_name, range_name, values):
+    """Queue a write while the breaker is open, or behind a queue that has not been replayed yet.
+    Returns a truthy marker so callers treat it as accepted."""
+    with _pending_writes_lock:
+        if len(_pending_sheet_writes) >= SHEETS_WRITE_QUEUE_MAX:
+            dropped = _pending_sheet_writes.popleft()
+            _forget_queued_append(dropped)
+            _SHEETS_BREAKER["dropped"] += 1
+            log.warning(f"Sheets write queue full; dropped oldest {dropped[0]} on {dropped[1]}")
+        predicted = _apply_write_to_cached_rows(sheet_name, kind, range_name, values)
+        item = (kind, sheet_name, range_name, list(values), time.time(), predicted)
+        _pending_sheet_writes.append(item)
+        if kind == "append" and values and values[0]:
+            _queued_appends[(sheet_name, values[0])] = item
+        depth = len(_pending_sheet_writes)
+    if _sheets_breaker_state() == "closed":
+        # behind a backlog that is being (or must be) replayed; the drain picks this one up in order
+        _hot_log.debug(f"queued {kind} on {range_name or sheet_name} behind {depth - 1} pending write(s)")
+        threading.Thread(target=_drain_pending_sheet_writes, daemon=True).start()
+    else:
+        log.warning(f"Sheets breaker open; queued {kind} on {range_name or sheet_name} (queue depth={depth})")
+    return {"queued": True, "row": predicted}
+
+def _forget_queued_append(item):
+    """Drop the id record of a queued append that left the queue. Call with _pending_writes_lock held."""
+    if item[0] == "append" and item[3] and _queued_appends.get((item[1], item[3][0])) is item:
+        del _queued_appends[(item[1], item[3][0])]
+
+def _queued_append_row(sheet_name, row_id):
+    """(copy of row, predicted row) of a still-queued append of row_id, or None."""
+    with _pending_writes_lock:
+        item = _queued_appends.get((sheet_name, row_id))
+        return (list(item[3]), item[5]) if item is not None else None
+
+def _remap_queued_row(sheet_name, old_row, new_row):
+    """A replayed append landed on new_row instead of the predicted old_row: retarget later queued
+    writes and the last-good copy of that row (row-index caches re-verify the id and heal themselves)."""
+    def retarget(rng):
+        tab, _, ref = rng.rpartition("!")
+        ref = re.sub(r"([A-Z])" + str(old_row) + r"(?!\d)", lambda m: m.group(1) + str(new_row), ref)
+        return f"{tab}!{ref}"
+    with _pending_writes_lock:
+        for i, item in enumerate(_pending_sheet_writes):
+            if item[1] == sheet_name and item[0] != "append" and (_parse_a1_start(item[2]) or (0, 0))[1] == old_row:
+                _pending_sheet_writes[i] = (item[0], item[1], retarget(item[2])) + item[3:]
+    with _row_snapshots_lock:
+        _row_snapshots.pop((sheet_name, old_row), None)
+        row_id = _last_good_row_ids.pop((sheet_name, old_row), None)
+        ent = _last_good_rows.get((sheet_name, row_id)) if row_id is not None else None
+        if ent is not None:
+            _remember_last_good_row_locked(sheet_name, new_row, ent[1])
+    if row_id is not None:
+        for idx_cache in (_checkins_row_index_cache, _submissions_row_index_cache):
+            if idx_cache.get(row_id) == old_row:
+                idx_cache[row_id] = new_row
+    log.info(f"queued append on {sheet_name} landed on row {new_row}, not {old_row}; later writes retargeted")
+
+def _drain_pending_sheet_writes():
+    """Replay queued writes in FIFO order; stop (and keep the rest) at the first failure."""
+    while True:
+        if not _drain_lock.acquire(blocking=False):
+            return  # the running drain re-checks the queue before it lets go
+        try:
+            _drain_ctx.active = True
+            emptied = _replay_queued_writes()
+        finally:
+            _drain_ctx.active = False
+            _drain_lock.release()
+        with _pending_writes_lock:
+            if not emptied or not _pending_sheet_writes:
+                return
+        # a write was queued while we were releasing the lock: go round again
+
+def _replay_queued_writes() -> bool:
+    """Send queued writes oldest first. True when the queue ran empty, False when paused: the breaker
+    opened again (the next closing resumes), or a write kept failing with the breaker closed
+    (SHEETS_REPLAY_MAX_ATTEMPTS times; it is then dropped so it cannot hold back every later write)."""
+    failures = 0
+    while True:
+        with _pending_writes_lock:
+            if not _pending_sheet_writes:
+                return True
+            item = _pending_sheet_writes[0]
+        kind, sheet_name, range_name, values, _queued_at, predicted = item
+        if kind != "append" and _targets_placeholder(range_name):
+            # its append was dropped, so the row never got a real number
+            log.error(f"queued {kind} on {range_name} targets a row that was never appended; dropped")
+            with _pending_writes_lock:
+                if _pending_sheet_writes and _pending_sheet_writes[0] is item:
+                    _pending_sheet_writes.popleft()
+                    _SHEETS_BREAKER["dropped"] += 1
+            continue
+        if kind == "append":
+            result = append_sheet_data(sheet_name, values)
+        else:
+            result = update_sheet_data(sheet_name, range_name, values)
+        if result is None or result.get("queued"):
+            failures += 1
+            if _sheets_breaker_state() != "closed":
+                log.warning(f"replay of queued Sheets writes paused ({len(_pending_sheet_writes)} left)")
+                return False
+            if failures < SHEETS_REPLAY_MAX_ATTEMPTS:
+                continue
+            log.error(f"replayed {kind} on {range_name or sheet_name} failed {failures}x; dropped")
+            with _pending_writes_lock:
+                if _pending_sheet_writes and _pending_sheet_writes[0] is item:
+                    _pending_sheet_writes.popleft()
+                    _forget_queued_append(item)
+                    _SHEETS_BREAKER["dropped"] += 1
+            failures = 0
+            continue
+        failures = 0
+        if kind == "append" and predicted:
+            actual = _row_index_from_append_result(result)
+            if actual and actual != predicted:
+                _remap_queued_row(sheet_name, predicted, actual)
+            if actual:
+                _note_sheet_rows(sheet_name, actual)
+        with _pending_writes_lock:
+            if _pending_sheet_writes and _pending_sheet_writes[0] is item:
+                _pending_sheet_writes.popleft()
+                _forget_queued_append(item)
+                _SHEETS_BREAKER["replayed"] += 1
+
+def _sheets_breaker_snapshot():
+    with _breaker_lock:
+        st = dict(_SHEETS_BREAKER)
+    with _pending_writes_lock:
+        st["queued_writes"] = len(_pending_sheet_writes)
+        st["oldest_queued_age_sec"] = round(time.time() - _pending_sheet_writes[0][4], 1) if _pending_sheet_writes else 0
+    st["open_for_sec"] = round(time.time() - st["opened_at"], 1) if st["state"] != "closed" else 0
+    return st
+
+# --- Google API call accounting ---
+# Every Sheets/Drive call is attributed to (api, method, sheet, caller) where caller is the first
+# function on the stack outside the Sheets/Drive helpers (e.g. get_employee_data,
+# _scan_and_timeout_overdue_checkins). Per-minute buckets are kept for
+# API_ACCOUNTING_WINDOW_MIN minutes so /admin/api-usage can show 1m/5m/60m totals next to the
+# per-minute Sheets quotas. "attempts" counts HTTP requests actually sent (what quota is charged for).
+API_ACCOUNTING_WINDOW_MIN = int(os.getenv('API_ACCOUNTING_WINDOW_MIN', '60'))
+_API_DESC_RE = re.compile(r"^(Sheets|Drive)\s+(?:quick\s+)?([\w.]+)\s*(?:\((.*)\))?")
+_API_INFRA_FUNCS = {
+    "_sheets_exec_with_retry", "_drive_exec", "_record_api_call", "_api_caller",
+    "get_sheet_data", "get_sheet_data_quick", "append_sheet_data", "append_sheet_row",
+    "update_sheet_data", "batch_update_sheet_data", "_update_row_dynamic", "_write_image_cells",
+    "_drain_pending_sheet_writes", "get_sheet_ranges", "get_sheet_range", "_find_row_by_id_ranged",
+    "_sheet_properties", "_delete_row_runs", "_fan_out", "_find_sharded_row", "_read_checkins_tail",
+    "_refdata_get", "_refdata_load", "_coalesced_read", "_read_whole_sheet",
+    "_read_whole_sheet_quick", "_read_sheet_ranges",
+}
+_api_calls_lock = threading.Lock()
+_api_call_minutes = deque()   # (minute_epoch, {key: agg})
+_API_CALL_TOTALS = {}         # key -> agg since process start
+
+
+def _api_caller():
+    """Name of the first function up the stack that is not a Sheets/Drive helper."""
+    override = getattr(_rate_ctx, "api_caller", None)  # set inside _fan_out tasks
+    if override:
+        return override
+    f = sys._getframe(2)
+    while f is not None:
+        name = f.f_code.co_name
+        if name not in _API_INFRA_FUNCS and name not in ("<lambda>", "<genexpr>", "<listcomp>"):
+            return name
+        f = f.f_back
+    return "?"
+
+
+def _api_labels(desc):
+    m = _API_DESC_RE.match(desc or "")
+    if not m:
+        return "other", desc or "?", ""
+    api, method, target = m.group(1).lower(), m.group(2), (m.group(3) or "")
+    sheet = target.split(",")[0].split("!")[0].strip("'\" ")
+    return api, method, sheet
+
+
+def _new_api_agg():
+    return {"calls": 0, "attempts": 0, "errors": 0, "bytes_out": 0, "bytes_in": 0,
+            "latency_sum": 0.0, "latency_max": 0.0}
+
+
+def _record_api_call(desc, caller, attempts, ok, latency, bytes_out=0, bytes_in=0):
+    api, method, sheet = _api_labels(desc)
+    key = (api, method, sheet, caller)
+    minute = int(time.time() // 60)
+    with _api_calls_lock:
+        if not _api_call_minutes or _api_call_minutes[-1][0] != minute:
+            _api_call_minutes.append((minute, {}))
+            while _api_call_minutes and _api_call_minutes[0][0] <= minute - API_ACCOUNTING_WINDOW_MIN:
+                _api_call_minutes.popleft()
+        for bucket in (_api_call_minutes[-1][1], _API_CALL_TOTALS):
+            agg = bucket.get(key)
+            if agg is None:
+                agg = bucket[key] = _new_api_agg()
+            agg["calls"] += 1
+            agg["attempts"] += attempts
+            agg["errors"] += 0 if ok else 1
+            agg["bytes_out"] += bytes_out
+            agg["bytes_in"] += bytes_in
+            agg["latency_sum"] += latency
+            agg["latency_max"] = max(agg["latency_max"], latency)
+
+
+def _api_rows(aggs):
+    rows = []
+    for (api, method, sheet, caller), a in aggs.items():
+        row = dict(api=api, method=method, sheet=sheet, caller=caller, **a)
+        row["latency_avg"] = round(a["latency_sum"] / a["calls"], 3) if a["calls"] else 0
+        row["latency_sum"] = round(a["latency_sum"], 3)
+        row["latency_max"] = round(a["latency_max"], 3)
+        rows.append(row)
+    rows.sort(key=lambda r: (-r["attempts"], -r["calls"]))
+    return rows
+
+
+def _api_accounting_snapshot(windows=(1, 5, 60)):
+    now_min = int(time.time() // 60)
+    with _api_calls_lock:
+        minutes = [(m, {k: dict(v) for k, v in d.items()}) for m, d in _api_call_minutes]
+        totals = {k: dict(v) for k, v in _API_CALL_TOTALS.items()}
+    out = {"window_min": API_ACCOUNTING_WINDOW_MIN, "windows": {}}
+    for w in windows:
+        merged = {}
+        for minute, data in minutes:
+            if minute <= now_min - w:
+                continue
+            for key, a in data.items():
+                m = merged.setdefault(key, _new_api_agg())
+                for field in ("calls", "attempts", "errors", "bytes_out", "bytes_in", "latency_sum"):
+                    m[field] += a[field]
+                m["latency_max"] = max(m["latency_max"], a["latency_max"])
+        by_api = {}
+        for (api, method, _sheet, _caller), a in merged.items():
+            kind = "read" if method.split(".")[-1] in ("get", "batchGet") else "write" if api == "sheets" else "calls"
+            t = by_api.setdefault(f"{api}.{kind}", {"calls": 0, "attempts": 0})
+            t["calls"] += a["calls"]
+            t["attempts"] += a["attempts"]
+        out["windows"][f"{w}m"] = {"totals": by_api, "by_call": _api_rows(merged)}
+    out["since_start"] = _api_rows(totals)
+    out["read_coalescing"] = _coalesce_snapshot()
+    return out
+
+
+def _count_response_bytes(req):
+    """Have a googleapiclient HttpRequest note the length of its raw response body in
+    req.response_bytes as it is parsed (no re-encoding of the parsed result)."""
+    req.response_bytes = 0
+    postproc = getattr(req, "postproc", None)
+    if postproc is not None:
+        def _postproc(resp, content):
+            req.response_bytes = len(content or b"")
+            return postproc(resp, content)
+        req.postproc = _postproc
+    return req
+
+def _response_size(result):
+    """Encoded size of a small parsed reply (Drive metadata); Sheets calls use _count_response_bytes."""
+    try:
+        return len(json.dumps(result, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+    except Exception:
+        return 0
+
+def _sheets_exec_with_retry(request_callable, desc: str, method_class: str = "write",
+                            max_attempts=None, timeout_sec=None):
     """
     Execute a Google Sheets request with hard timeout AND exponential backoff.
+    Each attempt first takes a token from the shared rate limiter; 429s honour Retry-After.
+    Fails fast with SheetsCircuitOpen while the Sheets circuit breaker is open.
+    max_attempts / timeout_sec override SHEETS_MAX_ATTEMPTS / SHEETS_EXECUTE_TIMEOUT_SEC (quick reads).
     Returns the JSON dict on success, or raises the last Exception on failure.
     """
+    max_attempts = max_attempts or SHEETS_MAX_ATTEMPTS
+    timeout_sec = timeout_sec or SHEETS_EXECUTE_TIMEOUT_SEC
     attempt = 0
+    sent = 0
+    bytes_out = 0
+    caller = _api_caller()
+    t0 = time.perf_counter()
     delay = SHEETS_BACKOFF_SECONDS
     last_exc = None
-    while attempt < SHEETS_MAX_ATTEMPTS:
+    while attempt < max_attempts:
         attempt += 1
         try:
-            return _exec_with_timeout(lambda: request_callable().execute(num_retries=3),
-                                      SHEETS_EXECUTE_TIMEOUT_SEC,
-                                      f"{desc} (attempt {attempt}/{SHEETS_MAX_ATTEMPTS})")
+            _breaker_before_call(desc)  # raises SheetsCircuitOpen without touching the network
+        except SheetsCircuitOpen:
+            _record_api_call(desc, caller, sent, False, time.perf_counter() - t0, bytes_out)
+            raise
+        try:
+            _rate_acquire("sheets", method_class)
+            req = _count_response_bytes(request_callable())
+            body = getattr(req, "body", None) or b""
+            bytes_out += len(body) if isinstance(body, (bytes, bytearray)) else len(str(body).encode("utf-8"))
+            sent += 1
+            result = _exec_with_timeout(lambda: req.execute(num_retries=SHEETS_CLIENT_NUM_RETRIES),
+                                        timeout_sec,
+                                        f"{desc} (attempt {attempt}/{max_attempts})")
+            _rate_note_success("sheets", method_class)
+            _breaker_record(True)
+            _record_api_call(desc, caller, sent, True, time.perf_counter() - t0, bytes_out, req.response_bytes)
+            if method_class == "write":
+                _note_sheet_write(_api_labels(desc)[2])  # no shared read from before this write
+            return result
         except Exception as e:
             last_exc = e
-            print(f"WARNING: {desc} failed on attempt {attempt}/{SHEETS_MAX_ATTEMPTS}: {e}")
-            traceback.print_exc()
-            sys.stdout.flush()
-            if attempt >= SHEETS_MAX_ATTEMPTS:
+            _breaker_record(not _is_breaker_failure(e))
+            log.warning(f"{desc} failed on attempt {attempt}/{max_attempts}: {e}", exc_info=True)
+            if attempt >= max_attempts:
                 break
-            time.sleep(delay)
-            delay *= 2  # exponential backoff
+            throttled, retry_after = _http_error_throttle_info(e)
+            if throttled:
+                # Shared bucket is now blocked; the next _rate_acquire waits out Retry-After
+                _rate_note_throttled("sheets", method_class, retry_after or delay)
+            else:
+                time.sleep(delay * random.uniform(0.5, 1.5))  # jittered exponential backoff
+            delay *= 2
     # Exhausted attempts
+    _record_api_call(desc, caller, sent, False, time.perf_counter() - t0, bytes_out)
+    if method_class == "write" and sent:
+        _note_sheet_write(_api_labels(desc)[2])  # a timed-out write may still have landed
     raise last_exc
 
 # --- Locations matching configuration ---
 LOCATIONS_SHEET_NAME = os.getenv('LOCATIONS_SHEET_NAME', 'Locations')
 SITE_NO_MATCH_POLICY = os.getenv('SITE_NO_MATCH_POLICY', 'nearest_or_coords')  # 'nearest_or_coords' | 'coords_only' | 'reject'
-print(f"DEBUG: LOCATIONS_SHEET_NAME = {LOCATIONS_SHEET_NAME}")
-print(f"DEBUG: SITE_NO_MATCH_POLICY = {SITE_NO_MATCH_POLICY}")
-sys.stdout.flush()
+log.debug(f"LOCATIONS_SHEET_NAME = {LOCATIONS_SHEET_NAME}")
+log.debug(f"SITE_NO_MATCH_POLICY = {SITE_NO_MATCH_POLICY}")
 
 
 # --- Submissions sheet configuration ---
 SUBMISSIONS_SHEET_NAME = os.getenv('SUBMISSIONS_SHEET_NAME', 'Submissions')
 
+# --- Sharding: CheckIns / Submissions spread over several spreadsheets ---
+# SHEET_SHARD_IDS lists the spreadsheets that hold the CheckIns and Submissions tabs (same layout
+# in each); Employees, Roles and Locations always stay in SPREADSHEET_ID. A new transaction's row
+# goes to the shard picked by SHARD_KEY: "user" (stable hash of the LINE user id) or "site_group"
+# (SHARD_SITE_GROUP_MAP "G1:0,G2:1", unmapped groups hashed).
+# Inside the Sheets helpers a shard's tab is named "<Tab>@<n>" (e.g. "CheckIns@1"), so caches,
+# row snapshots, queued writes and API accounting are per shard; _resolve_sheet() turns it into
+# (spreadsheet id, tab) at the API call. A shard that is SPREADSHEET_ID itself keeps the plain name,
+# so an unsharded deployment behaves exactly as before.
+SHEET_SHARD_IDS = [s.strip() for s in os.getenv('SHEET_SHARD_IDS', '').split(',') if s.strip()] or [SPREADSHEET_ID]
+SHARD_KEY = os.getenv('SHARD_KEY', 'user')  # 'user' | 'site_group'
+SHARD_SITE_GROUP_MAP = {}
+for _item in os.getenv('SHARD_SITE_GROUP_MAP', '').split(','):
+    if ':' in _item:
+        _grp, _n = _item.rsplit(':', 1)
+        SHARD_SITE_GROUP_MAP[_grp.strip()] = int(_n) % len(SHEET_SHARD_IDS)
+TXN_SHARD_CACHE_MAX = int(os.getenv('TXN_SHARD_CACHE_MAX', '20000'))
+_txn_shard = {}  # transaction id -> shard index (where its CheckIns / Submissions row lives)
+_txn_shard_lock = threading.Lock()
+log.debug(f"SHEET_SHARD_IDS = {len(SHEET_SHARD_IDS)} spreadsheet(s), SHARD_KEY = {SHARD_KEY}")
+
+
+def _shard_sheet(base, n):
+    """Helper-level name of tab `base` in shard n ("CheckIns" or "CheckIns@2")."""
+    return base if SHEET_SHARD_IDS[n] == SPREADSHEET_ID else f"{base}@{n}"
+
+
+def _shard_sheets(base):
+    return [_shard_sheet(base, n) for n in range(len(SHEET_SHARD_IDS))]
+
+
+def _sheet_base(sheet_name):
+    return sheet_name.split("@", 1)[0]
+
+
+def _resolve_sheet(sheet_name):
+    """'CheckIns@1' -> (shard 1 spreadsheet id, 'CheckIns'); plain names -> (SPREADSHEET_ID, name)."""
+    base, sep, n = sheet_name.partition("@")
+    if sep and n.isdigit() and int(n) < len(SHEET_SHARD_IDS):
+        return SHEET_SHARD_IDS[int(n)], base
+    return SPREADSHEET_ID, sheet_name
+
+
+def _resolve_range(range_name):
+    """'CheckIns@1!I5:J5' -> (spreadsheet id, 'CheckIns!I5:J5')."""
+    sheet, sep, cells = range_name.partition("!")
+    spreadsheet_id, tab = _resolve_sheet(sheet)
+    return spreadsheet_id, tab + sep + cells
+
+
+def _shard_index(user_id="", site_group=""):
+    if len(SHEET_SHARD_IDS) == 1:
+        return 0
+    if SHARD_KEY == "site_group" and site_group:
+        if site_group in SHARD_SITE_GROUP_MAP:
+            return SHARD_SITE_GROUP_MAP[site_group]
+        key = site_group
+    else:
+        key = user_id or site_group or ""
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16) % len(SHEET_SHARD_IDS)
+
+
+def _shard_of_sheet(sheet_name):
+    _, sep, n = sheet_name.partition("@")
+    if sep and n.isdigit():
+        return int(n)
+    return SHEET_SHARD_IDS.index(SPREADSHEET_ID) if SPREADSHEET_ID in SHEET_SHARD_IDS else 0
+
+
+def _remember_txn_shard(txn_id, sheet_name):
+    with _txn_shard_lock:
+        _txn_shard.pop(txn_id, None)
+        _txn_shard[txn_id] = _shard_of_sheet(sheet_name)
+        while len(_txn_shard) > TXN_SHARD_CACHE_MAX:
+            _txn_shard.pop(next(iter(_txn_shard)))
+
+
+def _txn_sheet(base, txn_id, user_id="", site_group=""):
+    """Tab holding txn_id's row: the shard it was found in / written to, else the routing choice."""
+    n = _txn_shard.get(txn_id)
+    if n is None:
+        n = _shard_index(user_id, site_group)
+    return _shard_sheet(base, n)
+
+
+def _fan_out(fn, items, timeout_sec=None):
+    """fn(item) for every item, in parallel on the fan-out pool when there is more than one.
+    Keeps the caller's API priority and accounting label; a raising or timed-out call yields None.
+    Runs the items one by one in the calling thread when the fan-out pool is saturated."""
+    if len(items) <= 1:
+        return [fn(x) for x in items]
+    if _fan_out_executor.saturated():
+        out = []
+        for x in items:
+            try:
+                out.append(fn(x))
+            except Exception as e:
+                log.warning(f"fan-out call for {x} failed: {e}", exc_info=True)
+                out.append(None)
+        return out
+    prio = _current_api_priority()
+    caller = _api_caller()
+
+    def task(x):
+        def _fan_out_task():
+            _rate_ctx.api_caller = caller
+            try:
+                with _api_priority(prio):
+                    return fn(x)
+            finally:
+                _rate_ctx.api_caller = None
+        return _fan_out_task
+
+    futures = [_fan_out_executor.submit(task(x)) for x in items]
+    deadline = time.monotonic() + (FAN_OUT_TIMEOUT_SEC if timeout_sec is None else timeout_sec)
+    out = []
+    for x, fut in zip(items, futures):
+        try:
+            out.append(fut.result(timeout=max(0.0, deadline - time.monotonic())))
+        except FuturesTimeout:
+            _fan_out_executor.abandon(fut)
+            log.warning(f"fan-out call for {x} timed out")
+            out.append(None)
+        except Exception as e:
+            log.warning(f"fan-out call for {x} failed: {e}", exc_info=True)
+            out.append(None)
+    return out
+
 # --- Roles sheet (for registration) ---
 ROLES_SHEET_NAME = os.getenv('ROLES_SHEET_NAME', 'Roles')
 ROLES_CACHE_TTL_SEC = float(os.getenv('ROLES_CACHE_TTL_SEC', '600'))  # default: 10 minutes
-_ROLES_CACHE = {"items": None, "ts": 0.0}
+_ROLES_CACHE = {"items": None, "version": None}  # parsed roles of reference-data version
+
+# --- Locations cache (parsed site list) ---
+LOCATIONS_CACHE_TTL_SEC = float(os.getenv('LOCATIONS_CACHE_TTL_SEC', '300'))  # default: 5 minutes
+_LOCATIONS_CACHE = {"items": None, "version": None, "sheet": None}  # parsed sites of reference-data version
 
 # Validate GOOGLE_REDIRECT_URI for HTTPS
 if GOOGLE_REDIRECT_URI and not GOOGLE_REDIRECT_URI.startswith("https://"):
@@ -202,8 +1072,7 @@ if GOOGLE_REDIRECT_URI and not GOOGLE_REDIRECT_URI.startswith("https://"):
 
 TOKEN_PATH = "token.json" # Path to store OAuth token
 CLIENT_SECRETS_FILE = "client_secret.json" # Path to client_secret.json downloaded from Cloud Console
-print(f"DEBUG: CLIENT_SECRETS_FILE path: {os.path.abspath(CLIENT_SECRETS_FILE)}") # New print
-sys.stdout.flush()
+log.debug(f"CLIENT_SECRETS_FILE path: {os.path.abspath(CLIENT_SECRETS_FILE)}")
 
  # Global variables for Google services
 sheets_service = None
@@ -211,11 +1080,17 @@ drive_service = None
 # Background scheduler (initialized in __main__)
 scheduler = None
 
-# ---------- Simple cache for Employees sheet ----------
-_EMP_CACHE = {"rows": None, "ts": 0.0}
+# ---------- Reference data cache TTLs (see "Reference data cache") ----------
 EMP_CACHE_TTL_SEC = float(os.getenv("EMP_CACHE_TTL_SEC", "30"))
+REFDATA_STALE_SEC = float(os.getenv('REFDATA_STALE_SEC', '300'))  # serve-while-revalidate window past the TTL
+REFDATA_REFRESH_AHEAD = float(os.getenv('REFDATA_REFRESH_AHEAD', '0.8'))  # share of TTL after which a tab joins a batch
+# Last successful full read of every other tab; served only while the Sheets breaker is open
+_SHEET_LAST_GOOD = {}
 # -----------------------------------------------------
 
+# message_id -> image bytes downloaded ahead of handle_image_message (asyncio server mode)
+_prefetched_image_bytes = {}
+
 # In-memory locks per transaction to avoid race conditions when multiple images arrive nearly simultaneously
 _txn_locks = defaultdict(threading.Lock)
 # Track processed webhook event ids to avoid duplicate processing (LINE redelivery)
@@ -223,9 +1098,111 @@ _processed_events = set()
 
 # Cache: checkin_id -> row index (1-based) to allow partial updates when Sheets read times out
 _checkins_row_index_cache = {}
+_submissions_row_index_cache = {}  # submit_id -> row index (1-based), same idea for Submissions
+
+
+# Row numbers stay valid only while no rows are deleted. Everything that looks a row up and later
+# writes to it by number (webhook dispatch, the LIFF POST, the timeout scan) holds this gate shared;
+# archival holds it exclusively for its last in-flight check, the delete and the row-cache reset.
+class _RowPositionGate:
+    """Shared/exclusive gate. Shared is re-entrant per thread; exclusive waits for a moment with no
+    shared holder (it does not block new shared holders while it waits)."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._local = threading.local()
+
+    @contextmanager
+    def shared(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            with self._cond:
+                while self._exclusive:
+                    self._cond.wait()
+                self._shared += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                with self._cond:
+                    self._shared -= 1
+                    if not self._shared:
+                        self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self, timeout_sec):
+        """Yields True while held exclusively, or False (nothing held) if not free within timeout_sec."""
+        got = False
+        deadline = time.monotonic() + timeout_sec
+        with self._cond:
+            while self._shared or self._exclusive:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            else:
+                self._exclusive = got = True
+        try:
+            yield got
+        finally:
+            if got:
+                with self._cond:
+                    self._exclusive = False
+                    self._cond.notify_all()
+
+_row_positions = _RowPositionGate()
+
+
+def _holds_row_positions(fn):
+    """Run fn with the row-position gate held shared (see _RowPositionGate)."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _row_positions.shared():
+            return fn(*args, **kwargs)
+    return wrapper
+
+# httplib2.Http is not thread-safe, and Sheets / Drive requests run on many executor threads at once.
+# Every request therefore executes on an AuthorizedHttp it has to itself (with its own socket
+# timeout); finished ones are kept, up to GOOGLE_HTTP_MAX_IDLE, so their connections are reused.
+GOOGLE_HTTP_MAX_IDLE = int(os.getenv('GOOGLE_HTTP_MAX_IDLE', '16'))
+
+def _authorized_request_builder(creds, timeout_sec):
+    """requestBuilder for googleapiclient build(): requests that check out a private AuthorizedHttp
+    for the duration of execute()."""
+    from googleapiclient.http import HttpRequest
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
+    idle = []
+    idle_lock = threading.Lock()
+
+    class _Request(HttpRequest):
+        def execute(self, http=None, num_retries=0):
+            if http is not None:
+                return super().execute(http=http, num_retries=num_retries)
+            with idle_lock:
+                http = idle.pop() if idle else None
+            if http is None:
+                http = AuthorizedHttp(creds, http=httplib2.Http(timeout=timeout_sec))
+            try:
+                return super().execute(http=http, num_retries=num_retries)
+            finally:
+                # back only once the call has ended, also when the caller stopped waiting on it
+                with idle_lock:
+                    if len(idle) < GOOGLE_HTTP_MAX_IDLE:
+                        idle.append(http)
+    return _Request
 
 def get_drive_service_oauth():
     """Authenticates with Google using OAuth 2.0 and returns Drive service object."""
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
+    from googleapiclient.discovery import build
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
     creds = None
     if pathlib.Path(TOKEN_PATH).exists():
         creds = Credentials.from_authorized_user_file(TOKEN_PATH, OAUTH_SCOPES)
@@ -235,28 +1212,37 @@ def get_drive_service_oauth():
             creds.refresh(Request())
         else:
             # No valid creds, user needs to authorize via /authorize route
-            print("DEBUG: No valid OAuth credentials found. User needs to authorize.")
-            sys.stdout.flush()
+            log.debug("No valid OAuth credentials found. User needs to authorize.")
             return None
     
     # Save the credentials for the next run
     with open(TOKEN_PATH, 'w') as f:
         f.write(creds.to_json())
 
-    # Build with credentials only (avoid passing http together with credentials)
-    return build('drive', 'v3', credentials=creds, cache_discovery=False)
+    # Build with an authorized http only (googleapiclient disallows http+credentials together);
+    # the socket timeout makes abandoned calls end instead of holding an executor thread.
+    # Requests run on their own AuthorizedHttp (_authorized_request_builder).
+    authed_http = AuthorizedHttp(creds, http=httplib2.Http(timeout=DRIVE_EXECUTE_TIMEOUT_SEC))
+    return build('drive', 'v3', http=authed_http, cache_discovery=False,
+                 requestBuilder=_authorized_request_builder(creds, DRIVE_EXECUTE_TIMEOUT_SEC))
 
 def get_google_service_sheets():
     """Authenticates with Google using a service account for Sheets access (with HTTP timeout)."""
     try:
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
+        from google_auth_httplib2 import AuthorizedHttp
+        import httplib2
         creds = service_account.Credentials.from_service_account_file(
             SERVICE_ACCOUNT_FILE, scopes=SERVICE_ACCOUNT_SCOPES)
-        # Build with credentials only (newer googleapiclient disallows http+credentials together)
-        return build('sheets', 'v4', credentials=creds, cache_discovery=False)
+        # Build with an authorized http only (newer googleapiclient disallows http+credentials together);
+        # the socket timeout bounds each call even after _exec_with_timeout stops waiting on it.
+        # Requests run on their own AuthorizedHttp (_authorized_request_builder).
+        authed_http = AuthorizedHttp(creds, http=httplib2.Http(timeout=SHEETS_EXECUTE_TIMEOUT_SEC))
+        return build('sheets', 'v4', http=authed_http, cache_discovery=False,
+                     requestBuilder=_authorized_request_builder(creds, SHEETS_EXECUTE_TIMEOUT_SEC))
     except Exception as e:
-        print(f"Error initializing Google Sheets service account: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
+        log.error(f"Error initializing Google Sheets service account: {e}", exc_info=True)
         return None
 
 def ensure_google_services(): # Modified to handle both OAuth and Service Account
@@ -265,15 +1251,13 @@ def ensure_google_services(): # Modified to handle both OAuth and Service Accoun
     if sheets_service is None:
         sheets_service = get_google_service_sheets()
         if sheets_service is None:
-            print("ERROR: Failed to initialize Google Sheets service. Aborting.")
-            sys.stdout.flush()
+            log.error("Failed to initialize Google Sheets service. Aborting.")
             abort(500)
     
     if drive_service is None:
         drive_service = get_drive_service_oauth()
         if drive_service is None:
-            print("ERROR: Google Drive service not authorized. Please authorize via /authorize.")
-            sys.stdout.flush()
+            log.error("Google Drive service not authorized. Please authorize via /authorize.")
             # We don't abort here, but expect the bot to handle cases where Drive is not ready.
 
 # --- LINE Bot Configuration ---
@@ -287,32 +1271,476 @@ if not LINE_CHANNEL_SECRET:
 
 # OAuth Client ID/Secret/Redirect URI checks
 if not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET or not GOOGLE_REDIRECT_URI:
-    print("WARNING: Google OAuth Client ID, Secret, or Redirect URI not fully set in .env. OAuth flow may fail.")
-    sys.stdout.flush()
+    log.warning("Google OAuth Client ID, Secret, or Redirect URI not fully set in .env. OAuth flow may fail.")
 
 # Initialize LINE Messaging API client (v3)
+# --- LINE client: shared connection pool, rate limits, retries ---
+# MessagingApi and MessagingApiBlob share one ApiClient, so every LINE call (api.line.me and
+# api-data.line.me) reuses one urllib3 pool sized for the worker pool. Both are wrapped in
+# _LineClient: each call takes a token from the shared rate limiter (api "line", one bucket per
+# endpoint, defaults from LINE's published per-channel limits), 429/5xx are retried with jittered
+# backoff (Retry-After honoured), push/multicast carry an X-Line-Retry-Key so a retried send is not
+# delivered twice, reply_message is retried on 429 only (a reply token is single-use and a reply has
+# no retry key: after a 5xx the reply may have been delivered, and a retry would only fail with 400), and latency per endpoint/outcome is exported on /metrics and /admin/line.
+LINE_POOL_MAXSIZE = int(os.getenv('LINE_POOL_MAXSIZE', '32'))
+LINE_REQUEST_TIMEOUT_SEC = float(os.getenv('LINE_REQUEST_TIMEOUT_SEC', '10'))
+LINE_MAX_ATTEMPTS = int(os.getenv('LINE_MAX_ATTEMPTS', '3'))
+LINE_BACKOFF_SECONDS = float(os.getenv('LINE_BACKOFF_SECONDS', '0.5'))
+LINE_RATE_BURST = float(os.getenv('LINE_RATE_BURST', '50'))
+LINE_RATE_LIMITS = {  # requests/sec per endpoint; LINE_RPS_<ENDPOINT> overrides
+    endpoint: float(os.getenv(f'LINE_RPS_{endpoint.upper()}', default))
+    for endpoint, default in (("reply", "2000"), ("push", "2000"), ("multicast", "200"),
+                              ("content", "2000"), ("loading", "100"), ("other", "2000"))
+}
+_LINE_ENDPOINTS = {"reply_message": "reply", "push_message": "push", "multicast": "multicast",
+                   "get_message_content": "content", "show_loading_animation": "loading"}
+_LINE_RETRY_KEY_METHODS = ("push_message", "multicast")
+log.debug(f"LINE_POOL_MAXSIZE = {LINE_POOL_MAXSIZE}, LINE_MAX_ATTEMPTS = {LINE_MAX_ATTEMPTS}")
+
+
+def _line_retry_info(exc):
+    """Return (retryable, throttled, retry_after_seconds_or_None) for a LINE ApiException."""
+    status = getattr(exc, "status", None)
+    if not isinstance(exc, ApiException) or not isinstance(status, int):
+        return False, False, None
+    retry_after = None
+    try:
+        raw = (getattr(exc, "headers", None) or {}).get("Retry-After")
+        retry_after = float(raw) if raw else None
+    except Exception:
+        retry_after = None
+    return status == 429 or status >= 500, status == 429, retry_after
+
+
+class _LineClient:
+    """Wraps a MessagingApi / MessagingApiBlob: rate limit, retry and time every method call."""
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        target = getattr(self._api, name)
+        if not callable(target) or name.startswith("_"):
+            return target
+
+        def call(*args, **kwargs):
+            return _line_call(name, target, args, kwargs)
+        return call
+
+
+def _line_call(name, target, args, kwargs):
+    endpoint = _LINE_ENDPOINTS.get(name, "other")
+    kwargs.setdefault("_request_timeout", LINE_REQUEST_TIMEOUT_SEC)
+    if name in _LINE_RETRY_KEY_METHODS:
+        kwargs.setdefault("x_line_retry_key", str(uuid.uuid4()))  # same key on every attempt
+    attached = []
+    if name == "reply_message" and args:
+        req, attached = _attach_pending_notices(args[0])
+        args = (req,) + tuple(args[1:])
+    t0 = time.perf_counter()
+    delay = LINE_BACKOFF_SECONDS
+    outcome = "ok"
+    try:
+        for attempt in range(1, LINE_MAX_ATTEMPTS + 1):
+            _rate_acquire("line", endpoint)
+            try:
+                result = target(*args, **kwargs)
+                _rate_note_success("line", endpoint)
+                if attempt > 1:
+                    outcome = "ok_retried"
+                return result
+            except Exception as e:
+                if kwargs.get("x_line_retry_key") and attempt > 1 and getattr(e, "status", None) == 409:
+                    outcome = "ok_retried"  # the earlier attempt was accepted after all
+                    return None
+                retryable, throttled, retry_after = _line_retry_info(e)
+                if throttled:
+                    _line_note("throttled", endpoint)
+                if retryable and not throttled and name == "reply_message":
+                    outcome = "uncertain"  # 5xx: LINE may have delivered it; never resend
+                    raise
+                if not retryable or attempt >= LINE_MAX_ATTEMPTS:
+                    outcome = "throttled" if throttled else "error"
+                    raise
+                _line_note("retries", endpoint)
+                if throttled:
+                    _rate_note_throttled("line", endpoint, retry_after or delay)
+                else:
+                    time.sleep(delay * random.uniform(0.5, 1.5))
+                log.warning(f"LINE {name} failed with {getattr(e, 'status', '?')} "
+                            f"(attempt {attempt}/{LINE_MAX_ATTEMPTS}); retrying")
+                delay *= 2
+    finally:
+        _observe_latency(endpoint, "line", outcome, time.perf_counter() - t0, store=_LINE_LATENCY)
+        _line_note("calls", endpoint)
+        if args:
+            _messaging_note(name, args[0], outcome.startswith("ok"), attached, outcome == "uncertain")
+
+
+_LINE_LATENCY = {}  # (endpoint, "line", outcome) -> histogram series, see _observe_latency
+_LINE_COUNTERS = {}  # (counter, endpoint) -> n
+_line_counters_lock = threading.Lock()
+
+
+def _line_note(counter, endpoint):
+    with _line_counters_lock:
+        _LINE_COUNTERS[(counter, endpoint)] = _LINE_COUNTERS.get((counter, endpoint), 0) + 1
+
+
+def _line_snapshot():
+    with _latency_lock:
+        series = [(k, dict(v, recent=sorted(v["recent"]))) for k, v in _LINE_LATENCY.items()]
+    with _line_counters_lock:
+        counters = dict(_LINE_COUNTERS)
+    out = {}
+    for (endpoint, _flow, outcome), s in sorted(series):
+        ep = out.setdefault(endpoint, {"calls": counters.get(("calls", endpoint), 0),
+                                       "retries": counters.get(("retries", endpoint), 0),
+                                       "throttled": counters.get(("throttled", endpoint), 0),
+                                       "outcomes": {}})
+        ep["outcomes"][outcome] = {"count": s["count"], "avg_ms": round(s["sum"] / s["count"] * 1000, 1),
+                                   **{f"p{int(q * 100)}_ms": round(_quantile(s["recent"], q) * 1000, 1)
+                                      for q in LATENCY_QUANTILES}}
+    limits = {k: v for k, v in _rate_limiter_snapshot().items() if k.startswith("line/")}
+    return {"endpoints": out, "rate_limits": limits, "pool_maxsize": LINE_POOL_MAXSIZE}
+
+
 configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-line_bot_api = MessagingApi(ApiClient(configuration))
+configuration.connection_pool_maxsize = LINE_POOL_MAXSIZE
+_line_api_client = ApiClient(configuration)
+line_bot_api = _LineClient(MessagingApi(_line_api_client))
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
-blob_api = MessagingApiBlob(ApiClient(configuration)) # Initialize MessagingApiBlob
+blob_api = _LineClient(MessagingApiBlob(_line_api_client))
+
+log.info("LINE Bot API and Webhook Handler initialized.")
+
+# --- Latency spans (image path) ---
+# handle_image_message runs inside _image_trace(); each stage (LINE download, Pillow, Drive
+# create/permission, Sheets find/update, reply, ...) is timed with _span() and recorded into a
+# histogram keyed by (stage, flow, outcome). Spans outside an active trace are no-ops, so shared
+# helpers can be instrumented freely. /metrics exposes the histograms in Prometheus text format
+# plus p50/p95/p99 over the most recent LATENCY_QUANTILE_WINDOW samples per series.
+LATENCY_BUCKETS_SEC = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0)
+LATENCY_QUANTILE_WINDOW = int(os.getenv('LATENCY_QUANTILE_WINDOW', '1024'))
+LATENCY_QUANTILES = (0.5, 0.95, 0.99)
+_latency_lock = threading.Lock()
+_LATENCY = {}  # (stage, flow, outcome) -> {"buckets": [...], "count": n, "sum": s, "recent": deque}
+_span_ctx = threading.local()
+
+
+def _observe_latency(stage, flow, outcome, seconds, store=None):
+    key = (stage, flow, outcome)
+    store = _LATENCY if store is None else store
+    with _latency_lock:
+        series = store.get(key)
+        if series is None:
+            series = store[key] = {"buckets": [0] * len(LATENCY_BUCKETS_SEC), "count": 0, "sum": 0.0,
+                                      "recent": deque(maxlen=LATENCY_QUANTILE_WINDOW)}
+        for i, bound in enumerate(LATENCY_BUCKETS_SEC):
+            if seconds <= bound:
+                series["buckets"][i] += 1
+        series["count"] += 1
+        series["sum"] += seconds
+        series["recent"].append(seconds)
+
+
+def _quantile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    pos = min(len(sorted_values) - 1, max(0, int(math.ceil(q * len(sorted_values))) - 1))
+    return sorted_values[pos]
+
+
+@contextmanager
+def _span(stage):
+    """Time one stage of the current trace; outcome is 'error' if the block raises."""
+    trace = getattr(_span_ctx, "trace", None)
+    if trace is None:
+        yield {}
+        return
+    span = {"outcome": "ok"}
+    t0 = time.perf_counter()
+    try:
+        yield span
+    except Exception:
+        span["outcome"] = "error"
+        raise
+    finally:
+        dur = time.perf_counter() - t0
+        _observe_latency(stage, trace["flow"], span["outcome"], dur)
+        trace["stages"].append((stage, dur))
+
+
+@contextmanager
+def _image_trace():
+    """Trace one image event; the handler fills in trace['flow'] and trace['outcome']."""
+    trace = {"flow": "unknown", "outcome": "ok", "stages": []}
+    prev = getattr(_span_ctx, "trace", None)
+    _span_ctx.trace = trace
+    t0 = time.perf_counter()
+    try:
+        yield trace
+    except Exception:
+        trace["outcome"] = "error"
+        raise
+    finally:
+        total = time.perf_counter() - t0
+        _span_ctx.trace = prev
+        _observe_latency("total", trace["flow"], trace["outcome"], total)
+        stages = " ".join(f"{name}={dur * 1000:.0f}ms" for name, dur in trace["stages"])
+        log.info(f"image trace flow={trace['flow']} outcome={trace['outcome']} total={total * 1000:.0f}ms {stages}")
+
+
+def _latency_snapshot():
+    with _latency_lock:
+        items = [(k, dict(v, recent=sorted(v["recent"]))) for k, v in _LATENCY.items()]
+    return sorted(items)
 
-print("LINE Bot API and Webhook Handler initialized.")
-sys.stdout.flush() # Flush output
+
+def _render_prometheus_metrics():
+    lines = [
+        "# HELP senalocation_image_stage_seconds Latency of image-path stages.",
+        "# TYPE senalocation_image_stage_seconds histogram",
+    ]
+    snapshot = _latency_snapshot()
+    for (stage, flow, outcome), s in snapshot:
+        labels = f'stage="{stage}",flow="{flow}",outcome="{outcome}"'
+        for bound, n in zip(LATENCY_BUCKETS_SEC, s["buckets"]):
+            lines.append(f'senalocation_image_stage_seconds_bucket{{{labels},le="{bound}"}} {n}')
+        lines.append(f'senalocation_image_stage_seconds_bucket{{{labels},le="+Inf"}} {s["count"]}')
+        lines.append(f"senalocation_image_stage_seconds_sum{{{labels}}} {s['sum']:.6f}")
+        lines.append(f"senalocation_image_stage_seconds_count{{{labels}}} {s['count']}")
+    lines += [
+        f"# HELP senalocation_image_stage_quantile_seconds Quantiles over the last {LATENCY_QUANTILE_WINDOW} samples.",
+        "# TYPE senalocation_image_stage_quantile_seconds gauge",
+    ]
+    for (stage, flow, outcome), s in snapshot:
+        labels = f'stage="{stage}",flow="{flow}",outcome="{outcome}"'
+        for q in LATENCY_QUANTILES:
+            lines.append(f'senalocation_image_stage_quantile_seconds{{{labels},quantile="{q}"}} '
+                         f'{_quantile(s["recent"], q):.6f}')
+    refdata = _refdata_snapshot()["tabs"]
+    lines += [
+        "# HELP senalocation_refdata_requests_total Reference data cache lookups by result.",
+        "# TYPE senalocation_refdata_requests_total counter",
+    ]
+    for tab, st in refdata.items():
+        for result in ("hits", "stale_hits", "misses", "errors"):
+            lines.append(f'senalocation_refdata_requests_total{{tab="{tab}",result="{result}"}} {st[result]}')
+    lines += [
+        "# HELP senalocation_refdata_age_seconds Age of the cached copy of each reference tab.",
+        "# TYPE senalocation_refdata_age_seconds gauge",
+    ]
+    for tab, st in refdata.items():
+        if st["age_sec"] is not None:
+            lines.append(f'senalocation_refdata_age_seconds{{tab="{tab}"}} {st["age_sec"]}')
+    coalesce = _coalesce_snapshot()
+    lines += [
+        "# HELP senalocation_sheets_coalesced_reads_total Non-reference Sheets reads: fetched, joined in flight, shared after.",
+        "# TYPE senalocation_sheets_coalesced_reads_total counter",
+    ] + [f'senalocation_sheets_coalesced_reads_total{{result="{r}"}} {coalesce[r]}' for r in ("fetches", "joined", "shared")]
+    with _txn_stats_lock:
+        txn_stats = dict(_TXN_STATS)
+    lines += [
+        "# HELP senalocation_txn_issued_total Signed transaction ids issued.",
+        "# TYPE senalocation_txn_issued_total counter",
+        f"senalocation_txn_issued_total {txn_stats.pop('issued')}",
+        "# HELP senalocation_txn_checks_total Transaction ids on incoming locations by check result (no I/O).",
+        "# TYPE senalocation_txn_checks_total counter",
+    ] + [f'senalocation_txn_checks_total{{result="{r}"}} {n}' for r, n in txn_stats.items()]
+    with _latency_lock:
+        line_series = sorted((k, dict(v)) for k, v in _LINE_LATENCY.items())
+    lines += [
+        "# HELP senalocation_line_request_seconds LINE Messaging API call latency (retries included) by endpoint.",
+        "# TYPE senalocation_line_request_seconds histogram",
+    ]
+    for (endpoint, _flow, outcome), s in line_series:
+        labels = f'endpoint="{endpoint}",outcome="{outcome}"'
+        for bound, n in zip(LATENCY_BUCKETS_SEC, s["buckets"]):
+            lines.append(f'senalocation_line_request_seconds_bucket{{{labels},le="{bound}"}} {n}')
+        lines.append(f'senalocation_line_request_seconds_bucket{{{labels},le="+Inf"}} {s["count"]}')
+        lines.append(f"senalocation_line_request_seconds_sum{{{labels}}} {s['sum']:.6f}")
+        lines.append(f"senalocation_line_request_seconds_count{{{labels}}} {s['count']}")
+    with _line_counters_lock:
+        line_counters = sorted(_LINE_COUNTERS.items())
+    for counter, help_text in (("retries", "LINE call attempts retried after 429/5xx."),
+                               ("throttled", "LINE call attempts answered with 429.")):
+        lines += [f"# HELP senalocation_line_{counter}_total {help_text}",
+                  f"# TYPE senalocation_line_{counter}_total counter"]
+        lines += [f'senalocation_line_{counter}_total{{endpoint="{ep}"}} {n}' for (c, ep), n in line_counters if c == counter]
+    messaging = _messaging_snapshot()
+    lines += [
+        "# HELP senalocation_line_messages_total Messages sent by reply (free) and push (billed, per recipient).",
+        "# TYPE senalocation_line_messages_total counter",
+        f'senalocation_line_messages_total{{kind="reply"}} {messaging["stats"]["reply"]}',
+        f'senalocation_line_messages_total{{kind="reply_uncertain"}} {messaging["stats"]["reply_uncertain"]}',
+        f'senalocation_line_messages_total{{kind="push"}} {messaging["stats"]["push_recipients"]}',
+        "# HELP senalocation_notices_total Out-of-band notices by how they were delivered.",
+        "# TYPE senalocation_notices_total counter",
+    ] + [f'senalocation_notices_total{{outcome="{k[len("notices_"):]}"}} {v}'
+         for k, v in messaging["stats"].items() if k.startswith("notices_")]
+    lines += [
+        "# HELP senalocation_notices_pending Notices waiting for the user's next interaction.",
+        "# TYPE senalocation_notices_pending gauge",
+        f"senalocation_notices_pending {messaging['pending_notices']}",
+    ]
+    with _latency_lock:
+        notice_series = sorted((k, dict(v)) for k, v in _NOTICE_LATENCY.items())
+    lines += [
+        "# HELP senalocation_notice_delivery_seconds Time from a notice being raised to LINE accepting it, by route.",
+        "# TYPE senalocation_notice_delivery_seconds histogram",
+    ]
+    for (route, _flow, outcome), s in notice_series:
+        labels = f'route="{route}",outcome="{outcome}"'
+        for bound, n in zip(LATENCY_BUCKETS_SEC, s["buckets"]):
+            lines.append(f'senalocation_notice_delivery_seconds_bucket{{{labels},le="{bound}"}} {n}')
+        lines.append(f'senalocation_notice_delivery_seconds_bucket{{{labels},le="+Inf"}} {s["count"]}')
+        lines.append(f"senalocation_notice_delivery_seconds_sum{{{labels}}} {s['sum']:.6f}")
+        lines.append(f"senalocation_notice_delivery_seconds_count{{{labels}}} {s['count']}")
+    if messaging["quota"]["remaining"] is not None:
+        lines += [
+            "# HELP senalocation_line_push_quota_remaining Pushes left this month (LINE usage + local count since).",
+            "# TYPE senalocation_line_push_quota_remaining gauge",
+            f"senalocation_line_push_quota_remaining {messaging['quota']['remaining']}",
+        ]
+    return "\n".join(lines) + "\n"
 
 # --- Blocking-call timeout wrapper ---
+# Google calls get a socket-level timeout (see get_google_service_sheets / get_drive_service_oauth),
+# so a call abandoned by _exec_with_timeout still ends on its own instead of pinning a worker.
+# The pool below grows past THREAD_POOL_WORKERS while abandoned calls occupy threads and
+# sheds idle extra workers again, and it counts everything for /admin/executor.
 THREAD_POOL_WORKERS = int(os.getenv('THREAD_POOL_WORKERS', '8'))
-print(f"DEBUG: THREAD_POOL_WORKERS = {THREAD_POOL_WORKERS}")
-sys.stdout.flush()
-_executor_singleton = ThreadPoolExecutor(max_workers=THREAD_POOL_WORKERS)
+THREAD_POOL_MAX_WORKERS = int(os.getenv('THREAD_POOL_MAX_WORKERS', str(THREAD_POOL_WORKERS * 4)))
+THREAD_POOL_IDLE_SEC = float(os.getenv('THREAD_POOL_IDLE_SEC', '60'))
+log.debug(f"THREAD_POOL_WORKERS = {THREAD_POOL_WORKERS} (max {THREAD_POOL_MAX_WORKERS})")
+# _fan_out (per-shard reads, notice senders) gets its own pool: its tasks call _exec_with_timeout,
+# and queueing them on the pool they wait on can starve the Google calls they are waiting for.
+FAN_OUT_WORKERS = int(os.getenv('FAN_OUT_WORKERS', '4'))
+FAN_OUT_MAX_WORKERS = int(os.getenv('FAN_OUT_MAX_WORKERS', str(FAN_OUT_WORKERS * 4)))
+FAN_OUT_TIMEOUT_SEC = float(os.getenv('FAN_OUT_TIMEOUT_SEC', str(SHEETS_EXECUTE_TIMEOUT_SEC * 2)))
+# Same for work started in the background that makes Google calls itself (reference data
+# refreshes, the warm-up reads): it runs on its own small pool, never on the one its calls need.
+BACKGROUND_POOL_MAX_WORKERS = int(os.getenv('BACKGROUND_POOL_MAX_WORKERS', '4'))
+
+class _ElasticExecutor:
+    """
+    Minimal thread pool for blocking Google/LINE calls. Keeps `min_workers` threads alive,
+    spawns more (up to `max_workers`) when no worker is idle, and lets extra workers exit
+    after `idle_sec`. Tracks in-flight and abandoned (timed-out but still running) calls.
+    """
+
+    def __init__(self, min_workers, max_workers, idle_sec):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.idle_sec = idle_sec
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._abandoned = set()
+        self._stats = {"workers": 0, "idle": 0, "in_flight": 0, "peak_workers": 0,
+                       "submitted": 0, "completed": 0, "timeouts": 0,
+                       "cancelled_before_start": 0, "abandoned_completed": 0,
+                       "spawned": 0, "shed": 0}
+
+    def submit(self, fn):
+        fut = Future()
+        with self._lock:
+            self._stats["submitted"] += 1
+            spawn = self._stats["idle"] <= self._tasks.qsize() and self._stats["workers"] < self.max_workers
+            if spawn:
+                self._stats["workers"] += 1
+                self._stats["idle"] += 1
+                self._stats["spawned"] += 1
+                self._stats["peak_workers"] = max(self._stats["peak_workers"], self._stats["workers"])
+        self._tasks.put((fut, fn))
+        if spawn:
+            threading.Thread(target=self._worker, name="exec-worker", daemon=True).start()
+        return fut
+
+    def abandon(self, fut):
+        """Called when the waiter gave up. Cancels queued work; otherwise tracks the running call."""
+        with self._lock:
+            self._stats["timeouts"] += 1
+            if fut.cancel():
+                self._stats["cancelled_before_start"] += 1
+            elif not fut.done():
+                self._abandoned.add(fut)
+
+    def _worker(self):
+        while True:
+            try:
+                fut, fn = self._tasks.get(timeout=self.idle_sec)
+            except queue.Empty:
+                with self._lock:
+                    if self._stats["workers"] > self.min_workers:
+                        self._stats["workers"] -= 1
+                        self._stats["idle"] -= 1
+                        self._stats["shed"] += 1
+                        return
+                continue
+            if not fut.set_running_or_notify_cancel():
+                continue
+            with self._lock:
+                self._stats["idle"] -= 1
+                self._stats["in_flight"] += 1
+            try:
+                fut.set_result(fn())
+            except BaseException as e:
+                fut.set_exception(e)
+            finally:
+                with self._lock:
+                    self._stats["idle"] += 1
+                    self._stats["in_flight"] -= 1
+                    self._stats["completed"] += 1
+                    if fut in self._abandoned:
+                        self._abandoned.discard(fut)
+                        self._stats["abandoned_completed"] += 1
+
+    def saturated(self):
+        """True when every worker the pool may have is busy or spoken for by queued work."""
+        with self._lock:
+            return self._stats["in_flight"] + self._tasks.qsize() >= self.max_workers
+
+    def snapshot(self):
+        with self._lock:
+            st = dict(self._stats)
+            st["abandoned_running"] = len(self._abandoned)
+        st["queued"] = self._tasks.qsize()
+        st["min_workers"] = self.min_workers
+        st["max_workers"] = self.max_workers
+        st["saturation"] = round(st["in_flight"] / float(self.max_workers), 3)
+        return st
+
+_executor_singleton = _ElasticExecutor(THREAD_POOL_WORKERS, THREAD_POOL_MAX_WORKERS, THREAD_POOL_IDLE_SEC)
+_fan_out_executor = _ElasticExecutor(FAN_OUT_WORKERS, FAN_OUT_MAX_WORKERS, THREAD_POOL_IDLE_SEC)
+_background_executor = _ElasticExecutor(1, BACKGROUND_POOL_MAX_WORKERS, THREAD_POOL_IDLE_SEC)
 
 def _exec_with_timeout(fn, timeout_sec, desc=''):
     """Run a callable in a thread and enforce a hard timeout. Raise TimeoutError on expiry."""
+    fut = _executor_singleton.submit(fn)
     try:
-        fut = _executor_singleton.submit(fn)
         return fut.result(timeout=timeout_sec)
     except FuturesTimeout:
+        _executor_singleton.abandon(fut)
         raise TimeoutError(f"Timeout while executing {desc or 'Google API call'} after {timeout_sec}s")
 
+def _drive_exec(fn, desc, bytes_out=0):
+    """Run a Drive request callable through the shared rate limiter with DRIVE_EXECUTE_TIMEOUT_SEC."""
+    caller = _api_caller()
+    _rate_acquire("drive", "write")
+    t0 = time.perf_counter()
+    try:
+        result = _exec_with_timeout(fn, DRIVE_EXECUTE_TIMEOUT_SEC, desc)
+    except Exception as e:
+        _record_api_call(desc, caller, 1, False, time.perf_counter() - t0, bytes_out)
+        throttled, retry_after = _http_error_throttle_info(e)
+        if throttled:
+            _rate_note_throttled("drive", "write", retry_after)
+        raise
+    _rate_note_success("drive", "write")
+    _record_api_call(desc, caller, 1, True, time.perf_counter() - t0, bytes_out, _response_size(result))
+    return result
+
 # --- Google Sheets Helper Functions ---
 def _col_letter(n: int) -> str:
     """1-based column index -> ตัวอักษรคอลัมน์แบบ Excel (1=A, 13=M, 27=AA, ...)"""
@@ -322,88 +1750,584 @@ def _col_letter(n: int) -> str:
         s = chr(65 + r) + s
     return s
 
+# --- Row snapshots for minimal-range writes ---
+# (sheet_name, row_idx_1based) -> copy of the row as last read from / written to Sheets
+ROW_SNAPSHOT_CACHE_MAX = int(os.getenv('ROW_SNAPSHOT_CACHE_MAX', '2000'))
+_row_snapshots = {}
+_row_snapshots_lock = threading.Lock()
+_ROW_DIFF_STATS = {"writes": 0, "skipped": 0, "bytes_full": 0, "bytes_sent": 0}
+
+# Per-row last-good copies by id: (sheet_name, row_id) -> [row_idx_1based, row]. CheckIns / Submissions
+# are only read by range, so there is no whole-tab last-good copy of them; while the breaker is open
+# the row finders answer from here, and queued writes are mirrored in (_apply_write_to_cached_rows).
+# Reference tabs are not kept here: their degraded copy is the reference data cache.
+_last_good_rows = {}
+_last_good_row_ids = {}  # (sheet_name, row_idx_1based) -> row_id
+
+def _remember_row_snapshot(sheet_name: str, row_idx_1based: int, row_values: list):
+    """Keep a copy of a row read from Sheets so a later write can send only the changed cells."""
+    if not row_idx_1based or row_values is None:
+        return
+    with _row_snapshots_lock:
+        key = (sheet_name, row_idx_1based)
+        _row_snapshots.pop(key, None)
+        _row_snapshots[key] = list(row_values)
+        while len(_row_snapshots) > ROW_SNAPSHOT_CACHE_MAX:
+            _row_snapshots.pop(next(iter(_row_snapshots)))
+        _remember_last_good_row_locked(sheet_name, row_idx_1based, row_values)
+
+def _remember_last_good_row_locked(sheet_name, row_idx_1based, row_values):
+    if sheet_name in _REFDATA or not row_values or not row_values[0]:
+        return
+    row_id = row_values[0]
+    old = _last_good_rows.pop((sheet_name, row_id), None)
+    if old is not None:
+        _last_good_row_ids.pop((sheet_name, old[0]), None)
+    stale_id = _last_good_row_ids.get((sheet_name, row_idx_1based))
+    if stale_id is not None and stale_id != row_id:
+        _last_good_rows.pop((sheet_name, stale_id), None)  # that id no longer lives on this row
+    _last_good_rows[(sheet_name, row_id)] = [row_idx_1based, list(row_values)]
+    _last_good_row_ids[(sheet_name, row_idx_1based)] = row_id
+    while len(_last_good_rows) > ROW_SNAPSHOT_CACHE_MAX:
+        (sheet, rid), (idx, _row) = next(iter(_last_good_rows.items()))
+        del _last_good_rows[(sheet, rid)]
+        _last_good_row_ids.pop((sheet, idx), None)
+
+def _patch_last_good_row(sheet_name, range_name, values):
+    """Apply a cell-range write (e.g. 'CheckIns!I12:J12') to the last-good copy of that row, if kept."""
+    start = _parse_a1_start(range_name)
+    if not start:
+        return
+    col, row_1based = start
+    with _row_snapshots_lock:
+        row_id = _last_good_row_ids.get((sheet_name, row_1based))
+        ent = _last_good_rows.get((sheet_name, row_id)) if row_id is not None else None
+        if ent is None:
+            return
+        row = ent[1]
+        while len(row) < col + len(values):
+            row.append("")
+        row[col:col + len(values)] = list(values)
+
+def _last_good_row(sheet_name, row_id):
+    """(copy of row, row_idx_1based) from the last-good copies, or None."""
+    with _row_snapshots_lock:
+        ent = _last_good_rows.get((sheet_name, row_id))
+        return (list(ent[1]), ent[0]) if ent is not None else None
+
+def _row_diff_ranges(sheet_name: str, row_idx_1based: int, prev_row: list, new_row: list):
+    """Return [(range_name, values)] covering only the cells that differ, grouped into contiguous runs."""
+    norm = lambda v: "" if v is None else str(v)
+    width = max(len(prev_row), len(new_row))
+    changed = [j for j in range(width)
+               if norm(prev_row[j] if j < len(prev_row) else "") != norm(new_row[j] if j < len(new_row) else "")]
+    updates = []
+    start = prev = None
+    for j in changed + [None]:
+        if start is not None and (j is None or j != prev + 1):
+            rng = f"{sheet_name}!{_col_letter(start + 1)}{row_idx_1based}"
+            if prev != start:
+                rng += f":{_col_letter(prev + 1)}{row_idx_1based}"
+            updates.append((rng, [new_row[k] if k < len(new_row) else "" for k in range(start, prev + 1)]))
+            start = None
+        if j is not None and start is None:
+            start = j
+        prev = j
+    return updates
+
 def _update_row_dynamic(sheet_name: str, row_idx_1based: int, row_values: list):
     """
-    อัปเดตทั้งแถวโดยให้ช่วงคอลัมน์สิ้นสุดตามความยาวของ row_values อัตโนมัติ
+    อัปเดตแถวโดยให้ช่วงคอลัมน์สิ้นสุดตามความยาวของ row_values อัตโนมัติ
     ป้องกันเคสกำหนดช่วงแค่ A..L แต่ส่งค่าไปถึงคอลัมน์ M แล้วโดน 400
+    ถ้ามี snapshot ของแถวเดิม (id คอลัมน์ A ตรงกัน) จะส่งเฉพาะเซลล์ที่เปลี่ยนผ่าน batchUpdate
+    เพื่อลด payload และไม่เขียนทับค่าที่หัวหน้างานแก้ไว้ในคอลัมน์อื่น
     """
     end_col_letter = _col_letter(len(row_values))
     rng = f"{sheet_name}!A{row_idx_1based}:{end_col_letter}{row_idx_1based}"
-    return update_sheet_data(sheet_name, rng, row_values)
+    with _row_snapshots_lock:
+        prev_row = _row_snapshots.get((sheet_name, row_idx_1based))
+    if prev_row is None or not prev_row or not row_values or prev_row[0] != row_values[0]:
+        result = update_sheet_data(sheet_name, rng, row_values)
+        if result is not None:
+            _remember_row_snapshot(sheet_name, row_idx_1based, row_values)
+        return result
 
-def get_sheet_data(sheet_name):
-    """Reads all data from a specified sheet (with cache for Employees)."""
-    # Cache only for Employees to reduce API pressure in hot paths/scheduler
-    use_cache = (sheet_name == "Employees")
+    updates = _row_diff_ranges(sheet_name, row_idx_1based, prev_row, row_values)
+    bytes_full = len(json.dumps({"range": rng, "values": [row_values]}, default=str, ensure_ascii=False).encode("utf-8"))
+    bytes_sent = len(json.dumps([{"range": r, "values": [v]} for r, v in updates], default=str, ensure_ascii=False).encode("utf-8")) if updates else 0
+    _ROW_DIFF_STATS["writes"] += 1
+    _ROW_DIFF_STATS["bytes_full"] += bytes_full
+    _ROW_DIFF_STATS["bytes_sent"] += bytes_sent
+    _hot_log.debug(f"Row diff {sheet_name}!{row_idx_1based}: {len(updates)} range(s), "
+                   f"{bytes_sent}B sent vs {bytes_full}B full row (saved {bytes_full - bytes_sent}B)")
+    if not updates:
+        _ROW_DIFF_STATS["skipped"] += 1
+        return {"skipped": True}
+    result = batch_update_sheet_data(sheet_name, updates)
+    if result is not None:
+        _remember_row_snapshot(sheet_name, row_idx_1based, row_values)
+    return result
+
+# --- Reference data cache (Employees / Roles / Locations) ---
+# The small reference tabs are cached together and refreshed with one values.batchGet:
+#   - fresh (age <= the tab's TTL)                 -> served from memory
+#   - stale (age <= TTL + REFDATA_STALE_SEC)       -> served from memory, refresh started in background
+#   - older / never loaded / invalidated by a write -> the caller waits for a refresh
+# A refresh takes along every other reference tab past REFDATA_REFRESH_AHEAD of its TTL, so one
+# request usually serves all of them. Concurrent misses of a tab share one in-flight request
+# (single-flight). If the refresh fails the last copy is served, unless a write made it outdated.
+# Counters and ages: /admin/refdata and /metrics.
+_REFDATA_TTL = {"Employees": EMP_CACHE_TTL_SEC, ROLES_SHEET_NAME: ROLES_CACHE_TTL_SEC,
+                LOCATIONS_SHEET_NAME: LOCATIONS_CACHE_TTL_SEC}
+_refdata_lock = threading.Lock()
+_refdata_inflight = {}  # tab -> Future of the batchGet currently loading it
+_REFDATA = {tab: {"rows": None, "loaded": 0.0, "invalidated": 0.0, "version": 0,
+                  "hits": 0, "stale_hits": 0, "misses": 0, "waits": 0, "errors": 0}
+            for tab in _REFDATA_TTL}
+_REFDATA_STATS = {"batches": 0, "background": 0, "tabs_loaded": 0, "last_batch_sec": None}
+
+
+def _refdata_usable(ent):
+    return ent["rows"] is not None and ent["invalidated"] <= ent["loaded"]
+
+
+def _refdata_claim(tab, now):
+    """Start loading `tab` plus any due tabs not already in flight. Caller holds _refdata_lock.
+    Returns (future, tabs) for the caller to run, or None if `tab` is already being loaded."""
+    if tab in _refdata_inflight:
+        return None
+    tabs = [tab] + [t for t, ent in _REFDATA.items()
+                    if t != tab and t not in _refdata_inflight
+                    and (not _refdata_usable(ent) or now - ent["loaded"] >= _REFDATA_TTL[t] * REFDATA_REFRESH_AHEAD)]
+    fut = Future()
+    for t in tabs:
+        _refdata_inflight[t] = fut
+    return fut, tabs
+
+
+def _refdata_load(job):
+    fut, tabs = job
+    started = time.time()
+    try:
+        request = lambda: sheets_service.spreadsheets().values().batchGet(
+            spreadsheetId=SPREADSHEET_ID, ranges=list(tabs))
+        result = _sheets_exec_with_retry(request, f"Sheets batchGet({','.join(tabs)})", method_class="read")
+        values = [vr.get("values", []) for vr in result.get("valueRanges", [])]
+        with _pending_writes_lock, _refdata_lock:  # a write queued meanwhile is mirrored into these rows
+            for tab, rows in zip(tabs, values):
+                ent = _REFDATA[tab]
+                ent.update(rows=_overlay_pending_writes(tab, rows), loaded=started, version=ent["version"] + 1)
+            _REFDATA_STATS["batches"] += 1
+            _REFDATA_STATS["tabs_loaded"] += len(tabs)
+            _REFDATA_STATS["last_batch_sec"] = round(time.time() - started, 3)
+        _hot_log.debug(f"Reference data refreshed: {', '.join(f'{t}={len(r)}' for t, r in zip(tabs, values))}")
+        fut.set_result(True)
+    except Exception as e:
+        with _refdata_lock:
+            for tab in tabs:
+                _REFDATA[tab]["errors"] += 1
+        if isinstance(e, SheetsCircuitOpen):
+            log.warning(f"{e}; reference data not refreshed ({', '.join(tabs)})")
+        else:
+            log.error(f"Reference data refresh failed ({', '.join(tabs)}): {e}", exc_info=True)
+        fut.set_exception(e)
+    finally:
+        with _refdata_lock:
+            for tab in tabs:
+                if _refdata_inflight.get(tab) is fut:
+                    del _refdata_inflight[tab]
+
+
+def _refdata_load_background(job):
+    with _api_priority("background"):
+        _refdata_load(job)
+
+
+def _refdata_get(tab):
+    """Rows of reference tab `tab` (header included), or None if it was never loaded / is known outdated."""
+    entered = time.time()  # any load started after this sees every write that finished before the call
+    for _round in range(2):
+        now = time.time()
+        with _refdata_lock:
+            ent = _REFDATA[tab]
+            age = now - ent["loaded"]
+            ttl = _REFDATA_TTL[tab]
+            if _refdata_usable(ent) and age <= ttl:
+                if not _round:
+                    ent["hits"] += 1
+                return ent["rows"]
+            job = _refdata_claim(tab, now)
+            if _refdata_usable(ent) and age <= ttl + REFDATA_STALE_SEC:
+                ent["stale_hits"] += 1
+                if job:
+                    _REFDATA_STATS["background"] += 1
+                    _background_executor.submit(lambda: _refdata_load_background(job))
+                return ent["rows"]
+            if not _round:
+                ent["misses"] += 1
+            fut = job[0] if job else _refdata_inflight[tab]
+            if not job:
+                ent["waits"] += 1
+        if job:
+            _refdata_load(job)
+        try:
+            fut.result(timeout=SHEETS_EXECUTE_TIMEOUT_SEC * SHEETS_MAX_ATTEMPTS + 5)
+        except Exception:
+            break  # logged by the loading thread; fall back below
+        if job:
+            break
+        # joined a load that started before we asked: one more round (any load claimed now starts later)
+        with _refdata_lock:
+            if _REFDATA[tab]["rows"] is not None and _REFDATA[tab]["loaded"] >= entered:
+                return _REFDATA[tab]["rows"]
+    with _refdata_lock:
+        ent = _REFDATA[tab]
+        return ent["rows"] if _refdata_usable(ent) or (ent["rows"] is not None and ent["loaded"] >= entered) else None
+
+
+def _refdata_invalidate(tab=None):
+    """Mark a reference tab (or all of them) outdated after a write; the next read reloads it."""
+    now = time.time()
+    with _refdata_lock:
+        for t in ([tab] if tab else list(_REFDATA)):
+            _REFDATA[t]["invalidated"] = now
+
+
+def _refdata_snapshot():
+    now = time.time()
+    with _refdata_lock:
+        tabs = {}
+        for tab, ent in _REFDATA.items():
+            looked_up = ent["hits"] + ent["stale_hits"] + ent["misses"]
+            tabs[tab] = {k: ent[k] for k in ("hits", "stale_hits", "misses", "waits", "errors", "version")}
+            tabs[tab].update(
+                rows=len(ent["rows"]) if ent["rows"] is not None else None,
+                age_sec=round(now - ent["loaded"], 1) if ent["rows"] is not None else None,
+                ttl_sec=_REFDATA_TTL[tab], outdated=not _refdata_usable(ent), loading=tab in _refdata_inflight,
+                hit_ratio=round((ent["hits"] + ent["stale_hits"]) / looked_up, 3) if looked_up else None)
+        return {"tabs": tabs, "stale_sec": REFDATA_STALE_SEC, **_REFDATA_STATS}
+
+# --- Read coalescing (CheckIns / Submissions and other non-reference reads) ---
+# Identical concurrent reads (same sheet, same ranges, same mode) share one request: the first
+# caller fetches, the others wait for its result. A finished result is also handed to callers that
+# arrive within SHEETS_READ_SHARE_SEC. Every write to a tab bumps its generation, and a read only
+# joins a fetch of the current generation, so nobody gets data from before a write that finished
+# ahead of their call. Failed reads (None) are never shared past the in-flight waiters.
+# Every caller, the fetcher included, gets its own copy of the rows: callers edit rows in place
+# (upserts, _ensure_row_len, finalize) and must not change each other's rows or the row snapshots.
+SHEETS_READ_SHARE_SEC = float(os.getenv('SHEETS_READ_SHARE_SEC', '0.5'))
+_coalesce_lock = threading.Lock()
+_coalesce = {}         # key -> {"fut": Future, "gen": int, "done": float | None}
+_sheet_write_gen = {}  # helper-level sheet name -> write generation
+_COALESCE_STATS = {"fetches": 0, "joined": 0, "shared": 0}
+
+
+def _note_sheet_write(sheet_name):
+    """A write to sheet_name finished (or may have): later reads must not reuse older fetches."""
+    with _coalesce_lock:
+        _sheet_write_gen[sheet_name] = _sheet_write_gen.get(sheet_name, 0) + 1
+        for key in [k for k in _coalesce if k[0] == sheet_name]:
+            del _coalesce[key]
+
+
+def _copy_read(result):
+    """Private copy of a read result (rows, or a list of row-lists per range) down to the row lists."""
+    if isinstance(result, list):
+        return [_copy_read(x) if isinstance(x, list) else x for x in result]
+    return result
+
+
+def _coalesced_read(key, fetch):
+    """Run fetch() for key = (sheet_name, ...) unless an identical read is in flight or just finished."""
     now = time.time()
+    with _coalesce_lock:
+        gen = _sheet_write_gen.get(key[0], 0)
+        ent = _coalesce.get(key)
+        if ent and ent["gen"] == gen and (ent["done"] is None or now - ent["done"] <= SHEETS_READ_SHARE_SEC):
+            _COALESCE_STATS["joined" if ent["done"] is None else "shared"] += 1
+            fut = ent["fut"]
+        else:
+            fut = None
+            ent = {"fut": Future(), "gen": gen, "done": None}
+            _coalesce[key] = ent
+            _COALESCE_STATS["fetches"] += 1
+    if fut is not None:
+        _hot_log.debug(f"Coalesced read {key}")
+        return _copy_read(fut.result())
+    try:
+        result = fetch()
+    except BaseException as e:
+        ent["fut"].set_exception(e)
+        with _coalesce_lock:
+            if _coalesce.get(key) is ent:
+                del _coalesce[key]
+        raise
+    ent["fut"].set_result(result)
+    with _coalesce_lock:
+        if _coalesce.get(key) is ent:
+            if result is None or SHEETS_READ_SHARE_SEC <= 0:
+                del _coalesce[key]
+            else:
+                ent["done"] = time.time()
+                # opportunistic cleanup of expired entries
+                if len(_coalesce) > 256:
+                    cutoff = ent["done"] - SHEETS_READ_SHARE_SEC
+                    for k in [k for k, e in _coalesce.items() if e["done"] is not None and e["done"] < cutoff]:
+                        del _coalesce[k]
+    return _copy_read(result)
+
+
+def _coalesce_snapshot():
+    with _coalesce_lock:
+        st = dict(_COALESCE_STATS, entries=len(_coalesce), share_sec=SHEETS_READ_SHARE_SEC)
+    served = st["fetches"] + st["joined"] + st["shared"]
+    st["saved_ratio"] = round((st["joined"] + st["shared"]) / served, 3) if served else None
+    return st
+
+def get_sheet_data(sheet_name):
+    """Reads all data from a specified sheet (reference tabs come from the reference data cache)."""
+    if sheet_name in _REFDATA:
+        return _refdata_get(sheet_name)
+    return _coalesced_read((sheet_name, "get"), lambda: _read_whole_sheet(sheet_name))
 
-    if use_cache and _EMP_CACHE["rows"] is not None and (now - _EMP_CACHE["ts"] <= EMP_CACHE_TTL_SEC):
-        print(f"DEBUG: Employees cache hit ({len(_EMP_CACHE['rows'])} rows).")
-        sys.stdout.flush()
-        return _EMP_CACHE["rows"]
 
-    print(f"DEBUG: Attempting to read from sheet: {sheet_name}")
-    sys.stdout.flush()
+def _read_whole_sheet(sheet_name):
+    _hot_log.debug(f"Attempting to read from sheet: {sheet_name}")
     try:
+        spreadsheet_id, tab = _resolve_sheet(sheet_name)
         request = lambda: sheets_service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, range=sheet_name)
-        result = _sheets_exec_with_retry(request, f"Sheets get({sheet_name})")
+            spreadsheetId=spreadsheet_id, range=tab)
+        result = _sheets_exec_with_retry(request, f"Sheets get({sheet_name})", method_class="read")
         data = result.get('values', [])
+        with _pending_writes_lock:
+            _SHEET_LAST_GOOD[sheet_name] = _overlay_pending_writes(sheet_name, data)
 
-        if use_cache:
-            _EMP_CACHE["rows"] = data
-            _EMP_CACHE["ts"] = now
-
-        print(f"DEBUG: Successfully read {len(data)} rows from {sheet_name}.")
-        sys.stdout.flush()
+        _hot_log.debug(f"Successfully read {len(data)} rows from {sheet_name}.")
         return data
+    except SheetsCircuitOpen as e:
+        # Degraded mode: answer immediately from the last good copy instead of waiting on Sheets
+        stale = _SHEET_LAST_GOOD.get(sheet_name)
+        log.warning(f"{e}; serving {'stale cache' if stale is not None else 'nothing'} for {sheet_name}.")
+        return stale
     except Exception as e:
-        print(f"ERROR: Error reading from sheet {sheet_name}: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
-        # If Employees read fails but we have a recent cache, serve stale data
-        if use_cache and _EMP_CACHE["rows"] is not None:
-            print("WARNING: Using stale Employees cache due to Sheets error.")
-            sys.stdout.flush()
-            return _EMP_CACHE["rows"]
+        log.error(f"Error reading from sheet {sheet_name}: {e}", exc_info=True)
         return None
 
 # --- Quick-read helper for Sheets (no retries, hard timeout) ---
 
 def get_sheet_data_quick(sheet_name, timeout_sec=8):
     """อ่านชีตแบบเร็ว ไม่ retry หลายรอบ เพื่อลดเวลาค้างใน scheduler."""
-    print(f"DEBUG: QUICK read from sheet: {sheet_name}")
-    sys.stdout.flush()
+    return _coalesced_read((sheet_name, "quick get", timeout_sec),
+                           lambda: _read_whole_sheet_quick(sheet_name, timeout_sec))
+
+
+def _read_whole_sheet_quick(sheet_name, timeout_sec):
+    _hot_log.debug(f"QUICK read from sheet: {sheet_name}")
+    desc = f"Sheets quick get({sheet_name})"
+    caller = _api_caller()
+    t0 = time.perf_counter()
     try:
+        spreadsheet_id, tab = _resolve_sheet(sheet_name)
         req = lambda: sheets_service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID, range=sheet_name)
+            spreadsheetId=spreadsheet_id, range=tab)
         # no extra retries inside request, just our outer hard-timeout
-        res = _exec_with_timeout(lambda: req().execute(num_retries=0),
-                                 timeout_sec,
-                                 f"Sheets quick get({sheet_name})")
+        _breaker_before_call(desc)
+        _rate_acquire("sheets", "read")
+        try:
+            http_req = _count_response_bytes(req())
+            res = _exec_with_timeout(lambda: http_req.execute(num_retries=0),
+                                     timeout_sec,
+                                     desc)
+        except Exception as e:
+            _breaker_record(not _is_breaker_failure(e))
+            _record_api_call(desc, caller, 1, False, time.perf_counter() - t0)
+            raise
+        _breaker_record(True)
+        _rate_note_success("sheets", "read")
+        _record_api_call(desc, caller, 1, True, time.perf_counter() - t0, 0, http_req.response_bytes)
         data = res.get('values', [])
-        print(f"DEBUG: QUICK read ok: {sheet_name} rows={len(data)}")
-        sys.stdout.flush()
+        _hot_log.debug(f"QUICK read ok: {sheet_name} rows={len(data)}")
         return data
     except Exception as e:
-        print(f"WARNING: QUICK read failed for {sheet_name}: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
+        throttled, retry_after = _http_error_throttle_info(e)
+        if throttled:
+            _rate_note_throttled("sheets", "read", retry_after)
+        log.warning(f"QUICK read failed for {sheet_name}: {e}", exc_info=True)
+        return None
+
+# --- Ranged reads (columns / row windows instead of whole tabs) ---
+# CheckIns and Submissions grow without bound, so lookups read only what they need:
+#   - a known row index -> just that row (A{n}:M{n})
+#   - otherwise the recent tail (last SHEETS_TAIL_ROWS rows), where live transactions are
+#   - otherwise the id column A:A, then the one matching row
+# Several ranges of one tab are fetched with a single values.batchGet (one quota unit).
+SHEETS_TAIL_ROWS = int(os.getenv('SHEETS_TAIL_ROWS', '500'))
+_SHEET_ROW_COUNT = {}  # sheet -> last data row (1-based) seen via appends / column reads
+
+
+def _note_sheet_rows(sheet_name, last_row_1based):
+    if last_row_1based and last_row_1based > _SHEET_ROW_COUNT.get(sheet_name, 0):
+        _SHEET_ROW_COUNT[sheet_name] = last_row_1based
+
+
+def _a1_bounds(a1: str):
+    """'B2:D' -> (r0, c0, r1, c1) 0-based inclusive, None = open end (for slicing cached tabs)."""
+    def part(ref):
+        m = re.match(r"^\$?([A-Z]*)\$?(\d*)$", ref)
+        col = 0
+        for ch in m.group(1):
+            col = col * 26 + (ord(ch) - 64)
+        return (int(m.group(2)) - 1 if m.group(2) else None), (col - 1 if m.group(1) else None)
+    start, _, end = a1.partition(":")
+    r0, c0 = part(start)
+    r1, c1 = part(end or start)
+    return r0 or 0, c0 or 0, r1, c1
+
+
+def get_sheet_ranges(sheet_name, ranges, quick=False, timeout_sec=None):
+    """Read several A1 ranges (e.g. ["A2:A", "M2:O"]) of one tab in one batchGet.
+    Returns a list of row-lists aligned with `ranges`, or None if Sheets is unavailable.
+    quick=True: single attempt with `timeout_sec` (scheduler). While the breaker is open the
+    ranges are sliced from the last good full copy of the tab, if there is one.
+    Identical concurrent calls share one request (see "Read coalescing")."""
+    return _coalesced_read((sheet_name, "batchGet", tuple(ranges), quick, timeout_sec),
+                           lambda: _read_sheet_ranges(sheet_name, ranges, quick, timeout_sec))
+
+
+def _read_sheet_ranges(sheet_name, ranges, quick, timeout_sec):
+    spreadsheet_id, tab = _resolve_sheet(sheet_name)
+    full = [f"{tab}!{r}" for r in ranges]
+    desc = f"Sheets batchGet({sheet_name}!{','.join(ranges)})"
+    try:
+        request = lambda: sheets_service.spreadsheets().values().batchGet(
+            spreadsheetId=spreadsheet_id, ranges=full)
+        result = _sheets_exec_with_retry(request, desc, method_class="read",
+                                         max_attempts=1 if quick else None, timeout_sec=timeout_sec)
+        return [vr.get("values", []) for vr in result.get("valueRanges", [])] + [[]] * (len(ranges) - len(result.get("valueRanges", [])))
+    except SheetsCircuitOpen as e:
+        stale = _SHEET_LAST_GOOD.get(sheet_name)
+        log.warning(f"{e}; serving {'stale ranges' if stale is not None else 'nothing'} for {sheet_name}.")
+        if stale is None:
+            return None
+        out = []
+        for r in ranges:
+            r0, c0, r1, c1 = _a1_bounds(r)
+            rows = stale[r0:(r1 + 1) if r1 is not None else None]
+            out.append([list(row[c0:(c1 + 1) if c1 is not None else None]) for row in rows])
+        return out
+    except Exception as e:
+        throttled, retry_after = _http_error_throttle_info(e)
+        if quick and throttled:
+            _rate_note_throttled("sheets", "read", retry_after)
+        log.error(f"Error reading ranges {ranges} from {sheet_name}: {e}", exc_info=True)
         return None
 
+
+def get_sheet_range(sheet_name, a1, **kw):
+    """Single-range form of get_sheet_ranges: rows of `sheet_name!a1`, or None on error."""
+    parts = get_sheet_ranges(sheet_name, [a1], **kw)
+    return parts[0] if parts is not None else None
+
+
+def _degraded_row_lookup(sheet_name, row_id):
+    """A ranged read failed. While the breaker is open, answer from the per-row last-good copies
+    ((None, None) for an id this process has not seen, like a whole-tab copy taken before it was
+    written); with the breaker closed it was a real error -> None."""
+    if _sheets_breaker_state() == "closed":
+        return None
+    hit = _last_good_row(sheet_name, row_id)
+    _hot_log.debug(f"Breaker open; {sheet_name} row {row_id} from last-good copy: {'hit' if hit else 'unknown'}")
+    return hit if hit else (None, None)
+
+
+def _find_row_by_id_ranged(sheet_name, row_id, last_col, idx_cache):
+    """Locate a row by its column-A id with ranged reads.
+    Returns (row, idx_1based), (None, None) if absent, or None if Sheets could not be read
+    (while the breaker is open: the last-good copy of the row, see _degraded_row_lookup)."""
+    def found(row, idx):
+        idx_cache[row_id] = idx
+        _note_sheet_rows(sheet_name, idx)
+        _remember_row_snapshot(sheet_name, idx, row)
+        return row, idx
+
+    # 0) Writes still queued (breaker open, or replay not caught up): Sheets does not show them yet,
+    #    the last-good copy of the row does
+    if _pending_sheet_writes:
+        hit = _last_good_row(sheet_name, row_id) or _queued_append_row(sheet_name, row_id)
+        if hit:
+            idx_cache[row_id] = hit[1]
+            return hit
+
+    # 1) Known row index: read only that row, verify the id (rows can move, e.g. archival)
+    idx = idx_cache.get(row_id)
+    if idx:
+        rows = get_sheet_range(sheet_name, f"A{idx}:{last_col}{idx}")
+        if rows is None:
+            return _degraded_row_lookup(sheet_name, row_id)
+        if rows and rows[0] and rows[0][0] == row_id:
+            return found(rows[0], idx)
+        idx_cache.pop(row_id, None)
+
+    # 2) Recent tail: live transactions were appended lately
+    total = _SHEET_ROW_COUNT.get(sheet_name)
+    if total:
+        start = max(2, total - SHEETS_TAIL_ROWS + 1)
+        rows = get_sheet_range(sheet_name, f"A{start}:{last_col}")
+        if rows is None:
+            return _degraded_row_lookup(sheet_name, row_id)
+        _note_sheet_rows(sheet_name, start + len(rows) - 1)
+        for k, r in enumerate(rows):
+            if r and r[0] == row_id:
+                return found(r, start + k)
+        if start == 2:
+            return None, None  # the tail covered the whole tab
+
+    # 3) Id column, then the single matching row
+    ids = get_sheet_range(sheet_name, "A:A")
+    if ids is None:
+        return _degraded_row_lookup(sheet_name, row_id)
+    _note_sheet_rows(sheet_name, len(ids))
+    for i, r in enumerate(ids):
+        if r and r[0] == row_id:
+            rows = get_sheet_range(sheet_name, f"A{i + 1}:{last_col}{i + 1}")
+            if rows is None:
+                return _degraded_row_lookup(sheet_name, row_id)
+            if rows and rows[0] and rows[0][0] == row_id:
+                return found(rows[0], i + 1)
+            break
+    return None, None
+
+
+def _find_sharded_row(base, row_id, last_col, idx_cache):
+    """_find_row_by_id_ranged over every shard of tab `base`: the shard the id is known to live in
+    first, otherwise all shards in parallel. Remembers the shard (see _txn_sheet).
+    Returns (row, idx_1based), (None, None) if absent, or None if a shard could not be read."""
+    known = _txn_shard.get(row_id)
+    if known is not None:
+        res = _find_row_by_id_ranged(_shard_sheet(base, known), row_id, last_col, idx_cache)
+        if res is None or res[1]:
+            return res
+    sheets = [s for n, s in enumerate(_shard_sheets(base)) if n != known]
+    results = _fan_out(lambda s: _find_row_by_id_ranged(s, row_id, last_col, idx_cache), sheets)
+    for sheet, res in zip(sheets, results):
+        if res and res[1]:
+            _remember_txn_shard(row_id, sheet)
+            return res
+    return None if any(res is None for res in results) else (None, None)
+
+
 # --- Roles helpers: read from sheet + build Quick Reply ---
 def _get_roles_from_sheet():
     """
-    Load role display names from the Roles sheet (with simple in-process cache).
+    Load role display names from the Roles sheet (reference data cache; parsed once per version).
     Prefer column B as display name if present; otherwise use column A.
     Deduplicate and cap to 11 items (Quick Reply limit room for extra buttons).
     """
     try:
-        now = time.time()
-        if _ROLES_CACHE["items"] is not None and (now - _ROLES_CACHE["ts"] <= ROLES_CACHE_TTL_SEC):
-            return _ROLES_CACHE["items"]
-
         rows = get_sheet_data(ROLES_SHEET_NAME) or []
+        version = _REFDATA[ROLES_SHEET_NAME]["version"]
+        if _ROLES_CACHE["items"] is not None and _ROLES_CACHE["version"] == version:
+            return _ROLES_CACHE["items"]
         roles = []
         start_idx = 1 if (rows and len(rows) > 0 and any(rows[0])) else 0  # skip header if present
         for r in rows[start_idx:]:
@@ -418,12 +2342,10 @@ def _get_roles_from_sheet():
                 break
         if not roles:
             roles = ["พนักงาน", "หัวหน้างาน"]  # fallback if sheet empty
-        _ROLES_CACHE["items"] = roles
-        _ROLES_CACHE["ts"] = now
+        _ROLES_CACHE.update(items=roles, version=version)
         return roles
     except Exception as e:
-        print(f"WARNING: _get_roles_from_sheet failed: {e}")
-        traceback.print_exc(); sys.stdout.flush()
+        log.warning(f"_get_roles_from_sheet failed: {e}", exc_info=True)
         # safe fallback
         return ["พนักงาน", "หัวหน้างาน"]
 
@@ -441,50 +2363,123 @@ def _build_role_quick_reply():
 
 def append_sheet_data(sheet_name, values):
     """Appends a row of data to a specified sheet."""
-    print(f"DEBUG: Attempting to append to sheet: {sheet_name} with values: {values}")
-    sys.stdout.flush()
+    _hot_log.debug(f"Attempting to append to sheet: {sheet_name} ({len(values)} cells)")
+    if _writes_backlogged():
+        return _queue_sheet_write("append", sheet_name, "", values)
     try:
         body = {'values': [values]}
+        spreadsheet_id, tab = _resolve_sheet(sheet_name)
         request = lambda: sheets_service.spreadsheets().values().append(
-            spreadsheetId=SPREADSHEET_ID, range=sheet_name,
+            spreadsheetId=spreadsheet_id, range=tab,
             valueInputOption='RAW', body=body)
         result = _sheets_exec_with_retry(request, f"Sheets append({sheet_name})")
-        print(f"DEBUG: Successfully appended to {sheet_name}.")
-        # Bust Employees cache after writes to avoid stale reads during registration/name step
-        if sheet_name == "Employees":
-            _EMP_CACHE["rows"] = None
-            _EMP_CACHE["ts"] = 0.0
-            print("DEBUG: Employees cache invalidated after append.")
-        sys.stdout.flush()
+        _hot_log.debug(f"Successfully appended to {sheet_name}.")
+        # Bust the reference cache after writes to avoid stale reads during registration/name step
+        if sheet_name in _REFDATA:
+            _refdata_invalidate(sheet_name)
+            _hot_log.debug(f"{sheet_name} cache invalidated after append.")
         return result
     except Exception as e:
-        print(f"ERROR: Error appending to sheet {sheet_name}: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
+        if isinstance(e, SheetsCircuitOpen) and not getattr(_drain_ctx, "active", False):
+            return _queue_sheet_write("append", sheet_name, "", values)
+        log.error(f"Error appending to sheet {sheet_name}: {e}", exc_info=True)
+        return None
+
+def _row_index_from_append_result(result):
+    """Parse the 1-based row number from an append response's updates.updatedRange (e.g. 'CheckIns!A15:M15')."""
+    try:
+        updated_range = ((result or {}).get('updates') or {}).get('updatedRange') or ""
+        m = re.search(r"!\$?[A-Z]+\$?(\d+)", updated_range)
+        return int(m.group(1)) if m else None
+    except Exception:
         return None
 
+def append_sheet_row(sheet_name, values):
+    """
+    Append one row and return its 1-based row index taken from the append response,
+    so callers don't need to re-read the whole sheet to find it. Returns None on failure.
+    """
+    result = append_sheet_data(sheet_name, values)
+    if result is None:
+        return None
+    if result.get("queued"):
+        # accepted: the row it should land on when replayed, or a placeholder (see _remap_queued_row)
+        row_idx = result.get("row")
+        _remember_row_snapshot(sheet_name, row_idx, values)
+        return row_idx
+    row_idx = _row_index_from_append_result(result)
+    if row_idx:
+        _remember_row_snapshot(sheet_name, row_idx, values)
+        _note_sheet_rows(sheet_name, row_idx)
+    else:
+        log.warning(f"append to {sheet_name} succeeded but updatedRange was not parseable: {result.get('updates')}")
+    return row_idx
+
 def update_sheet_data(sheet_name, range_name, values):
     """Updates data in a specified range of a sheet."""
-    print(f"DEBUG: Attempting to update sheet: {sheet_name} range: {range_name} with values: {values}")
-    sys.stdout.flush()
+    _hot_log.debug(f"Attempting to update sheet: {sheet_name} range: {range_name} ({len(values)} cells)")
+    if _writes_backlogged():
+        return _queue_sheet_write("update", sheet_name, range_name, values)
+    if _targets_placeholder(range_name):
+        log.error(f"update of {range_name} skipped: its queued append was dropped")
+        return None
     try:
         body = {'values': [values]}
+        spreadsheet_id, api_range = _resolve_range(range_name)
         request = lambda: sheets_service.spreadsheets().values().update(
-            spreadsheetId=SPREADSHEET_ID, range=range_name,
+            spreadsheetId=spreadsheet_id, range=api_range,
             valueInputOption='RAW', body=body)
         result = _sheets_exec_with_retry(request, f"Sheets update({range_name})")
-        print(f"DEBUG: Successfully updated {sheet_name} at {range_name}.")
-        # Bust Employees cache after updates to ensure next read sees fresh data
-        if sheet_name == "Employees":
-            _EMP_CACHE["rows"] = None
-            _EMP_CACHE["ts"] = 0.0
-            print("DEBUG: Employees cache invalidated after update.")
-        sys.stdout.flush()
+        _hot_log.debug(f"Successfully updated {sheet_name} at {range_name}.")
+        _patch_last_good_row(sheet_name, range_name, values)
+        # Bust the reference cache after updates to ensure next read sees fresh data
+        if sheet_name in _REFDATA:
+            _refdata_invalidate(sheet_name)
+            _hot_log.debug(f"{sheet_name} cache invalidated after update.")
+        return result
+    except Exception as e:
+        if isinstance(e, SheetsCircuitOpen) and not getattr(_drain_ctx, "active", False):
+            return _queue_sheet_write("update", sheet_name, range_name, values)
+        log.error(f"Error updating sheet {sheet_name} at {range_name}: {e}", exc_info=True)
+        return None
+
+def batch_update_sheet_data(sheet_name, updates):
+    """
+    Updates several ranges of a sheet in a single values.batchUpdate call.
+    `updates` is a list of (range_name, row_values) tuples.
+    """
+    if not updates:
+        return None
+    _hot_log.debug(f"Attempting batch update on sheet: {sheet_name} ranges: {[r for r, _ in updates]}")
+    if _writes_backlogged():
+        for rng, vals in updates:
+            _queue_sheet_write("update", sheet_name, rng, vals)
+        return {"queued": True}
+    if any(_targets_placeholder(rng) for rng, _ in updates):
+        log.error(f"batch update of {sheet_name} skipped: its queued append was dropped")
+        return None
+    try:
+        spreadsheet_id, _tab = _resolve_sheet(sheet_name)
+        body = {
+            'valueInputOption': 'RAW',
+            'data': [{'range': _resolve_range(rng)[1], 'values': [vals]} for rng, vals in updates],
+        }
+        request = lambda: sheets_service.spreadsheets().values().batchUpdate(
+            spreadsheetId=spreadsheet_id, body=body)
+        result = _sheets_exec_with_retry(request, f"Sheets batchUpdate({sheet_name}, {len(updates)} ranges)")
+        _hot_log.debug(f"Successfully batch-updated {sheet_name} ({len(updates)} ranges).")
+        for rng, vals in updates:
+            _patch_last_good_row(sheet_name, rng, vals)
+        if sheet_name in _REFDATA:
+            _refdata_invalidate(sheet_name)
+            _hot_log.debug(f"{sheet_name} cache invalidated after batch update.")
         return result
     except Exception as e:
-        print(f"ERROR: Error updating sheet {sheet_name} at {range_name}: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
+        if isinstance(e, SheetsCircuitOpen):
+            for rng, vals in updates:
+                _queue_sheet_write("update", sheet_name, rng, vals)
+            return {"queued": True}
+        log.error(f"Error batch-updating sheet {sheet_name}: {e}", exc_info=True)
         return None
 
 # --- Employee State Management ---
@@ -526,8 +2521,7 @@ def update_employee_state(user_id, state, transaction_id=None):
     """Updates the current_state and current_transaction_id for an employee."""
     employee_row, row_num = get_employee_data(user_id)
     if employee_row == "__SHEETS_ERROR__":
-        print("ERROR: update_employee_state skipped due to Sheets read failure.")
-        sys.stdout.flush()
+        log.error("update_employee_state skipped due to Sheets read failure.")
         return None
     if employee_row:
         employee_row[EMPLOYEE_CURRENT_STATE_COL] = state
@@ -564,13 +2558,14 @@ def upsert_employee(user_id: str, name: str = "", role: str = "พนักง
                 return i + 1
         # ไม่พบแถวเดิม → สร้างใหม่
         new_row = [user_id, name or "", role or "พนักงาน", state, transaction_id or ""]
-        append_sheet_data("Employees", new_row)
-        # ยืนยันเลขแถว
+        idx = append_sheet_row("Employees", new_row)
+        if idx:
+            return idx
+        # เลขแถวไม่ได้มาจาก append response → ยืนยันด้วยการอ่านชีต
         row, idx = get_employee_data(user_id)
         return idx
     except Exception as e:
-        print(f"ERROR: upsert_employee failed: {e}")
-        traceback.print_exc(); sys.stdout.flush()
+        log.error(f"upsert_employee failed: {e}", exc_info=True)
         return None
 
 
@@ -597,6 +2592,10 @@ def load_locations(sheet_name=None):
     """
     sheet = sheet_name or LOCATIONS_SHEET_NAME
     rows = get_sheet_data(sheet)
+    version = _REFDATA[sheet]["version"] if sheet in _REFDATA else None
+    if (version is not None and _LOCATIONS_CACHE["items"] is not None and _LOCATIONS_CACHE["sheet"] == sheet
+            and _LOCATIONS_CACHE["version"] == version):
+        return _LOCATIONS_CACHE["items"]
     locs = []
     if not rows or len(rows) < 2:
         return locs
@@ -624,6 +2623,7 @@ def load_locations(sheet_name=None):
                 })
         except Exception:
             continue
+    _LOCATIONS_CACHE.update({"items": locs, "version": version, "sheet": sheet})
     return locs
 
 def match_site_by_location(lat, lon, policy=None):
@@ -692,7 +2692,7 @@ def match_site_by_location_for_submission(lat, lon, policy=None):
 
 # --- LIFF Meta Parsing Helpers ---
 def _parse_meta_from_address(addr_text: str):
-    """Expect: 'Lat:<lat>, Lon:<lon> (txn=<uuid>|acc=<num>|ts=<ms>)' -> dict"""
+    """Expect: 'Lat:<lat>, Lon:<lon> (txn=<txn>|acc=<num>|ts=<ms>)' -> dict"""
     if not addr_text:
         return {}
     try:
@@ -718,6 +2718,78 @@ def _is_recent_ts_ms(ts_ms: str, max_age_sec: int) -> bool:
     except Exception:
         return False
 
+# --- Signed transaction ids (txn) ---
+# handle_message issues txn = "<flow>-<exp>-<nonce>-<sig>" instead of a bare uuid4:
+#   flow  c = check-in, s = submission
+#   exp   unix seconds, 8 hex (TXN_TOKEN_TTL_SEC after issue)
+#   sig   HMAC-SHA256 over flow-exp-nonce and the LINE user_id, truncated to 80 bits (20 hex)
+# 40 chars, so it still fits the Employees / CheckIns / Submissions id columns and the LIFF address
+# meta (a LINE location address is at most 100 chars). The user_id is bound by the signature rather
+# than spelled out. A location carrying a forged, expired or someone else's txn is refused by
+# _check_txn in microseconds, before any Sheets read; a valid one is still compared with the
+# Employees row (the signature proves who and which flow, the sheet decides whether it is current).
+# The LIFF POST token (/liff/location) is "<txn>.<user_id>": the txn signature already covers the user.
+# uuid txns issued before a deploy are let through to the sheet check for one TTL, then refused too.
+TXN_TOKEN_SECRET = (os.getenv('TXN_TOKEN_SECRET', '').strip().encode()
+                    or hmac.new((LINE_CHANNEL_SECRET or "").encode(), b"txn-token", hashlib.sha256).digest())
+TXN_TOKEN_TTL_SEC = int(os.getenv('TXN_TOKEN_TTL_SEC', '900'))
+TXN_FLOWS = {"c": "checkin", "s": "submission"}
+
+_TXN_RE = re.compile(r"([cs])-([0-9a-f]{8})-([0-9a-f]{8})-([0-9a-f]{20})")
+_TXN_UUID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+_TXN_LEGACY_UNTIL = time.time() + TXN_TOKEN_TTL_SEC
+_TXN_STATS = {"issued": 0, "valid": 0, "legacy": 0, "malformed": 0, "bad_signature": 0, "expired": 0}
+_txn_stats_lock = threading.Lock()
+
+
+def _txn_sig(body: str, user_id: str) -> str:
+    return hmac.new(TXN_TOKEN_SECRET, f"{body}|{user_id}".encode(), hashlib.sha256).hexdigest()[:20]
+
+
+def _new_txn(user_id: str, flow: str, ttl_sec: int = None) -> str:
+    """Signed transaction id for `flow` ("checkin" / "submission") of user_id."""
+    code = next(c for c, f in TXN_FLOWS.items() if f == flow)
+    exp = int(time.time()) + (TXN_TOKEN_TTL_SEC if ttl_sec is None else ttl_sec)
+    body = f"{code}-{exp:08x}-{os.urandom(4).hex()}"
+    with _txn_stats_lock:
+        _TXN_STATS["issued"] += 1
+    return f"{body}-{_txn_sig(body, user_id)}"
+
+
+def _check_txn(txn: str, user_id: str):
+    """
+    (flow, "valid") for a txn we issued to this user and that has not expired; (None, "legacy") for a
+    pre-deploy uuid inside the grace window; otherwise (None, reason) and the caller refuses it. No I/O.
+    """
+    txn = txn or ""
+    m = _TXN_RE.fullmatch(txn)
+    if m is None:
+        reason = "legacy" if _TXN_UUID_RE.fullmatch(txn) and time.time() < _TXN_LEGACY_UNTIL else "malformed"
+    elif not hmac.compare_digest(m.group(4), _txn_sig(txn[:-21], user_id or "")):
+        reason = "bad_signature"
+    elif int(m.group(2), 16) < time.time():
+        reason = "expired"
+    else:
+        reason = "valid"
+    with _txn_stats_lock:
+        _TXN_STATS[reason] += 1
+    return (TXN_FLOWS[m.group(1)] if reason == "valid" else None), reason
+
+
+def _txn_link_token(txn: str, user_id: str) -> str:
+    return f"{txn}.{user_id}"
+
+
+def _verify_txn_token(token: str):
+    """(txn, user_id, flow) for a valid LIFF POST token, else None. No I/O.
+    Unlike the chat path there is no legacy grace: here the signature is the only proof of user_id."""
+    txn, _, user_id = (token or "").partition(".")
+    flow, reason = _check_txn(txn, user_id)
+    if reason != "valid":
+        return None
+    return txn, user_id, flow
+
+
 # --- LINE Push Helper ---
 def push_text(user_id: str, text: str):
     try:
@@ -728,68 +2800,321 @@ def push_text(user_id: str, text: str):
             )
         )
     except Exception as e:
-        print(f"WARNING: push_text failed: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
+        log.warning(f"push_text failed: {e}", exc_info=True)
 def _reply_or_push_messages(event, user_id, messages):
     """
     พยายาม reply ก่อน ถ้าเจอ 400 Invalid reply token ให้ fallback เป็น push เพื่อให้ผู้ใช้ได้รับข้อความแน่ ๆ
     `messages` คือ list ของ message object (เช่น V3TextMessage, etc.)
     """
-    try:
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=messages
-            )
-        )
-    except ApiException as e:
+    with _span("reply") as span:
         try:
-            # LINE มักคืน 400 {"message":"Invalid reply token"} เมื่อ reply เกิน ~1 นาทีหลัง event
-            if getattr(e, "status", None) == 400:
-                print("WARNING: reply failed with 400 (invalid token); fallback to push_message()")
-                sys.stdout.flush()
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=messages
-                    )
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=messages
                 )
-            else:
-                raise
-        except Exception as e2:
-            print(f"ERROR: _reply_or_push_messages fallback failed: {e2}")
-            traceback.print_exc()
-            sys.stdout.flush()
+            )
+        except ApiException as e:
+            try:
+                # LINE มักคืน 400 {"message":"Invalid reply token"} เมื่อ reply เกิน ~1 นาทีหลัง event
+                # (5xx ไม่ fallback: reply อาจส่งถึงแล้ว push ซ้ำจะเสียโควตาและผู้ใช้ได้ข้อความซ้ำ)
+                if getattr(e, "status", None) == 400:
+                    log.warning("reply failed with 400 (invalid token); fallback to push_message()")
+                    span["outcome"] = "push_fallback"
+                    line_bot_api.push_message(
+                        PushMessageRequest(
+                            to=user_id,
+                            messages=messages
+                        )
+                    )
+                else:
+                    raise
+            except Exception as e2:
+                span["outcome"] = "error"
+                log.error(f"_reply_or_push_messages fallback failed: {e2}", exc_info=True)
+        except Exception as e:
+            span["outcome"] = "error"
+            log.error(f"_reply_or_push_messages unexpected error: {e}", exc_info=True)
+
+# --- Messaging cost: reply tokens, pending notices, push quota ---
+# Replies are free, pushes count against the channel's monthly quota. To push less:
+#   - every webhook event's reply token is remembered per user (_note_reply_token). Once its event
+#     has been handled without using it, a notice for that user (_send_notice) is sent as a reply
+#     while it is younger than REPLY_TOKEN_MAX_AGE_SEC.
+#   - informational notices (not urgent, e.g. "your check-in was closed") are kept as pending and
+#     prepended to the user's next reply (any reply_message through _LineClient; LINE allows 5
+#     messages per reply). Urgent ones (timeout warnings) are pushed unless the quota is used up.
+#   - quota and usage come from LINE's quota endpoints every PUSH_QUOTA_REFRESH_SEC (scheduler job),
+#     plus pushes counted locally since; below PUSH_QUOTA_RESERVE informational notices always wait.
+# Counts and the push-vs-reply ratio: /admin/messaging and /metrics.
+REPLY_TOKEN_MAX_AGE_SEC = float(os.getenv('REPLY_TOKEN_MAX_AGE_SEC', '50'))
+NOTICE_DEFER_INFO = os.getenv('NOTICE_DEFER_INFO', '1') == '1'
+PENDING_NOTICE_MAX_PER_USER = int(os.getenv('PENDING_NOTICE_MAX_PER_USER', '4'))
+PENDING_NOTICE_MAX_AGE_SEC = float(os.getenv('PENDING_NOTICE_MAX_AGE_SEC', str(3 * 86400)))
+PUSH_QUOTA_REFRESH_SEC = int(os.getenv('PUSH_QUOTA_REFRESH_SEC', '600'))
+PUSH_QUOTA_RESERVE = int(os.getenv('PUSH_QUOTA_RESERVE', '50'))  # pushes kept for urgent notices
+_msg_lock = threading.Lock()
+_msg_ctx = threading.local()  # reply tokens noted by the event being handled in this thread
+_REPLY_TOKENS = {}        # user_id -> {"token": str, "ts": float, "busy": bool}
+_REPLY_TOKEN_USER = {}    # reply token -> user_id (tokens still in _REPLY_TOKENS)
+_PENDING_NOTICES = {}     # user_id -> [(text, ts)]
+_PUSH_QUOTA = {"type": None, "limit": None, "used": None, "checked": None, "pushed_since_check": 0, "error": None}
+_MESSAGING_STATS = {"reply": 0, "reply_uncertain": 0, "push": 0, "push_recipients": 0,
+                    "notices_replied": 0, "notices_pushed": 0, "notices_deferred": 0, "notices_delivered_late": 0, "notices_dropped": 0,
+                    "notices_expired": 0}
+
+
+def _note_reply_token(user_id, reply_token):
+    """Remember the reply token of the event now being handled (usable by notices once released)."""
+    if not user_id or not reply_token:
+        return
+    with _msg_lock:
+        old = _REPLY_TOKENS.get(user_id)
+        if old:
+            _REPLY_TOKEN_USER.pop(old["token"], None)
+        _REPLY_TOKENS[user_id] = {"token": reply_token, "ts": time.time(), "busy": True}
+        _REPLY_TOKEN_USER[reply_token] = user_id
+    if not hasattr(_msg_ctx, "tokens"):
+        _msg_ctx.tokens = []
+    _msg_ctx.tokens.append((user_id, reply_token))
+
+
+def _release_reply_tokens():
+    """The webhook's events are handled: their unused reply tokens may now serve notices."""
+    tokens, _msg_ctx.tokens = getattr(_msg_ctx, "tokens", []), []
+    with _msg_lock:
+        for user_id, reply_token in tokens:
+            ent = _REPLY_TOKENS.get(user_id)
+            if ent and ent["token"] == reply_token:
+                ent["busy"] = False
+
+
+def _take_reply_token(user_id):
+    with _msg_lock:
+        ent = _REPLY_TOKENS.get(user_id)
+        if not ent or ent["busy"]:
+            return None
+        del _REPLY_TOKENS[user_id]
+        if time.time() - ent["ts"] > REPLY_TOKEN_MAX_AGE_SEC:
+            _REPLY_TOKEN_USER.pop(ent["token"], None)
+            return None
+        return ent["token"]  # token -> user stays until the reply, so pending notices ride along
+
+
+def _queue_notice(user_id, text):
+    with _msg_lock:
+        queue_ = _PENDING_NOTICES.setdefault(user_id, [])
+        queue_.append((text, time.time()))
+        if len(queue_) > PENDING_NOTICE_MAX_PER_USER:
+            del queue_[0]
+            _MESSAGING_STATS["notices_dropped"] += 1
+        _MESSAGING_STATS["notices_deferred"] += 1
+
+
+def _attach_pending_notices(req):
+    """reply_message hook: prepend the user's pending notices. Returns (request, attached notices)."""
+    now = time.time()
+    with _msg_lock:
+        user_id = _REPLY_TOKEN_USER.get(getattr(req, "reply_token", None))
+        pending = _PENDING_NOTICES.get(user_id) if user_id else None
+        if not pending:
+            return req, []
+        fresh = [(t, ts) for t, ts in pending if now - ts <= PENDING_NOTICE_MAX_AGE_SEC]
+        _MESSAGING_STATS["notices_expired"] += len(pending) - len(fresh)
+        room = max(0, 5 - len(req.messages or []))
+        attached, rest = fresh[:room], fresh[room:]
+        if rest:
+            _PENDING_NOTICES[user_id] = rest
+        else:
+            _PENDING_NOTICES.pop(user_id, None)
+    if not attached:
+        return req, []
+    messages = [V3TextMessage(text=t) for t, _ts in attached] + list(req.messages or [])
+    return ReplyMessageRequest(reply_token=req.reply_token, messages=messages,
+                               notification_disabled=req.notification_disabled), attached
+
+
+def _messaging_note(name, req, ok, attached, uncertain=False):
+    """_LineClient hook after a send: count it, consume the reply token, requeue undelivered notices
+    (not after an uncertain reply: they may have gone out with it)."""
+    with _msg_lock:
+        if name == "reply_message":
+            user_id = _REPLY_TOKEN_USER.pop(getattr(req, "reply_token", None), None)
+            if user_id and _REPLY_TOKENS.get(user_id, {}).get("token") == req.reply_token:
+                del _REPLY_TOKENS[user_id]
+            if ok:
+                _MESSAGING_STATS["reply"] += 1
+                _MESSAGING_STATS["notices_delivered_late"] += len(attached)
+            elif uncertain:
+                _MESSAGING_STATS["reply_uncertain"] += 1
+            elif attached and user_id:
+                _PENDING_NOTICES[user_id] = attached + _PENDING_NOTICES.get(user_id, [])
+        elif ok and name in ("push_message", "multicast"):
+            recipients = 1 if name == "push_message" else len(getattr(req, "to", None) or [])
+            _MESSAGING_STATS["push"] += 1
+            _MESSAGING_STATS["push_recipients"] += recipients
+            _PUSH_QUOTA["pushed_since_check"] += recipients
+
+
+def _push_quota_remaining():
+    """Pushes left this month by our count, or None when unlimited / not known yet."""
+    with _msg_lock:
+        if _PUSH_QUOTA["limit"] is None or _PUSH_QUOTA["used"] is None:
+            return None
+        return _PUSH_QUOTA["limit"] - _PUSH_QUOTA["used"] - _PUSH_QUOTA["pushed_since_check"]
+
+
+def _refresh_push_quota():
+    """Read the monthly limit and this month's usage from LINE (scheduler job)."""
+    try:
+        with _api_priority("background"):
+            quota = line_bot_api.get_message_quota()
+            usage = line_bot_api.get_message_quota_consumption()
+        with _msg_lock:
+            _PUSH_QUOTA.update(type=str(getattr(quota, "type", "") or ""),
+                               limit=getattr(quota, "value", None) if str(getattr(quota, "type", "")) == "limited" else None,
+                               used=getattr(usage, "total_usage", None), pushed_since_check=0,
+                               checked=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), error=None)
+        remaining = _push_quota_remaining()
+        if remaining is not None and remaining <= PUSH_QUOTA_RESERVE:
+            log.warning(f"LINE push quota low: {remaining} left of {_PUSH_QUOTA['limit']}")
     except Exception as e:
-        print(f"ERROR: _reply_or_push_messages unexpected error: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
+        _PUSH_QUOTA["error"] = str(e) or type(e).__name__
+        log.warning(f"LINE push quota refresh failed: {e}")
+
+
+def _messaging_snapshot():
+    with _msg_lock:
+        stats = dict(_MESSAGING_STATS)
+        quota = dict(_PUSH_QUOTA)
+        pending = sum(len(v) for v in _PENDING_NOTICES.values())
+        tokens = sum(1 for v in _REPLY_TOKENS.values() if not v["busy"])
+    sent = stats["reply"] + stats["push_recipients"]
+    stats["push_ratio"] = round(stats["push_recipients"] / sent, 3) if sent else None
+    quota["remaining"] = _push_quota_remaining()
+    with _latency_lock:
+        series = [(k, sorted(v["recent"]), v["count"]) for k, v in _NOTICE_LATENCY.items()]
+    delivery = {f"{route}/{outcome}": {"count": count, **{f"p{int(q * 100)}_ms": round(_quantile(recent, q) * 1000, 1)
+                                                          for q in LATENCY_QUANTILES}}
+                for (route, _flow, outcome), recent, count in sorted(series)}
+    return {"stats": stats, "quota": quota, "pending_notices": pending, "pending_users": len(_PENDING_NOTICES),
+            "reusable_reply_tokens": tokens, "defer_info": NOTICE_DEFER_INFO, "quota_reserve": PUSH_QUOTA_RESERVE,
+            "delivery_latency": delivery, "multicast_max": NOTIFY_MULTICAST_MAX, "max_parallel": NOTIFY_MAX_PARALLEL}
+
+# --- Notice dispatcher (batched push / multicast) ---
+# _dispatch_notices delivers many notices at once (a scheduler run): each notice is first routed
+# as in _send_notice (stored reply token, deferred, dropped); the ones left to push are grouped by
+# identical text into multicast calls of up to NOTIFY_MULTICAST_MAX recipients (single recipients
+# use push_message), and groups go out on NOTIFY_MAX_PARALLEL concurrent senders. Time from a
+# notice being raised to LINE accepting it is recorded per route (/admin/messaging, /metrics).
+NOTIFY_MULTICAST_MAX = max(1, min(500, int(os.getenv('NOTIFY_MULTICAST_MAX', '500'))))  # LINE caps multicast at 500
+NOTIFY_MAX_PARALLEL = max(1, int(os.getenv('NOTIFY_MAX_PARALLEL', '4')))
+_NOTICE_LATENCY = {}  # (route, "notice", outcome) -> histogram series, see _observe_latency
+
+
+def _notice_route(user_id, text, urgent):
+    """Reply with a stored token, defer or drop; returns that route, or 'push' if it still has to be pushed."""
+    token = _take_reply_token(user_id)
+    if token:
+        try:
+            line_bot_api.reply_message(ReplyMessageRequest(reply_token=token, messages=[V3TextMessage(text=text)]))
+            with _msg_lock:
+                _MESSAGING_STATS["notices_replied"] += 1
+            return "reply"
+        except Exception as e:
+            log.debug(f"notice reply with a stored token failed ({e}); falling back")
+    remaining = _push_quota_remaining()
+    if not urgent and (NOTICE_DEFER_INFO or (remaining is not None and remaining <= PUSH_QUOTA_RESERVE)):
+        _queue_notice(user_id, text)
+        return "deferred"
+    if remaining is not None and remaining <= 0:
+        with _msg_lock:
+            _MESSAGING_STATS["notices_dropped"] += 1
+        log.warning("LINE push quota used up; urgent notice not sent")
+        return "dropped"
+    return "push"
+
+
+def _push_notice_group(text, members):
+    """One push (single recipient) or multicast for [(user_id, raised_at)] sharing `text`."""
+    users = [u for u, _ts in members]
+    route = "push" if len(users) == 1 else "multicast"
+    outcome = "ok"
+    try:
+        if route == "push":
+            line_bot_api.push_message(PushMessageRequest(to=users[0], messages=[V3TextMessage(text=text)]))
+        else:
+            line_bot_api.multicast(MulticastRequest(to=users, messages=[V3TextMessage(text=text)]))
+        with _msg_lock:
+            _MESSAGING_STATS["notices_pushed"] += len(users)
+    except Exception as e:
+        outcome = "error"
+        log.warning(f"notice {route} to {len(users)} user(s) failed: {e}", exc_info=True)
+    now = time.time()
+    for _u, ts in members:
+        _observe_latency(route, "notice", outcome, now - ts, store=_NOTICE_LATENCY)
+    return outcome
+
+
+def _dispatch_notices(notices):
+    """Deliver [(user_id, text, urgent, raised_at)]; returns the route taken by each notice."""
+    routes = []
+    groups = {}  # text -> {user_id: raised_at}
+    for user_id, text, urgent, raised_at in notices:
+        route = _notice_route(user_id, text, urgent)
+        if route == "push":
+            groups.setdefault(text, {}).setdefault(user_id, raised_at)
+            route = "push" if len(notices) == 1 else "batched"
+        elif route == "reply":
+            _observe_latency("reply", "notice", "ok", time.time() - raised_at, store=_NOTICE_LATENCY)
+        routes.append(route)
+    jobs = []
+    for text, members in groups.items():
+        members = list(members.items())
+        jobs += [(text, members[i:i + NOTIFY_MULTICAST_MAX]) for i in range(0, len(members), NOTIFY_MULTICAST_MAX)]
+    if jobs:
+        jobs_lock = threading.Lock()
+
+        def sender(_n):
+            while True:
+                with jobs_lock:
+                    if not jobs:
+                        return
+                    text, members = jobs.pop(0)
+                _push_notice_group(text, members)
+        t0 = time.time()
+        n_jobs = len(jobs)
+        _fan_out(sender, list(range(min(NOTIFY_MAX_PARALLEL, n_jobs))))
+        _hot_log.debug(f"Dispatched {sum(len(m) for m in groups.values())} notice push(es) in {n_jobs} call(s) "
+                       f"({time.time() - t0:.2f}s)")
+    return routes
+
+
+def _send_notice(user_id, text, urgent=False):
+    """Tell a user something outside of a reply. Returns 'reply', 'push', 'deferred' or 'dropped'."""
+    return _dispatch_notices([(user_id, text, urgent, time.time())])[0]
 
 # --- CheckIns Helpers (row locate / timeout / finalize) ---
 
 def _find_checkins_row_by_id(checkin_id):
-    """Return (row_values, row_index_1_based) for given checkin_id in CheckIns sheet; or (None, None)"""
-    rows = get_sheet_data("CheckIns")
-    for i, r in enumerate(rows):
-        if r and len(r) > 0 and r[0] == checkin_id:
-            return r, i + 1
-    return None, None
+    """Return (row_values, row_index_1_based) for given checkin_id in CheckIns sheet; or (None, None).
+    Reads A..M of the cached row / recent tail / id column only, in the shard holding the id
+    (see _find_sharded_row); write back through _txn_sheet("CheckIns", checkin_id)."""
+    res = _find_sharded_row("CheckIns", checkin_id, "M", _checkins_row_index_cache)
+    if res is None:
+        raise RuntimeError(f"Sheets read failed while locating CheckIns row for {checkin_id}")
+    return res
 
 # --- Submissions helpers (row locate / upsert / finalize) ---
 def _find_submissions_row_by_id(submit_id):
-    rows = get_sheet_data(SUBMISSIONS_SHEET_NAME)
-    if not rows:
-        return None, None
-    for i, r in enumerate(rows):
-        if r and len(r) > 0 and r[0] == submit_id:
-            return r, i + 1
-    return None, None
+    res = _find_sharded_row(SUBMISSIONS_SHEET_NAME, submit_id, "S", _submissions_row_index_cache)
+    return res if res is not None else (None, None)
 
 def upsert_submission_row_idempotent(submit_id: str, user_id: str,
                                      location_name: str, site_group: str,
                                      distance_m, employee_name: str = ""):
     existing_row, existing_idx = _find_submissions_row_by_id(submit_id)
+    sheet = _txn_sheet(SUBMISSIONS_SHEET_NAME, submit_id, user_id, site_group)
     if existing_idx:
         _ensure_row_len(existing_row, 19)  # up to S
         ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -800,7 +3125,7 @@ def upsert_submission_row_idempotent(submit_id: str, user_id: str,
         if len(existing_row) > 11:
             existing_row[11] = distance_m  # distance_m (L)
         existing_row[18] = employee_name or (existing_row[18] if len(existing_row) > 18 else "")  # S: employee_name
-        _update_row_dynamic(SUBMISSIONS_SHEET_NAME, existing_idx, existing_row)
+        _update_row_dynamic(sheet, existing_idx, existing_row)
         return existing_idx
     ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     base_row = [
@@ -814,34 +3139,38 @@ def upsert_submission_row_idempotent(submit_id: str, user_id: str,
     base_row += ["", "", "", "", "", ""]  # M..R (6 empty cells)
     # Finally, add S = employee_name
     new_row = base_row + [employee_name or ""]
-    try:
-        append_sheet_data(SUBMISSIONS_SHEET_NAME, new_row)
-    except Exception as e:
-        print(f"WARNING: append Submissions failed once: {e}")
-        traceback.print_exc(); sys.stdout.flush()
-        chk_row, chk_idx = _find_submissions_row_by_id(submit_id)
-        if chk_idx:
-            return chk_idx
-        append_sheet_data(SUBMISSIONS_SHEET_NAME, new_row)
+    _remember_txn_shard(submit_id, sheet)
+    new_idx = append_sheet_row(sheet, new_row)
+    if new_idx:
+        _submissions_row_index_cache[submit_id] = new_idx
+        return new_idx
+    log.warning("append Submissions failed once (or returned no row index)")
+    chk_row, chk_idx = _find_submissions_row_by_id(submit_id)
+    if chk_idx:
+        return chk_idx
+    new_idx = append_sheet_row(sheet, new_row)
+    if new_idx:
+        return new_idx
     final_row, final_idx = _find_submissions_row_by_id(submit_id)
     return final_idx
 
 def _finalize_submission(user_id, submit_id, status_text):
     try:
-        row, idx = _find_submissions_row_by_id(submit_id)
-        if row and idx:
-            _ensure_row_len(row, 12)
-            row[8] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            row[9] = status_text
-            _update_row_dynamic(SUBMISSIONS_SHEET_NAME, idx, row)
+        # Same per-transaction lock as the J: status write in _write_image_cells
+        with _txn_locks[submit_id]:
+            _mark_image_slots_closed(submit_id)
+            row, idx = _find_submissions_row_by_id(submit_id)
+            if row and idx:
+                _ensure_row_len(row, 12)
+                row[8] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                row[9] = status_text
+                _update_row_dynamic(_txn_sheet(SUBMISSIONS_SHEET_NAME, submit_id), idx, row)
     except Exception as e:
-        print(f"WARNING: finalize submission failed: {e}")
-        traceback.print_exc(); sys.stdout.flush()
+        log.warning(f"finalize submission failed: {e}", exc_info=True)
     try:
         update_employee_state(user_id, "idle", "")
     except Exception as e:
-        print(f"WARNING: finalize submission set idle failed: {e}")
-        traceback.print_exc(); sys.stdout.flush()
+        log.warning(f"finalize submission set idle failed: {e}", exc_info=True)
 
 # --- New idempotent upsert for CheckIns ---
 def upsert_checkin_row_idempotent(checkin_id: str, user_id: str,
@@ -856,6 +3185,7 @@ def upsert_checkin_row_idempotent(checkin_id: str, user_id: str,
     """
     # 1) มีอยู่แล้วหรือยัง
     existing_row, existing_idx = _find_checkins_row_by_id(checkin_id)
+    sheet = _txn_sheet("CheckIns", checkin_id, user_id, site_group)  # shard of the existing row, or where a new one goes
     if existing_idx:
         _ensure_row_len(existing_row, 13)    # up to M
         ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -866,7 +3196,7 @@ def upsert_checkin_row_idempotent(checkin_id: str, user_id: str,
         if len(existing_row) > 11:
             existing_row[11] = distance_m    # distance_m (L)
         existing_row[12] = employee_name or (existing_row[12] if len(existing_row) > 12 else "")  # employee_name (M)
-        _update_row_dynamic("CheckIns", existing_idx, existing_row)
+        _update_row_dynamic(sheet, existing_idx, existing_row)
         # remember row index for fast finalize even if read fails later
         _checkins_row_index_cache[checkin_id] = existing_idx
         return existing_idx
@@ -889,20 +3219,23 @@ def upsert_checkin_row_idempotent(checkin_id: str, user_id: str,
     _ensure_row_len(new_row, 12)  # up to L
     new_row.append(employee_name or "")  # M: employee_name
 
-    try:
-        append_sheet_data("CheckIns", new_row)
-    except Exception as e:
-        print(f"WARNING: append CheckIns failed once: {e}")
-        traceback.print_exc(); sys.stdout.flush()
+    # เลขแถวมาจาก updates.updatedRange ของ append response (ไม่ต้องอ่านชีตซ้ำ)
+    _remember_txn_shard(checkin_id, sheet)
+    new_idx = append_sheet_row(sheet, new_row)
+    if not new_idx:
+        log.warning("append CheckIns failed once (or returned no row index)")
         # ตรวจซ้ำว่าเขียนไปแล้วหรือยัง
         chk_row, chk_idx = _find_checkins_row_by_id(checkin_id)
         if chk_idx:
+            _checkins_row_index_cache[checkin_id] = chk_idx
             return chk_idx
         # ยังไม่เจอจริง ๆ → ลองครั้งสุดท้าย
-        append_sheet_data("CheckIns", new_row)
+        new_idx = append_sheet_row(sheet, new_row)
 
-    # 3) หา index ที่แท้จริงหลัง append สำเร็จ
-    final_row, final_idx = _find_checkins_row_by_id(checkin_id)
+    # 3) ถ้ายังไม่ได้เลขแถวจาก response ให้หา index ที่แท้จริงจากชีต
+    final_idx = new_idx
+    if not final_idx:
+        final_row, final_idx = _find_checkins_row_by_id(checkin_id)
     if final_idx:
         _checkins_row_index_cache[checkin_id] = final_idx
     return final_idx
@@ -925,75 +3258,145 @@ def _first_empty_image_slot_index(row, start_col=5, end_col=7):
             return j
     return None
 
+# --- Image slot allocator (F..H) ---
+# Concurrent images of the same transaction reserve their slot here instead of
+# serializing a full read-modify-write of the row on _txn_locks[txn_id].
+IMAGE_SLOT_STATE_TTL_SEC = float(os.getenv('IMAGE_SLOT_STATE_TTL_SEC', '3600'))
+_image_slot_lock = threading.Lock()
+_image_slot_state = {}  # txn_id -> {"reserved": set, "filled": set, "closed": bool, "ts": float}
+
+def _image_slot_entry(txn_id):
+    """Return (and create if missing) the slot state for txn_id. Caller must hold _image_slot_lock."""
+    st = _image_slot_state.get(txn_id)
+    if st is None:
+        st = {"reserved": set(), "filled": set(), "closed": False, "ts": time.time()}
+        _image_slot_state[txn_id] = st
+    return st
+
+def _reserve_image_slot(txn_id, row, start_col=5, end_col=7):
+    """
+    Atomically reserve the first free image column (0-based 5..7 = F..H) for txn_id.
+    A slot is free when it is empty in `row` (last read from Sheets) and not already
+    reserved or written by another image of the same transaction.
+    Returns the 0-based column index, or None if all slots are taken.
+    """
+    now = time.time()
+    with _image_slot_lock:
+        for k in [k for k, v in _image_slot_state.items() if now - v["ts"] > IMAGE_SLOT_STATE_TTL_SEC]:
+            del _image_slot_state[k]
+        st = _image_slot_entry(txn_id)
+        st["ts"] = now
+        for j in range(start_col, end_col + 1):
+            if j < len(row) and row[j]:
+                st["filled"].add(j)
+        for j in range(start_col, end_col + 1):
+            if j not in st["filled"] and j not in st["reserved"]:
+                st["reserved"].add(j)
+                return j
+        return None
+
+def _commit_image_slot(txn_id, slot, ok=True):
+    """Finish a reservation: mark the slot filled on success, or free it on failure. Returns filled count."""
+    with _image_slot_lock:
+        st = _image_slot_entry(txn_id)
+        st["reserved"].discard(slot)
+        if ok:
+            st["filled"].add(slot)
+        st["ts"] = time.time()
+        return len(st["filled"])
+
+def _mark_image_slots_closed(txn_id):
+    """Record that txn_id reached a terminal status so late images no longer touch J: status."""
+    with _image_slot_lock:
+        st = _image_slot_entry(txn_id)
+        st["closed"] = True
+        st["ts"] = time.time()
+
+def _image_slots_closed(txn_id) -> bool:
+    with _image_slot_lock:
+        st = _image_slot_state.get(txn_id)
+        return bool(st and st["closed"])
+
+def _write_image_cells(sheet_name, txn_id, idx, row, cells):
+    """
+    Write image-related single cells plus I: last_updated_at (and J: status when it must change).
+    `cells` is a list of (0-based col, value). Only J needs the per-transaction lock, because
+    finalize also writes J; the slot cells themselves are owned by their reservation.
+    """
+    now_ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    updates = [(f"{sheet_name}!{_col_letter(c + 1)}{idx}", [v]) for c, v in cells]
+    updates.append((f"{sheet_name}!I{idx}", [now_ts]))
+    curr_status = (row[9].strip().lower() if len(row) > 9 and row[9] else "")
+    if curr_status in ("in_progress", "done", "timeout", "cancelled"):
+        return batch_update_sheet_data(sheet_name, updates)
+    with _txn_locks[txn_id]:
+        if not _image_slots_closed(txn_id):
+            updates.append((f"{sheet_name}!J{idx}", ["in_progress"]))
+        return batch_update_sheet_data(sheet_name, updates)
+
 def _update_checkins_add_image_url(checkin_id: str, image_url: str):
     """
-    Idempotently ใส่ image_url ลงช่องรูปว่างช่องแรก (F..H) ของแถว CheckIns ของ checkin_id
+    Idempotently ใส่ image_url ลงช่องรูปว่าง (F..H) ของแถว CheckIns ของ checkin_id
     และอัปเดต I: last_updated_at, J: status='in_progress' โดยไม่ append แถวใหม่
+    จองช่องผ่าน _reserve_image_slot แล้วเขียนเฉพาะเซลล์ของช่องนั้น (ไม่เขียนทับทั้งแถว)
     """
-    lock = _txn_locks[checkin_id]
-    with lock:
+    with _span("sheets_find"):
         row, idx = _find_checkins_row_by_id(checkin_id)
-        if not idx:
-            # หากยังไม่มีแถว (กรณี edge) ให้ upsert ก่อน
-            upsert_checkin_row_idempotent(checkin_id, "", "", "", 0, "")
+    if not idx:
+        # หากยังไม่มีแถว (กรณี edge) ให้ upsert ก่อน — serialize เฉพาะการสร้างแถว
+        with _txn_locks[checkin_id]:
             row, idx = _find_checkins_row_by_id(checkin_id)
+            if not idx:
+                upsert_checkin_row_idempotent(checkin_id, "", "", "", 0, "")
+                row, idx = _find_checkins_row_by_id(checkin_id)
             if not idx:
                 raise RuntimeError(f"Cannot locate CheckIns row for {checkin_id}")
 
-        # cache row index for this checkin to support finalize without a fresh read
-        _checkins_row_index_cache[checkin_id] = idx
-
-        _ensure_row_len(row, 12)  # A..L
-        slot = _first_empty_image_slot_index(row, 5, 7)
-        if slot is None:
-            # ครบ 3 ช่องแล้ว แค่รีเฟรชเวลา/สถานะ
-            row[8] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # I
-            row[9] = row[9] or "in_progress"                       # J
-            _update_row_dynamic("CheckIns", idx, row)
-            _checkins_row_index_cache[checkin_id] = idx
-            return idx, 3
-
-        row[slot] = image_url
-        row[8] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')      # I
-        # Keep terminal statuses; only advance to in_progress if not already finalized
-        curr_status = (row[9].strip().lower() if len(row) > 9 and row[9] else "")
-        if curr_status not in ("done", "timeout", "cancelled"):
-            row[9] = "in_progress"                                 # J
-        _update_row_dynamic("CheckIns", idx, row)
-        _checkins_row_index_cache[checkin_id] = idx
-        filled = _count_images_in_row(row)
-        return idx, filled
+    # cache row index for this checkin to support finalize without a fresh read
+    _checkins_row_index_cache[checkin_id] = idx
+
+    _ensure_row_len(row, 12)  # A..L
+    slot = _reserve_image_slot(checkin_id, row, 5, 7)
+    if slot is None:
+        # ครบ 3 ช่องแล้ว แค่รีเฟรชเวลา/สถานะ
+        _write_image_cells(_txn_sheet("CheckIns", checkin_id), checkin_id, idx, row, [])
+        return idx, 3
+
+    with _span("sheets_update"):
+        written = _write_image_cells(_txn_sheet("CheckIns", checkin_id), checkin_id, idx, row, [(slot, image_url)])
+    if written is None:
+        _commit_image_slot(checkin_id, slot, ok=False)
+        raise RuntimeError(f"Cannot write image slot {_col_letter(slot + 1)} for {checkin_id}")
+    filled = _commit_image_slot(checkin_id, slot)
+    return idx, filled
 
 def _update_submissions_add_image_url(submit_id: str, image_url: str, image_hash_hex: str):
     """
     สำหรับ Submissions: ใส่รูปลง F..H, เก็บแฮชลง M..O, ถ้าพบซ้ำให้จด reference ลง P..R
-    ทำแบบ idempotent ต่อช่อง ไม่สร้างแถวใหม่
+    ทำแบบ idempotent ต่อช่อง ไม่สร้างแถวใหม่; เขียนเฉพาะเซลล์ของช่องที่จองไว้
     """
-    lock = _txn_locks[submit_id]
-    with lock:
+    with _span("sheets_find"):
         row, idx = _find_submissions_row_by_id(submit_id)
-        if not idx:
-            # Do NOT auto-create a new row here; it would reset distance_m to 0.
-            # The row must already exist from the location step.
-            raise RuntimeError(f"Cannot locate Submissions row for {submit_id} (expected to be created at location step)")
-
-        _ensure_row_len(row, 19)  # ถึง S: employee_name
-        slot = _first_empty_image_slot_index(row, 5, 7)  # F..H
-        if slot is None:
-            row[8] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # I
-            row[9] = row[9] or "in_progress"                       # J
-            _update_row_dynamic(SUBMISSIONS_SHEET_NAME, idx, row)
-            return idx, 3, None
-
-        # ใส่ URL
-        row[slot] = image_url
-        # เขียนแฮชลง M..O (12..14)
-        hash_col = 12 + (slot - 5)
+    if not idx:
+        # Do NOT auto-create a new row here; it would reset distance_m to 0.
+        # The row must already exist from the location step.
+        raise RuntimeError(f"Cannot locate Submissions row for {submit_id} (expected to be created at location step)")
+
+    _ensure_row_len(row, 19)  # ถึง S: employee_name
+    slot = _reserve_image_slot(submit_id, row, 5, 7)  # F..H
+    if slot is None:
+        _write_image_cells(_txn_sheet(SUBMISSIONS_SHEET_NAME, submit_id), submit_id, idx, row, [])
+        return idx, 3, None
+
+    try:
+        # ใส่ URL + แฮชลง M..O (12..14)
+        cells = [(slot, image_url)]
         if image_hash_hex:
-            row[hash_col] = image_hash_hex
+            cells.append((12 + (slot - 5), image_hash_hex))
 
         # ตรวจซ้ำย้อนหลัง (ยกเว้น submit นี้เอง)
-        dup_submit_id, dup_row_idx, dup_slot_1based = _find_duplicate_in_submissions(image_hash_hex, exclude_submit_id=submit_id)
+        with _span("dup_check"):
+            dup_submit_id, dup_row_idx, dup_slot_1based = _find_duplicate_in_submissions(image_hash_hex, exclude_submit_id=submit_id)
         dup_note = None
         if dup_submit_id and dup_slot_1based:
             # Map slot to image URL column letters F,G,H (1->F, 2->G, 3->H)
@@ -1001,17 +3404,17 @@ def _update_submissions_add_image_url(submit_id: str, image_url: str, image_hash
             col_letter = col_letter_map.get(dup_slot_1based, "?")
             # Write only "row & column" info, e.g., "row 12 col F"
             dup_note = f"row {dup_row_idx} col {col_letter}"
-            dup_col = 15 + (slot - 5)  # P..R for current record's duplicate_of_1..3
-            row[dup_col] = dup_note
-
-        row[8] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')      # I
-        # Keep terminal statuses; only set to in_progress if not finalized
-        curr_status = (row[9].strip().lower() if len(row) > 9 and row[9] else "")
-        if curr_status not in ("done", "timeout", "cancelled"):
-            row[9] = "in_progress"                                  # J
-        _update_row_dynamic(SUBMISSIONS_SHEET_NAME, idx, row)
-        filled = _count_images_in_row(row)
-        return idx, filled, dup_note
+            cells.append((15 + (slot - 5), dup_note))  # P..R for current record's duplicate_of_1..3
+
+        with _span("sheets_update"):
+            written = _write_image_cells(_txn_sheet(SUBMISSIONS_SHEET_NAME, submit_id), submit_id, idx, row, cells)
+        if written is None:
+            raise RuntimeError(f"Cannot write image slot {_col_letter(slot + 1)} for {submit_id}")
+    except Exception:
+        _commit_image_slot(submit_id, slot, ok=False)
+        raise
+    filled = _commit_image_slot(submit_id, slot)
+    return idx, filled, dup_note
     
 def _ensure_row_len(row, length):
     """Pad row with empty strings to at least 'length' items (generic)."""
@@ -1030,6 +3433,8 @@ def _finalize_checkin(user_id, checkin_id, status_text, reply_token=None, send_s
     # Acquire the same per-transaction lock used by image writes to prevent status clobbering
     lock = _txn_locks[checkin_id]
     with lock:
+        # Late images for this transaction must not move J: status back to in_progress
+        _mark_image_slots_closed(checkin_id)
         # Try to locate row; if read fails, fall back to cached row index
         try:
             row, idx = _find_checkins_row_by_id(checkin_id)
@@ -1037,11 +3442,12 @@ def _finalize_checkin(user_id, checkin_id, status_text, reply_token=None, send_s
             row, idx = None, _checkins_row_index_cache.get(checkin_id)
 
         # Update status & timestamp
+        sheet = _txn_sheet("CheckIns", checkin_id)
         try:
             last_ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             if idx:
                 # Minimal range update when we know the row index
-                update_sheet_data("CheckIns", f"CheckIns!I{idx}:J{idx}", [last_ts, status_text])
+                update_sheet_data(sheet, f"{sheet}!I{idx}:J{idx}", [last_ts, status_text])
             else:
                 # Fallback: full read/update
                 row2, idx2 = _find_checkins_row_by_id(checkin_id)
@@ -1049,13 +3455,11 @@ def _finalize_checkin(user_id, checkin_id, status_text, reply_token=None, send_s
                     _ensure_row_len(row2, 12)
                     row2[8] = last_ts
                     row2[9] = status_text
-                    _update_row_dynamic("CheckIns", idx2, row2)
+                    _update_row_dynamic(_txn_sheet("CheckIns", checkin_id), idx2, row2)
                     _checkins_row_index_cache[checkin_id] = idx2
                     row, idx = row2, idx2
         except Exception as e:
-            print(f"WARNING: finalize: failed to update CheckIns for {checkin_id}: {e}")
-            traceback.print_exc()
-            sys.stdout.flush()
+            log.warning(f"finalize: failed to update CheckIns for {checkin_id}: {e}", exc_info=True)
 
         # Prepare optional summary text (only when finishing as 'done' and requested)
         summary_text = None
@@ -1072,17 +3476,13 @@ def _finalize_checkin(user_id, checkin_id, status_text, reply_token=None, send_s
                 else:
                     summary_text = "เช็คอินเรียบร้อย ✅ (ไม่ได้แนบภาพ)"
             except Exception as e:
-                print(f"WARNING: finalize: summary compose failed for {checkin_id}: {e}")
-                traceback.print_exc()
-                sys.stdout.flush()
+                log.warning(f"finalize: summary compose failed for {checkin_id}: {e}", exc_info=True)
 
     # Update Employees state (separate try to avoid blocking the scheduler)
     try:
         update_employee_state(user_id, "idle", "")
     except Exception as e:
-        print(f"WARNING: finalize: failed to set employee {user_id} idle: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
+        log.warning(f"finalize: failed to set employee {user_id} idle: {e}", exc_info=True)
 
     # Send summary to the user if requested
     if send_summary and summary_text:
@@ -1097,9 +3497,7 @@ def _finalize_checkin(user_id, checkin_id, status_text, reply_token=None, send_s
             else:
                 push_text(user_id, summary_text)
         except Exception as e:
-            print(f"WARNING: finalize: failed to send summary message: {e}")
-            traceback.print_exc()
-            sys.stdout.flush()
+            log.warning(f"finalize: failed to send summary message: {e}", exc_info=True)
 
 def _check_and_handle_timeout(user_id, reply_token=None):
     """On any incoming event, check remaining time.
@@ -1140,7 +3538,7 @@ def _check_and_handle_timeout(user_id, reply_token=None):
         row[9] = "warning"  # J: status
         row[10] = "1"        # K: warning_sent
         row[8] = now_dt.strftime('%Y-%m-%d %H:%M:%S')  # refresh last_updated_at so we don't double-warn too fast
-        update_sheet_data("CheckIns", f"CheckIns!A{idx}:L{idx}", row)
+        _update_row_dynamic(_txn_sheet("CheckIns", current_transaction_id), idx, row)
         # Prefer reply if we have a reply_token for this event; otherwise push
         try:
             if reply_token:
@@ -1154,8 +3552,7 @@ def _check_and_handle_timeout(user_id, reply_token=None):
                 push_text(user_id, f"จะหมดเวลาใน {int(max(1, round(seconds_left)))} วินาที กรุณาส่งรูปให้ครบ 3 รูป หรือพิมพ์ 'จบ'")
         except Exception:
             pass
-        print(f"DEBUG: Event-path warning sent, seconds_left={seconds_left:.1f}")
-        sys.stdout.flush()
+        log.debug(f"Event-path warning sent, seconds_left={seconds_left:.1f}")
         # Do not return here; allow further processing of the current event
 
     if seconds_left <= 0:
@@ -1174,111 +3571,439 @@ def _check_and_handle_timeout(user_id, reply_token=None):
                 push_text(user_id, notify_text)
         except Exception:
             pass
-        print(f"DEBUG: Check-in timed out for user {user_id}, transaction {current_transaction_id}")
-        sys.stdout.flush()
+        log.debug(f"Check-in timed out for user {user_id}, transaction {current_transaction_id}")
         return True
 
     return False
 
 # --- Background Job: scan and timeout overdue check-ins ---
+def _read_checkins_tail(sheet, timeout_sec):
+    """(start_row, [(row_idx_1based, row)]) for the recent tail of one CheckIns shard, rows holding
+    A..C + blank D..H + I..K; None if the quick read failed."""
+    total = _SHEET_ROW_COUNT.get(sheet)
+    start = max(2, total - SHEETS_TAIL_ROWS + 1) if total else 2
+    parts = get_sheet_ranges(sheet, [f"A{start}:C", f"I{start}:K"], quick=True, timeout_sec=timeout_sec)
+    if parts is None:
+        return None
+    head_cols, state_cols = parts
+    _note_sheet_rows(sheet, start + len(head_cols) - 1)
+    rows = []
+    for k, head in enumerate(head_cols):
+        if not head:
+            continue
+        tail = list(state_cols[k]) if k < len(state_cols) else []
+        rows.append((start + k, _ensure_row_len(list(head), 3)[:3] + [""] * 5 + tail))
+    return start, rows
+
+@_holds_row_positions
 def _scan_and_timeout_overdue_checkins():
     start_ts = time.time()
-    print("DEBUG: Scheduler run start"); sys.stdout.flush()
-    try:
-        # Read once per run
-        employees = get_sheet_data("Employees")
-        if not employees:
-            print("DEBUG: Scheduler: no Employees data; skip run"); sys.stdout.flush()
-            return
-
-        now_dt = datetime.now()
-
-        # Build employee index: line_id -> (row, idx1)
-        emp_index = {}
-        for i, r in enumerate(employees):
-            if r and len(r) > 0 and r[0]:
-                emp_index[r[0]] = (r, i + 1)
-
-        # Fast exit if no one is waiting for images
-        any_waiting = False
-        for r, _ in emp_index.values():
-            state = r[EMPLOYEE_CURRENT_STATE_COL] if len(r) > EMPLOYEE_CURRENT_STATE_COL else ""
-            if state == "waiting_for_checkin_images":
-                any_waiting = True
-                break
-        if not any_waiting:
-            print("DEBUG: Scheduler early-exit: no employees waiting for images"); sys.stdout.flush()
-            return
-
-        # Read CheckIns only when needed (use quick-read to avoid long blocking)
-        quick_to = min(SHEETS_EXECUTE_TIMEOUT_SEC, max(5, SCHEDULER_INTERVAL_SECONDS - 1))
-        checkins = get_sheet_data_quick("CheckIns", timeout_sec=quick_to)
-        if checkins is None:
-            print("DEBUG: Scheduler: quick read CheckIns failed; skip run"); sys.stdout.flush()
-            return
-
-        for ci, row in enumerate(checkins):
-            if not row or len(row) < 3:
-                continue
-            checkin_id = row[0]
-            line_id = row[2]
-            status = row[9] if len(row) > 9 else ""
-            if status in ("done", "timeout", "cancelled"):
-                continue
+    _hot_log.debug("Scheduler run start")
+    notices = []  # (user_id, text, urgent, raised_at), sent together at the end of the run
+    # Scheduler traffic yields to interactive webhook calls in the shared rate limiter
+    with _api_priority("background"):
+        try:
+            # Read once per run
+            employees = get_sheet_data("Employees")
+            if not employees:
+                log.debug("Scheduler: no Employees data; skip run")
+                return
 
-            last_ts_str = row[8] if len(row) > 8 and row[8] else (row[1] if len(row) > 1 else "")
-            if not last_ts_str:
-                continue
-            try:
-                last_dt = datetime.strptime(last_ts_str, '%Y-%m-%d %H:%M:%S')
-            except Exception:
-                continue
+            now_dt = datetime.now()
+
+            # Build employee index: line_id -> (row, idx1)
+            emp_index = {}
+            for i, r in enumerate(employees):
+                if r and len(r) > 0 and r[0]:
+                    emp_index[r[0]] = (r, i + 1)
+
+            # Fast exit if no one is waiting for images
+            any_waiting = False
+            for r, _ in emp_index.values():
+                state = r[EMPLOYEE_CURRENT_STATE_COL] if len(r) > EMPLOYEE_CURRENT_STATE_COL else ""
+                if state == "waiting_for_checkin_images":
+                    any_waiting = True
+                    break
+            if not any_waiting:
+                log.debug("Scheduler early-exit: no employees waiting for images")
+                return
 
-            elapsed = (now_dt - last_dt).total_seconds()
-            seconds_left = CHECKIN_TIMEOUT_SECONDS - elapsed
-
-            # warning window
-            warned = (len(row) > 10 and str(row[10]).strip() != "")
-            if 0 < seconds_left <= WARNING_BEFORE_SECONDS and not warned:
-                _ensure_row_len(row, 12)  # A..L
-                row[9] = "warning"           # J
-                row[10] = "1"                # K
-                row[8] = now_dt.strftime('%Y-%m-%d %H:%M:%S')  # refresh last_updated_at
-                _update_row_dynamic("CheckIns", ci+1, row)
+            # Read CheckIns only when needed (quick read to avoid long blocking), and only
+            # A..C (id, created, user) + I..K (last_updated, status, warning) of the recent tail,
+            # of every shard in parallel
+            quick_to = min(SHEETS_EXECUTE_TIMEOUT_SEC, max(5, SCHEDULER_INTERVAL_SECONDS - 1))
+            shard_sheets = _shard_sheets("CheckIns")
+            tails = _fan_out(lambda s: _read_checkins_tail(s, quick_to), shard_sheets)
+            if all(t is None for t in tails):
+                log.debug("Scheduler: quick read CheckIns failed; skip run")
+                return
+            checkins = []  # (sheet, row_idx_1based, row) with D..H left blank
+            windowed = False
+            for sheet, tail in zip(shard_sheets, tails):
+                if tail is None:
+                    windowed = True  # unknown shard contents: locate waiting check-ins below
+                    continue
+                start, rows = tail
+                windowed = windowed or start > 2
+                checkins.extend((sheet, row_idx, row) for row_idx, row in rows)
+            if windowed:
+                # Waiting check-ins older than the tail window (or in an unreadable shard) are located individually
+                seen = {row[0] for _, _, row in checkins}
+                for r, _ in emp_index.values():
+                    state = r[EMPLOYEE_CURRENT_STATE_COL] if len(r) > EMPLOYEE_CURRENT_STATE_COL else ""
+                    txn = r[EMPLOYEE_CURRENT_TRANSACTION_ID_COL] if len(r) > EMPLOYEE_CURRENT_TRANSACTION_ID_COL else ""
+                    if state == "waiting_for_checkin_images" and txn and txn not in seen:
+                        try:
+                            old_row, old_idx = _find_checkins_row_by_id(txn)
+                        except Exception:
+                            continue
+                        if old_idx:
+                            checkins.append((_txn_sheet("CheckIns", txn), old_idx, old_row))
+
+            for sheet, row_idx, row in checkins:
+                if not row or len(row) < 3:
+                    continue
+                checkin_id = row[0]
+                line_id = row[2]
+                status = row[9] if len(row) > 9 else ""
+                if status in ("done", "timeout", "cancelled"):
+                    continue
+
+                last_ts_str = row[8] if len(row) > 8 and row[8] else (row[1] if len(row) > 1 else "")
+                if not last_ts_str:
+                    continue
                 try:
-                    push_text(line_id, f"จะหมดเวลาใน {int(max(1, round(seconds_left)))} วินาที กรุณาส่งรูปให้ครบ 3 รูป หรือพิมพ์ 'จบ'")
+                    last_dt = datetime.strptime(last_ts_str, '%Y-%m-%d %H:%M:%S')
                 except Exception:
-                    pass
-                continue
+                    continue
+
+                elapsed = (now_dt - last_dt).total_seconds()
+                seconds_left = CHECKIN_TIMEOUT_SECONDS - elapsed
+
+                # warning window
+                warned = (len(row) > 10 and str(row[10]).strip() != "")
+                if 0 < seconds_left <= WARNING_BEFORE_SECONDS and not warned:
+                    # I..K only: the tail row has D..H blanked, so it must not become the row snapshot
+                    # or the last-good copy (finalize / summary read those while writes are queued)
+                    update_sheet_data(sheet, f"{sheet}!I{row_idx}:K{row_idx}",
+                                      [now_dt.strftime('%Y-%m-%d %H:%M:%S'), "warning", "1"])  # last_updated_at, J, K
+                    notices.append((line_id, f"จะหมดเวลาใน {int(max(1, round(seconds_left)))} วินาที กรุณาส่งรูปให้ครบ 3 รูป หรือพิมพ์ 'จบ'",
+                                    True, time.time()))
+                    continue
+
+                if seconds_left > 0:
+                    continue
+
+                emp_tuple = emp_index.get(line_id)
+                if not emp_tuple:
+                    continue
+                emp_row, emp_row_idx = emp_tuple
+                while len(emp_row) <= EMPLOYEE_CURRENT_TRANSACTION_ID_COL:
+                    emp_row.append("")
+                state = emp_row[EMPLOYEE_CURRENT_STATE_COL] if len(emp_row) > EMPLOYEE_CURRENT_STATE_COL else ""
+                txn = emp_row[EMPLOYEE_CURRENT_TRANSACTION_ID_COL] if len(emp_row) > EMPLOYEE_CURRENT_TRANSACTION_ID_COL else ""
+                if state != "waiting_for_checkin_images" or txn != checkin_id:
+                    continue
+
+                with _log_context(transaction_id=checkin_id, user_id=line_id):
+                    log.info(f"Scheduler timing out checkin {checkin_id} (elapsed={elapsed}s)")
+                    _remember_txn_shard(checkin_id, sheet)
+                    _finalize_checkin(line_id, checkin_id, "timeout")
+                    # informational: goes out with the user's next reply unless a reply token is at hand
+                    notices.append((line_id, f"หมดเวลา {CHECKIN_TIMEOUT_SECONDS} วินาที ระบบปิดเช็คอินให้อัตโนมัติแล้วครับ",
+                                    False, time.time()))
+        except Exception as e:
+            log.error(f"_scan_and_timeout_overdue_checkins failed: {e}", exc_info=True)
+        finally:
+            if notices:
+                try:
+                    routes = _dispatch_notices(notices)
+                    log.info(f"Scheduler notices: {len(notices)} ({', '.join(f'{r}={routes.count(r)}' for r in sorted(set(routes)))})")
+                except Exception as e:
+                    log.error(f"Scheduler notice dispatch failed: {e}", exc_info=True)
+            dur = time.time() - start_ts
+            _hot_log.debug(f"Scheduler run end (took {dur:.2f}s)")
+
+# --- Archival: move closed, old rows out of the hot CheckIns / Submissions tabs ---
+# Lookups, the scheduler and the duplicate check only need recent rows. Once a day (ARCHIVE_HOUR
+# in APP_TIMEZONE) rows whose status is done/timeout/cancelled and whose last_updated_at (I) is
+# older than ARCHIVE_AFTER_DAYS are copied to per-month tabs "<Tab>_<YYYY>_<MM>" (month of
+# created_at, same columns + header as the hot tab) in ARCHIVE_SPREADSHEET_ID (default: the
+# spreadsheet of the hot tab, i.e. each shard archives into itself), then removed from the hot
+# tab with one spreadsheets.batchUpdate of deleteDimension ranges.
+#   - rows already in the archive tab (a previous run stopped between copy and delete) are not copied again
+#   - deleting rows shifts row numbers, so the delete runs with _row_positions held exclusively (no
+#     handler or scan in between), and is skipped while anyone is mid check-in / submission or writes
+#     are still queued for replay; the id column is re-checked right before the delete, and row-index
+#     caches are dropped before the gate is released
+# Off by default: turn on with ARCHIVE_ENABLED=1 once the archive spreadsheet is set up.
+ARCHIVE_ENABLED = os.getenv('ARCHIVE_ENABLED', '0') == '1'
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_HOUR = int(os.getenv('ARCHIVE_HOUR', '3'))
+ARCHIVE_MAX_ROWS_PER_RUN = int(os.getenv('ARCHIVE_MAX_ROWS_PER_RUN', '5000'))  # per tab
+ARCHIVE_APPEND_CHUNK_ROWS = int(os.getenv('ARCHIVE_APPEND_CHUNK_ROWS', '1000'))
+ARCHIVE_SPREADSHEET_ID = os.getenv('ARCHIVE_SPREADSHEET_ID', '').strip()
+ARCHIVE_LOCK_WAIT_SEC = float(os.getenv('ARCHIVE_LOCK_WAIT_SEC', '30'))  # wait for a gap between handlers
+# Archived months still searched for duplicate images; unset = every archive tab, 0 = none
+ARCHIVE_DUP_MONTHS = int(os.getenv('ARCHIVE_DUP_MONTHS')) if os.getenv('ARCHIVE_DUP_MONTHS', '').strip() else None
+SHEET_PROPS_TTL_SEC = float(os.getenv('SHEET_PROPS_TTL_SEC', '3600'))
+_ARCHIVE_CLOSED_STATUSES = ("done", "timeout", "cancelled")
+_archive_lock = threading.Lock()
+_ARCHIVE_STATE = {"running": False, "last_started": None, "last_finished": None, "last_result": None,
+                  "moved_total": 0}
+_SHEET_PROPS_CACHE = {}  # spreadsheet_id -> {"props": {title: sheetId}, "ts": float}
+_ARCHIVE_HASH_INDEX = {"tabs": None, "index": {}}  # archived Submissions image hashes (see _find_duplicate_in_submissions)
+
+
+def _sheet_properties(spreadsheet_id, refresh=False):
+    """{tab title: sheetId} of a spreadsheet, cached for SHEET_PROPS_TTL_SEC."""
+    ent = _SHEET_PROPS_CACHE.get(spreadsheet_id)
+    if ent and not refresh and time.time() - ent["ts"] <= SHEET_PROPS_TTL_SEC:
+        return ent["props"]
+    request = lambda: sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields="sheets.properties(sheetId,title)")
+    result = _sheets_exec_with_retry(request, "Sheets spreadsheets.get()", method_class="read")
+    props = {s["properties"]["title"]: s["properties"]["sheetId"] for s in result.get("sheets", [])}
+    _SHEET_PROPS_CACHE[spreadsheet_id] = {"props": props, "ts": time.time()}
+    return props
+
+
+def _archive_target(sheet_name):
+    """Spreadsheet id the archive tabs of (sharded) tab sheet_name go to."""
+    return ARCHIVE_SPREADSHEET_ID or _resolve_sheet(sheet_name)[0]
+
+
+def _archive_tab_name(sheet_name, created_at):
+    try:
+        dt = datetime.strptime(str(created_at)[:10], '%Y-%m-%d')
+    except Exception:
+        return f"{sheet_name}_undated"
+    return f"{sheet_name}_{dt:%Y_%m}"
 
-            if seconds_left > 0:
-                continue
 
-            emp_tuple = emp_index.get(line_id)
-            if not emp_tuple:
-                continue
-            emp_row, emp_row_idx = emp_tuple
-            while len(emp_row) <= EMPLOYEE_CURRENT_TRANSACTION_ID_COL:
-                emp_row.append("")
-            state = emp_row[EMPLOYEE_CURRENT_STATE_COL] if len(emp_row) > EMPLOYEE_CURRENT_STATE_COL else ""
-            txn = emp_row[EMPLOYEE_CURRENT_TRANSACTION_ID_COL] if len(emp_row) > EMPLOYEE_CURRENT_TRANSACTION_ID_COL else ""
-            if state != "waiting_for_checkin_images" or txn != checkin_id:
+def _archive_candidates(rows, cutoff_dt, limit):
+    """[(row_idx_1based, row)] of closed rows last updated before cutoff_dt (row 1 is the header)."""
+    out = []
+    for i, r in enumerate(rows[1:], start=2):
+        if not r or not r[0]:
+            continue
+        if (r[9] if len(r) > 9 else "") not in _ARCHIVE_CLOSED_STATUSES:
+            continue
+        ts = (r[8] if len(r) > 8 and r[8] else "") or (r[1] if len(r) > 1 else "")
+        try:
+            if datetime.strptime(ts, '%Y-%m-%d %H:%M:%S') >= cutoff_dt:
                 continue
-
-            print(f"DEBUG: Scheduler timing out checkin {checkin_id} for user {line_id} (elapsed={elapsed}s)")
-            sys.stdout.flush()
-            _finalize_checkin(line_id, checkin_id, "timeout")
-            try:
-                push_text(line_id, f"หมดเวลา {CHECKIN_TIMEOUT_SECONDS} วินาที ระบบปิดเช็คอินให้อัตโนมัติแล้วครับ")
-            except Exception:
-                pass
-    except Exception as e:
-        print(f"ERROR: _scan_and_timeout_overdue_checkins failed: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
+        except Exception:
+            continue
+        out.append((i, r))
+        if len(out) >= limit:
+            break
+    return out
+
+
+def _anyone_mid_transaction():
+    """True if some employee is between location and 'จบ' (fresh Employees read, cache bypassed)."""
+    _refdata_invalidate("Employees")
+    employees = get_sheet_data("Employees")
+    if employees is None:
+        return True  # unknown -> be safe
+    return any(len(r) > EMPLOYEE_CURRENT_STATE_COL and str(r[EMPLOYEE_CURRENT_STATE_COL]).startswith("waiting_for_")
+               for r in employees[1:])
+
+
+def _delete_row_runs(spreadsheet_id, sheet_id, row_indexes):
+    """Delete rows (1-based) with one batchUpdate; contiguous runs, bottom-up so indexes stay valid."""
+    runs = []
+    for idx in sorted(row_indexes, reverse=True):
+        if runs and runs[-1][0] == idx + 1:
+            runs[-1][0] = idx
+        else:
+            runs.append([idx, idx])
+    body = {"requests": [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS",
+                                                        "startIndex": lo - 1, "endIndex": hi}}}
+                         for lo, hi in runs]}
+    request = lambda: sheets_service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body)
+    _sheets_exec_with_retry(request, f"Sheets spreadsheets.batchUpdate(deleteDimension x{len(runs)})")
+    return len(runs)
+
+
+def _forget_row_positions(sheet_name, idx_cache):
+    """Drop everything that remembers row numbers of sheet_name (they moved)."""
+    _note_sheet_write(sheet_name)
+    idx_cache.clear()
+    with _row_snapshots_lock:
+        for key in [k for k in _row_snapshots if k[0] == sheet_name]:
+            del _row_snapshots[key]
+        for key in [k for k in _last_good_rows if k[0] == sheet_name]:
+            del _last_good_rows[key]
+        for key in [k for k in _last_good_row_ids if k[0] == sheet_name]:
+            del _last_good_row_ids[key]
+    _SHEET_ROW_COUNT.pop(sheet_name, None)
+    _SHEET_LAST_GOOD.pop(sheet_name, None)
+
+
+def _archive_sheet(sheet_name, idx_cache, cutoff_dt):
+    """Move closed rows older than cutoff_dt of one hot tab into its monthly archive tabs."""
+    rows = get_sheet_data(sheet_name)
+    if not rows:
+        return {"moved": 0, "skipped": "no data"}
+    header = rows[0]
+    width = max(len(header), max((len(r) for r in rows), default=0))
+    candidates = _archive_candidates(rows, cutoff_dt, ARCHIVE_MAX_ROWS_PER_RUN)
+    if not candidates:
+        return {"moved": 0}
+
+    base = _sheet_base(sheet_name)
+    archive_id = _archive_target(sheet_name)
+    by_tab = {}
+    for idx, r in candidates:
+        by_tab.setdefault(_archive_tab_name(base, r[1] if len(r) > 1 else ""), []).append((idx, r))
+
+    # 1) Archive tabs: create missing ones (with the hot tab's header), read ids of existing ones
+    props = _sheet_properties(archive_id)
+    missing = [t for t in by_tab if t not in props]
+    existing_ids = {}
+    present = [t for t in by_tab if t in props]
+    if present:
+        request = lambda: sheets_service.spreadsheets().values().batchGet(
+            spreadsheetId=archive_id, ranges=[f"'{t}'!A2:A" for t in present])
+        result = _sheets_exec_with_retry(request, f"Sheets batchGet({sheet_name} archive ids)", method_class="read")
+        for t, vr in zip(present, result.get("valueRanges", [])):
+            existing_ids[t] = {v[0] for v in vr.get("values", []) if v}
+    if missing:
+        body = {"requests": [{"addSheet": {"properties": {"title": t}}} for t in missing]}
+        request = lambda: sheets_service.spreadsheets().batchUpdate(spreadsheetId=archive_id, body=body)
+        _sheets_exec_with_retry(request, f"Sheets spreadsheets.batchUpdate(addSheet x{len(missing)})")
+        head = {"valueInputOption": "RAW",
+                "data": [{"range": f"'{t}'!A1", "values": [_ensure_row_len(list(header), width)]} for t in missing]}
+        request = lambda: sheets_service.spreadsheets().values().batchUpdate(
+            spreadsheetId=archive_id, body=head)
+        _sheets_exec_with_retry(request, f"Sheets batchUpdate({sheet_name} archive headers)")
+        _sheet_properties(archive_id, refresh=True)
+
+    # 2) Copy, one append per tab and chunk
+    copied = {}
+    for t, items in by_tab.items():
+        seen = existing_ids.get(t, set())
+        values = [_ensure_row_len(list(r), width) for _, r in items if r[0] not in seen]
+        for k in range(0, len(values), ARCHIVE_APPEND_CHUNK_ROWS):
+            chunk = {"values": values[k:k + ARCHIVE_APPEND_CHUNK_ROWS]}
+            request = lambda: sheets_service.spreadsheets().values().append(
+                spreadsheetId=archive_id, range=f"'{t}'!A1",
+                valueInputOption='RAW', insertDataOption='INSERT_ROWS', body=chunk)
+            _sheets_exec_with_retry(request, f"Sheets append({t}, {len(chunk['values'])} rows)")
+        copied[t] = len(values)
+
+    # 3) Delete from the hot tab, only if nothing is in flight and the rows are still where we read them.
+    # No handler runs while the gate is held, so nobody can look a row up between the check and the delete.
+    hot_spreadsheet, hot_tab = _resolve_sheet(sheet_name)
+    with _row_positions.exclusive(ARCHIVE_LOCK_WAIT_SEC) as held:
+        if not held:
+            return {"moved": 0, "copied": copied, "skipped": "handlers busy"}
+        if _pending_sheet_writes or _drain_lock.locked():
+            return {"moved": 0, "copied": copied, "skipped": "queued writes pending"}
+        if _anyone_mid_transaction():
+            return {"moved": 0, "copied": copied, "skipped": "transactions in progress"}
+        ids = get_sheet_range(sheet_name, "A:A")
+        if ids is None:
+            return {"moved": 0, "copied": copied, "skipped": "id re-check failed"}
+        moved_rows = [idx for idx, r in candidates if idx <= len(ids) and ids[idx - 1] and ids[idx - 1][0] == r[0]]
+        if len(moved_rows) != len(candidates):
+            log.warning(f"Archive {sheet_name}: {len(candidates) - len(moved_rows)} row(s) moved since read; "
+                        "deleting only the unchanged ones")
+        if not moved_rows:
+            return {"moved": 0, "copied": copied}
+        hot_id = _sheet_properties(hot_spreadsheet).get(hot_tab)
+        if hot_id is None:
+            hot_id = _sheet_properties(hot_spreadsheet, refresh=True)[hot_tab]
+        try:
+            runs = _delete_row_runs(hot_spreadsheet, hot_id, moved_rows)
+        finally:
+            _forget_row_positions(sheet_name, idx_cache)  # idx_cache: _checkins_ / _submissions_row_index_cache
+    if base == SUBMISSIONS_SHEET_NAME:
+        _ARCHIVE_HASH_INDEX["tabs"] = None  # rebuild with the newly archived hashes
+    return {"moved": len(moved_rows), "delete_ranges": runs, "copied": copied,
+            "remaining": len(rows) - 1 - len(moved_rows)}
+
+
+def _archive_closed_rows():
+    """Scheduler job (daily): archive CheckIns and Submissions. Returns the per-tab result."""
+    if not _archive_lock.acquire(blocking=False):
+        log.info("Archive run already in progress; skip")
+        return None
+    _ARCHIVE_STATE.update(running=True, last_started=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    result = {}
+    try:
+        with _api_priority("background"):
+            ensure_google_services()
+            cutoff_dt = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+            tabs = [(s, _checkins_row_index_cache) for s in _shard_sheets("CheckIns")]
+            tabs += [(s, _submissions_row_index_cache) for s in _shard_sheets(SUBMISSIONS_SHEET_NAME)]
+            for sheet_name, idx_cache in tabs:
+                try:
+                    result[sheet_name] = _archive_sheet(sheet_name, idx_cache, cutoff_dt)
+                    _ARCHIVE_STATE["moved_total"] += result[sheet_name].get("moved", 0)
+                except Exception as e:
+                    log.error(f"Archive {sheet_name} failed: {e}", exc_info=True)
+                    result[sheet_name] = {"moved": 0, "error": str(e)}
+            log.info(f"Archive run finished (cutoff {cutoff_dt:%Y-%m-%d}): {result}")
     finally:
-        dur = time.time() - start_ts
-        print(f"DEBUG: Scheduler run end (took {dur:.2f}s)"); sys.stdout.flush()
+        _ARCHIVE_STATE.update(running=False, last_finished=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                              last_result=result)
+        _archive_lock.release()
+    return result
+
+
+def _archived_submission_hashes():
+    """hash -> (submit_id, "Tab!row", slot) over the archive tabs (of every shard's archive
+    spreadsheet): all of them, or the last ARCHIVE_DUP_MONTHS months; rebuilt only when the set of
+    tabs changes."""
+    if ARCHIVE_DUP_MONTHS is not None and ARCHIVE_DUP_MONTHS <= 0:
+        return {}
+    if ARCHIVE_DUP_MONTHS is None:
+        archive_tab = re.compile(re.escape(SUBMISSIONS_SHEET_NAME) + r"_(\d{4}_\d{2}|undated)$")
+        wanted_tab = lambda t: archive_tab.match(t) is not None
+    else:
+        today = datetime.now()
+        months = set()
+        for k in range(ARCHIVE_DUP_MONTHS + 1):
+            y, m = divmod(today.year * 12 + today.month - 1 - k, 12)
+            months.add(f"{SUBMISSIONS_SHEET_NAME}_{y:04d}_{m + 1:02d}")
+        wanted_tab = months.__contains__
+    wanted = []
+    for archive_id in dict.fromkeys(_archive_target(s) for s in _shard_sheets(SUBMISSIONS_SHEET_NAME)):
+        try:
+            props = _sheet_properties(archive_id)
+        except Exception as e:
+            log.warning(f"archive tab list unavailable: {e}")
+            return _ARCHIVE_HASH_INDEX["index"]
+        wanted += [(archive_id, t) for t in sorted(props) if wanted_tab(t)]
+    tabs = tuple(wanted)
+    if _ARCHIVE_HASH_INDEX["tabs"] == tabs:
+        return _ARCHIVE_HASH_INDEX["index"]
+    index = {}
+    for archive_id in dict.fromkeys(a for a, _ in tabs):
+        names = [t for a, t in tabs if a == archive_id]
+        ranges = [r for t in names for r in (f"'{t}'!A2:A", f"'{t}'!M2:O")]
+        request = lambda: sheets_service.spreadsheets().values().batchGet(
+            spreadsheetId=archive_id, ranges=ranges)
+        try:
+            result = _sheets_exec_with_retry(request, f"Sheets batchGet({SUBMISSIONS_SHEET_NAME} archive hashes)",
+                                             method_class="read")
+        except Exception as e:
+            log.warning(f"archived hash read failed: {e}")
+            return _ARCHIVE_HASH_INDEX["index"]
+        vrs = result.get("valueRanges", [])
+        for n, t in enumerate(names):
+            ids = vrs[2 * n].get("values", []) if 2 * n < len(vrs) else []
+            hashes = vrs[2 * n + 1].get("values", []) if 2 * n + 1 < len(vrs) else []
+            for k, h in enumerate(hashes):
+                submit_id = ids[k][0] if k < len(ids) and ids[k] else ""
+                for slot in range(min(3, len(h))):
+                    if submit_id and h[slot]:
+                        index.setdefault(str(h[slot]).strip().lower(), (submit_id, f"{t}!{k + 2}", slot + 1))
+    _ARCHIVE_HASH_INDEX.update(tabs=tabs, index=index)
+    return index
 
 # --- Webhook Endpoint ---
 @app.route("/callback", methods=['POST'])
@@ -1286,39 +4011,35 @@ def callback():
     # Ensure Google services are initialized
     ensure_google_services()
 
-    print("Webhook callback received!") # Add this line for debugging
-    sys.stdout.flush() # Flush output
+    _set_log_context(transaction_id=None, user_id=None)  # request threads are reused
+    _hot_log.debug("Webhook callback received")
     signature = request.headers.get('X-Line-Signature') # Use .get() for safety
     if not signature:
-        print("ERROR: Missing X-Line-Signature header.")
-        sys.stdout.flush()
+        log.error("Missing X-Line-Signature header.")
         abort(400, description="Missing X-Line-Signature")
 
     body = request.get_data(as_text=True)
-    print("Request body: " + body)
-    print("X-Line-Signature: " + signature)
-    sys.stdout.flush() # Flush output
+    # Body length only: full payloads (user ids, message text) are not logged
+    _hot_log.debug(f"Callback body {len(body)}B")
 
     try:
-        handler.handle(body, signature)
+        with _row_positions.shared():
+            handler.handle(body, signature)
     except InvalidSignatureError as e:
-        print("ERROR: Invalid LINE signature. Check LINE_CHANNEL_SECRET.")
-        print(f"Exception details: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
+        log.error(f"Invalid LINE signature. Check LINE_CHANNEL_SECRET. ({e})")
         abort(400)
     except Exception as e:
-        print(f"ERROR: Error handling webhook: {e}")
-        print(f"Exception details: {e}")
-        traceback.print_exc()
-        sys.stdout.flush()
+        log.error(f"Error handling webhook: {e}", exc_info=True)
         abort(500)
+    finally:
+        _release_reply_tokens()
 
     return 'OK'
 
 # --- OAuth Routes ---
 @app.route('/authorize')
 def authorize():
+    from google_auth_oauthlib.flow import Flow
     flow = Flow.from_client_secrets_file(
         CLIENT_SECRETS_FILE, 
         scopes=OAUTH_SCOPES)
@@ -1331,8 +4052,7 @@ def authorize():
     )
     
     session['oauth_state'] = state
-    print(f"DEBUG: set session oauth_state = {state}") # New print
-    sys.stdout.flush()
+    log.debug(f"set session oauth_state = {state}")
     return redirect(authorization_url)
 
 @app.route('/oauth2callback')
@@ -1341,12 +4061,12 @@ def oauth2callback():
     if not state:
         return "Invalid or missing OAuth state. Please start authorization again at /authorize", 400
 
-    print(f"DEBUG: session oauth_state = {session.get('oauth_state')}") # New print
-    print(f"DEBUG: query state = {request.args.get('state')}") # New print
-    print(f"DEBUG: query code  = {request.args.get('code')}") # New print
-    print(f"DEBUG: request url   = {request.url}") # New print
-    sys.stdout.flush()
+    log.debug(f"session oauth_state = {session.get('oauth_state')}")
+    log.debug(f"query state = {request.args.get('state')}")
+    log.debug(f"query code  = {request.args.get('code')}")
+    log.debug(f"request url   = {request.url}")
 
+    from google_auth_oauthlib.flow import Flow
     flow = Flow.from_client_secrets_file(
         CLIENT_SECRETS_FILE, 
         scopes=OAUTH_SCOPES, state=state)
@@ -1369,35 +4089,20 @@ def oauth2callback():
 
 
 # --- LIFF App Serving Route ---
-
-@app.route("/liff_location_picker")
-def liff_location_picker():
-    """
-    LIFF page to acquire GPS from the mobile and send a LINE location message back to chat.
-    It reads ?txn=&lt;uuid&gt; and embeds (txn|acc|ts) into the address field for anti-fraud.
-
-    Changes in this version:
-    - Fixes the "ต้องกด 2 ครั้ง" issue by auto-resuming after LIFF login using sessionStorage('autoRun').
-    - Single-tap flow: first tap → login (if needed) → auto-continue to read GPS → send location.
-    - Keeps anti-fraud metadata (txn|acc|ts) and accuracy gating.
-    - Styling: center primary button; smaller secondary buttons.
-    NOTE: This version avoids Python f-strings to prevent conflicts with `{}` in HTML/CSS/JS.
-    """
-    if not LIFF_ID:
-        return "LIFF_ID is not set on server", 500
-
-    txn = request.args.get("txn", "")
-
-    # Use literal placeholders and replace later to avoid f-string brace escaping issues.
-    html = """<!doctype html>
-<html lang="th">
-<head>
-  <meta charset="utf-8" />
-  <meta name="viewport" content="width=device-width,initial-scale=1,viewport-fit=cover" />
-  <title>ส่งตำแหน่งเช็คอิน</title>
-  <script src="https://static.line-scdn.net/liff/edge/2/sdk.js"></script>
-  <style>
-    :root {
+# The location picker is built once per (LIFF_ID, MAX_GPS_ACCURACY_M, LIFF_DIRECT_POST): a small HTML shell plus CSS
+# and JS assets named by content hash. Each body is kept as identity / gzip / brotli (if the
+# optional `brotli` package is installed) with an ETag per encoding, so a request is a dict lookup
+# and a 304 when the webview still has it. The txn is read client-side from the page URL, so the
+# page is the same for every check-in:
+#   - HTML shell: Cache-Control max-age=LIFF_PAGE_MAX_AGE_SEC, revalidated by ETag
+#   - /liff_location_picker/app.<hash>.css|js: public, max-age=1 year, immutable
+#     (an outdated hash from a shell cached before a deploy gets the current asset, not cached)
+LIFF_PAGE_MAX_AGE_SEC = int(os.getenv('LIFF_PAGE_MAX_AGE_SEC', '600'))
+LIFF_ASSET_MAX_AGE_SEC = 365 * 86400
+_LIFF_PAGE_CACHE = {}  # (LIFF_ID, MAX_GPS_ACCURACY_M, LIFF_DIRECT_POST) -> {"html": variants, "assets": {name: variants}}
+_liff_page_lock = threading.Lock()
+
+_LIFF_PICKER_CSS = """    :root {
       --bg: #0b0f14;
       --card: #121922;
       --text: #e8eef6;
@@ -1481,43 +4186,39 @@ def liff_location_picker():
     footer { margin-top: 14px; text-align: center; font-size: 12px; color: var(--muted); }
     a { color: inherit; }
     #openInLineBtn { display:none; }
-  </style>
-</head>
-<body>
-  <div class="container">
-    <div class="card">
-      <div class="header">
-        <div class="dot"></div><h1>ส่งตำแหน่งเช็คอิน</h1>
-      </div>
-      <p class="lead">กดปุ่มด้านล่างเพื่อส่ง <b>ตำแหน่ง Location จากมือถือ</b></p>
-
-      <div class="status" id="statusBox">
-        <div class="row"><span>สถานะ LIFF</span><span id="stLiff" class="danger">ยังไม่เริ่ม</span></div>
-        <div class="row"><span>สิทธิ์ตำแหน่ง (GPS)</span><span id="stPerm" class="danger">ยังไม่ได้ร้องขอ</span></div>
-        <div class="row"><span>ความแม่นยำ (m)</span><span id="stAcc">-</span></div>
-        <div class="row"><span>เวลาที่อ่าน</span><span id="stTs">-</span></div>
-      </div>
-
-      <div class="actions">
-        <div class="btnwrap">
-          <button id="sendBtn" class="primary">ส่งตำแหน่งปัจจุบัน</button>
-          <div class="spinner" id="spin"></div>
-        </div>
-        <button id="retryBtn" class="secondary">ลองใหม่ / รีเฟรชสิทธิ์</button>
-        <button id="openInLineBtn" class="secondary">เปิดใน LINE แล้วลองอีกครั้ง</button>
-      </div>
-
-      <p class="helper">เปิด GPS/Location, เปิดสัญญาณมือถือ/ไวไฟ และยืนกลางแจ้งเพื่อความแม่นยำที่ดีกว่า</p>
-      <p class="hint" id="hint"></p>
-      <pre class="log" id="log"></pre>
-      <footer>LIFF ID: <span id="liffIdLabel">-</span> · Txn: <span id="txnLabel">-</span></footer>
-    </div>
-  </div>
+"""
+
+_LIFF_PICKER_JS = """    const LIFF_ID = document.body.dataset.liffId;
+    const MAX_ACC = Number(document.body.dataset.maxAcc);
+    const DIRECT_POST = document.body.dataset.directPost === "1";
+
+    // txn / t come from this page's URL (?txn=...&t=...); before liff.init() has redirected they are inside liff.state
+    function readParam(name) {
+      const q = new URLSearchParams(window.location.search);
+      let v = q.get(name);
+      if (!v && q.get("liff.state")) {
+        try { v = new URLSearchParams(q.get("liff.state").split("?")[1] || "").get(name); } catch (e) { v = ""; }
+      }
+      return v || "";
+    }
+    let txn = readParam("txn");
+    let token = readParam("t");
 
-    <script>
-    const LIFF_ID = "__LIFF_ID__";
-    const txn = "__TXN__";
-    const MAX_ACC = __MAX_ACC__;
+    // POST straight to the server; null means "not delivered" (network error / 5xx) -> send via chat instead
+    async function postLocation(lat, lon, acc, ts) {
+      if (!DIRECT_POST || !token) return null;
+      try {
+        const res = await fetch("/liff/location", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ t: token, lat: lat, lon: lon, acc: acc, ts: ts }),
+        });
+        if (res.status >= 500) return null;
+        return await res.json();
+      } catch (e) {
+        return null;
+      }
+    }
 
     const stLiff = document.getElementById('stLiff');
     const stPerm = document.getElementById('stPerm');
@@ -1554,6 +4255,9 @@ def liff_location_picker():
     async function initLiff(autoLogin=false) {
       try {
         await liff.init({ liffId: LIFF_ID });
+        txn = readParam("txn") || txn;
+        token = readParam("t") || token;
+        txnLabel.textContent = txn || "-";
         if (!liff.isLoggedIn()) {
           stLiff.textContent = "กำลังเข้าสู่ระบบ…";
           if (autoLogin) {
@@ -1614,6 +4318,17 @@ def liff_location_picker():
             hint.textContent = "";
           }
 
+          const result = await postLocation(lat, lon, acc, ts);
+          if (result) {
+            alert(result.message || (result.ok ? "ส่งตำแหน่งแล้ว ✔" : "ส่งตำแหน่งไม่สำเร็จ"));
+            if (result.ok) {
+              liff.closeWindow();
+            } else {
+              hint.textContent = result.message || "";
+            }
+            return;
+          }
+
           if (!liff.isInClient()) {
             alert("ขณะนี้เปิดในเบราว์เซอร์ภายนอก ไม่สามารถส่งเข้าห้องแชตได้ กรุณากด 'เปิดใน LINE แล้วลองอีกครั้ง'");
             return;
@@ -1639,7 +4354,7 @@ def liff_location_picker():
     }
 
     function openInLine() {
-      const link = `line://app/${LIFF_ID}?txn=${encodeURIComponent(txn)}`;
+      const link = `line://app/${LIFF_ID}?txn=${encodeURIComponent(txn)}&t=${encodeURIComponent(token)}`;
       window.location.href = link;
     }
 
@@ -1668,23 +4383,319 @@ def liff_location_picker():
         // ignore; user can tap the button
       }
     });
-  </script>
+"""
+
+# Placeholders (__NAME__) are filled once per build; no f-string, so the braces in CSS/JS stay as they are.
+_LIFF_PICKER_HTML = """<!doctype html>
+<html lang="th">
+<head>
+  <meta charset="utf-8" />
+  <meta name="viewport" content="width=device-width,initial-scale=1,viewport-fit=cover" />
+  <title>ส่งตำแหน่งเช็คอิน</title>
+  <script src="https://static.line-scdn.net/liff/edge/2/sdk.js"></script>
+  <link rel="stylesheet" href="__CSS_URL__" />
+</head>
+<body data-liff-id="__LIFF_ID__" data-max-acc="__MAX_ACC__" data-direct-post="__DIRECT_POST__">
+  <div class="container">
+    <div class="card">
+      <div class="header">
+        <div class="dot"></div><h1>ส่งตำแหน่งเช็คอิน</h1>
+      </div>
+      <p class="lead">กดปุ่มด้านล่างเพื่อส่ง <b>ตำแหน่ง Location จากมือถือ</b></p>
+
+      <div class="status" id="statusBox">
+        <div class="row"><span>สถานะ LIFF</span><span id="stLiff" class="danger">ยังไม่เริ่ม</span></div>
+        <div class="row"><span>สิทธิ์ตำแหน่ง (GPS)</span><span id="stPerm" class="danger">ยังไม่ได้ร้องขอ</span></div>
+        <div class="row"><span>ความแม่นยำ (m)</span><span id="stAcc">-</span></div>
+        <div class="row"><span>เวลาที่อ่าน</span><span id="stTs">-</span></div>
+      </div>
+
+      <div class="actions">
+        <div class="btnwrap">
+          <button id="sendBtn" class="primary">ส่งตำแหน่งปัจจุบัน</button>
+          <div class="spinner" id="spin"></div>
+        </div>
+        <button id="retryBtn" class="secondary">ลองใหม่ / รีเฟรชสิทธิ์</button>
+        <button id="openInLineBtn" class="secondary">เปิดใน LINE แล้วลองอีกครั้ง</button>
+      </div>
+
+      <p class="helper">เปิด GPS/Location, เปิดสัญญาณมือถือ/ไวไฟ และยืนกลางแจ้งเพื่อความแม่นยำที่ดีกว่า</p>
+      <p class="hint" id="hint"></p>
+      <pre class="log" id="log"></pre>
+      <footer>LIFF ID: <span id="liffIdLabel">-</span> · Txn: <span id="txnLabel">-</span></footer>
+    </div>
+  </div>
+
+  <script src="__JS_URL__"></script>
 </body>
 </html>"""
 
-    # Safe placeholder substitution (no f-string)
-    html = (html
-            .replace("__LIFF_ID__", LIFF_ID)
-            .replace("__TXN__", txn)
-            .replace("__MAX_ACC__", str(MAX_GPS_ACCURACY_M)))
 
-    return render_template_string(html)
+def _precompressed(body: bytes, mime: str):
+    """identity / gzip / br variants of body with one strong ETag per encoding."""
+    import gzip
+    digest = hashlib.sha1(body).hexdigest()[:16]
+    variants = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    try:
+        import brotli  # optional
+        variants["br"] = brotli.compress(body, quality=11)
+    except ImportError:
+        pass
+    return {"mime": mime, "digest": digest, "bodies": variants,
+            "etags": {enc: f'"{digest}-{enc}"' for enc in variants}}
+
+
+def _liff_page_bundle():
+    key = (LIFF_ID, MAX_GPS_ACCURACY_M, LIFF_DIRECT_POST)
+    bundle = _LIFF_PAGE_CACHE.get(key)
+    if bundle is not None:
+        return bundle
+    with _liff_page_lock:
+        bundle = _LIFF_PAGE_CACHE.get(key)
+        if bundle is None:
+            css = _precompressed(_LIFF_PICKER_CSS.encode("utf-8"), "text/css; charset=utf-8")
+            js = _precompressed(_LIFF_PICKER_JS.encode("utf-8"), "application/javascript; charset=utf-8")
+            css_name, js_name = f"app.{css['digest']}.css", f"app.{js['digest']}.js"
+            page = (_LIFF_PICKER_HTML
+                    .replace("__LIFF_ID__", html_escape(LIFF_ID))
+                    .replace("__MAX_ACC__", str(int(MAX_GPS_ACCURACY_M)))
+                    .replace("__DIRECT_POST__", "1" if LIFF_DIRECT_POST else "0")
+                    .replace("__CSS_URL__", f"/liff_location_picker/{css_name}")
+                    .replace("__JS_URL__", f"/liff_location_picker/{js_name}"))
+            bundle = {"html": _precompressed(page.encode("utf-8"), "text/html; charset=utf-8"),
+                      "assets": {css_name: css, js_name: js, "app.css": css, "app.js": js}}
+            _LIFF_PAGE_CACHE.clear()  # only the current configuration is served
+            _LIFF_PAGE_CACHE[key] = bundle
+            log.info(f"LIFF picker page built: html={len(page)}B css={css_name} js={js_name} "
+                     f"encodings={sorted(bundle['html']['bodies'])}")
+    return bundle
+
+
+def _serve_precompressed(entry, cache_control):
+    """Response for a _precompressed entry: best accepted encoding, ETag / If-None-Match, Vary."""
+    accepted = {p.split(";")[0].strip().lower() for p in request.headers.get("Accept-Encoding", "").split(",")}
+    enc = next((e for e in ("br", "gzip") if e in accepted and e in entry["bodies"]), "identity")
+    etag = entry["etags"][enc]
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if_none = request.headers.get("If-None-Match", "")
+    if if_none and (if_none.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in if_none.split(",")]):
+        return Response(status=304, headers=headers)
+    if enc != "identity":
+        headers["Content-Encoding"] = enc
+    return Response(entry["bodies"][enc], mimetype=entry["mime"].split(";")[0],
+                    content_type=entry["mime"], headers=headers)
+
+
+@app.route("/liff_location_picker")
+def liff_location_picker():
+    """
+    LIFF page to acquire GPS from the mobile and hand it to the server.
+    The page reads ?txn=&lt;txn&gt;&t=&lt;token&gt; itself and POSTs to /liff/location (LIFF_DIRECT_POST);
+    otherwise, or when that fails, it sends a LINE location message with (txn|acc|ts) in the address.
+
+    - Auto-resumes after LIFF login using sessionStorage('autoRun') (no "ต้องกด 2 ครั้ง").
+    - Single-tap flow: first tap → login (if needed) → auto-continue to read GPS → send location.
+    - Keeps anti-fraud metadata (txn|acc|ts) and accuracy gating.
+    - Served precompiled and compressed (see the section comment above).
+    """
+    if not LIFF_ID:
+        return "LIFF_ID is not set on server", 500
+    return _serve_precompressed(_liff_page_bundle()["html"], f"public, max-age={LIFF_PAGE_MAX_AGE_SEC}")
+
+
+@app.route("/liff_location_picker/<name>")
+def liff_location_picker_asset(name):
+    """CSS/JS of the picker page. Content-hashed names are immutable."""
+    if not LIFF_ID:
+        abort(404)
+    assets = _liff_page_bundle()["assets"]
+    entry = assets.get(name)
+    if entry is not None and name.count(".") == 2:
+        return _serve_precompressed(entry, f"public, max-age={LIFF_ASSET_MAX_AGE_SEC}, immutable")
+    kind = name.rsplit(".", 1)[-1]
+    if name.startswith("app.") and kind in ("css", "js"):
+        return _serve_precompressed(assets[f"app.{kind}"], "no-cache")  # outdated hash or unhashed name
+    abort(404)
 
 @app.route("/liff-location")
 def liff_location_alias():
     """Alias for older Endpoint URLs; serves the same page as /liff_location_picker."""
     return liff_location_picker()
 
+
+# --- Direct location POST from the picker (no chat round-trip) ---
+# The page POSTs {t, lat, lon, acc, ts} here instead of sending a location message into chat and
+# waiting for the webhook. The signed token (see "Signed transaction ids") is checked before any I/O; the
+# rest is _process_location, shared with handle_location_message. The chat follow-up (camera quick
+# reply) goes out on a held reply token when there is one, else as one push. On a network error or 5xx
+# the page falls back to the chat location message, so the old path stays the safety net.
+_LOCATION_HTTP_STATUS = {"ok": 200, "sheets_error": 503, "not_registered": 403,
+                         "txn_mismatch": 409, "wrong_state": 409}  # low_accuracy / stale / out_of_range -> 422
+
+
+def _location_json(status, **body):
+    return Response(json.dumps(body, ensure_ascii=False), status=status, mimetype="application/json",
+                    headers={"Cache-Control": "no-store"})
+
+
+def _send_location_followup(user_id, messages):
+    token = _take_reply_token(user_id)
+    try:
+        if token:
+            line_bot_api.reply_message(ReplyMessageRequest(reply_token=token, messages=messages))
+        else:
+            line_bot_api.push_message(PushMessageRequest(to=user_id, messages=messages))
+    except Exception as e:
+        log.warning(f"location follow-up to chat failed: {e}", exc_info=True)
+
+
+@app.route("/liff/location", methods=["POST"])
+def liff_location_post():
+    _set_log_context(transaction_id=None, user_id=None)
+    body = request.get_json(silent=True) or {}
+    claims = _verify_txn_token(str(body.get("t") or ""))
+    if not claims:
+        return _location_json(403, ok=False, code="bad_token",
+                              message="ลิงก์หมดอายุหรือไม่ถูกต้อง กรุณาเริ่มใหม่ด้วยคำสั่งเดิมในแชต")
+    txn, user_id, flow = claims
+    try:
+        lat, lon = float(body["lat"]), float(body["lon"])
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+            raise ValueError("out of range")
+        acc = "" if body.get("acc") in (None, "") else str(int(float(body["acc"])))
+        tsms = "" if body.get("ts") in (None, "") else str(int(body["ts"]))
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return _location_json(400, ok=False, code="bad_request", message="ข้อมูลพิกัดไม่ถูกต้อง")
+
+    _set_log_context(user_id=user_id, transaction_id=txn)
+    dedupe_key = f"liffpost:{txn}:{tsms}"
+    if dedupe_key in _processed_events:
+        _hot_log.debug(f"Duplicate location POST ignored: {dedupe_key}")
+        return _location_json(200, ok=True, code="duplicate", message="ส่งตำแหน่งแล้ว ✔ กลับไปที่แชตได้เลย")
+
+    ensure_google_services()
+    code, messages, info = _process_location(user_id, lat, lon, txn, acc, tsms, flow)
+    if code == "ok":
+        _processed_events.add(dedupe_key)
+        _executor_singleton.submit(lambda: _send_location_followup(user_id, messages))
+    return _location_json(_LOCATION_HTTP_STATUS.get(code, 422), ok=code == "ok", code=code,
+                          message=messages[0].text, site=info.get("site"), distance_m=info.get("distance_m"))
+
+# --- Admin / metrics endpoints ---
+# Closed unless ADMIN_TOKEN is set; the token is accepted only in the X-Admin-Token header
+# (a ?token= query string would end up in proxy / access logs).
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '').strip()
+if not ADMIN_TOKEN:
+    log.warning("ADMIN_TOKEN is not set; /admin/* and /metrics answer 403")
+
+def _admin_authorized() -> bool:
+    """True only for a request carrying X-Admin-Token equal to ADMIN_TOKEN."""
+    if not ADMIN_TOKEN:
+        return False
+    supplied = request.headers.get('X-Admin-Token', '')
+    return hmac.compare_digest(supplied.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+@app.route("/admin/ratelimit")
+def admin_ratelimit():
+    """Shared Google API rate limiter state (rates, tokens, 429 counts, waits) as JSON."""
+    if not _admin_authorized():
+        abort(403)
+    return Response(json.dumps(_rate_limiter_snapshot(), ensure_ascii=False, indent=2),
+                    mimetype="application/json")
+
+@app.route("/admin/circuit")
+def admin_circuit():
+    """Sheets circuit breaker state and queued-write backlog as JSON."""
+    if not _admin_authorized():
+        abort(403)
+    return Response(json.dumps(_sheets_breaker_snapshot(), ensure_ascii=False, indent=2),
+                    mimetype="application/json")
+
+@app.route("/admin/executor")
+def admin_executor():
+    """Blocking-call pool saturation: workers, in-flight, queued and abandoned calls."""
+    if not _admin_authorized():
+        abort(403)
+    snap = _executor_singleton.snapshot()
+    snap["fan_out"] = _fan_out_executor.snapshot()
+    snap["background"] = _background_executor.snapshot()
+    return Response(json.dumps(snap, ensure_ascii=False, indent=2),
+                    mimetype="application/json")
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus text exposition of image-path stage latencies (histograms + p50/p95/p99)."""
+    if not _admin_authorized():
+        abort(403)
+    return Response(_render_prometheus_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/admin/api-usage")
+def admin_api_usage():
+    """Sheets/Drive calls by method, sheet and caller over 1m/5m/60m windows (quota attribution)."""
+    if not _admin_authorized():
+        abort(403)
+    return Response(json.dumps(_api_accounting_snapshot(), ensure_ascii=False, indent=2),
+                    mimetype="application/json")
+
+@app.route("/admin/logging")
+def admin_logging():
+    """Log pipeline counters: enqueued, dropped (queue full) and sampled-out DEBUG records."""
+    if not _admin_authorized():
+        abort(403)
+    return Response(json.dumps(_logging_snapshot(), ensure_ascii=False, indent=2),
+                    mimetype="application/json")
+
+@app.route("/admin/archive", methods=["GET", "POST"])
+def admin_archive():
+    """Archival status (GET) or start an archive run now in the background (POST)."""
+    if not _admin_authorized():
+        abort(403)
+    if request.method == "POST":
+        if _ARCHIVE_STATE["running"]:
+            return Response(json.dumps({"started": False, "reason": "already running"}), status=409,
+                            mimetype="application/json")
+        threading.Thread(target=_archive_closed_rows, name="archive", daemon=True).start()
+        return Response(json.dumps({"started": True}), status=202, mimetype="application/json")
+    body = dict(_ARCHIVE_STATE, enabled=ARCHIVE_ENABLED, after_days=ARCHIVE_AFTER_DAYS, hour=ARCHIVE_HOUR,
+                spreadsheet_id=ARCHIVE_SPREADSHEET_ID or "(same as each hot tab)", dup_months="all" if ARCHIVE_DUP_MONTHS is None else ARCHIVE_DUP_MONTHS)
+    return Response(json.dumps(body, ensure_ascii=False, indent=2), mimetype="application/json")
+
+@app.route("/admin/line")
+def admin_line():
+    """LINE calls per endpoint: counts, retries, 429s, latency quantiles and rate-limit buckets."""
+    if not _admin_authorized():
+        abort(403)
+    return Response(json.dumps(_line_snapshot(), ensure_ascii=False, indent=2), mimetype="application/json")
+
+@app.route("/admin/messaging", methods=["GET", "POST"])
+def admin_messaging():
+    """Reply/push counts, push ratio, push quota and pending notices (POST re-reads the quota)."""
+    if not _admin_authorized():
+        abort(403)
+    if request.method == "POST":
+        _refresh_push_quota()
+    return Response(json.dumps(_messaging_snapshot(), ensure_ascii=False, indent=2), mimetype="application/json")
+
+@app.route("/admin/refdata", methods=["GET", "POST"])
+def admin_refdata():
+    """Reference data cache counters (GET) or drop all cached reference tabs (POST)."""
+    if not _admin_authorized():
+        abort(403)
+    if request.method == "POST":
+        _refdata_invalidate()
+    return Response(json.dumps(_refdata_snapshot(), ensure_ascii=False, indent=2), mimetype="application/json")
+
+@app.route("/healthz")
+def healthz():
+    """Liveness: the process is up and serving requests."""
+    return "OK", 200
+
+@app.route("/readyz")
+def readyz():
+    """Readiness: 200 only after Google clients are built and reference caches are warm."""
+    body = json.dumps(_READINESS, ensure_ascii=False)
+    return Response(body, status=200 if _READINESS["ready"] else 503, mimetype="application/json")
+
 @app.route("/", methods=["GET", "HEAD"])
 def root_ok():
     """Simple health check to avoid 502 on root requests."""
@@ -1733,19 +4744,19 @@ def handle_message(event):
     ensure_google_services()
 
     user_id = event.source.user_id
+    _set_log_context(user_id=user_id, transaction_id=None)
+    _note_reply_token(user_id, event.reply_token)
         # ---- De-dup guard: ป้องกันอัพโหลดซ้ำเมื่อ LINE redeliver/retry ----
     evt_id = getattr(event, "webhook_event_id", None) or getattr(event.message, "id", None)
     if evt_id and evt_id in _processed_events:
-        print(f"DEBUG: Duplicate image event ignored: {evt_id}")
-        sys.stdout.flush()
+        _hot_log.debug(f"Duplicate image event ignored: {evt_id}")
         return
     if evt_id:
         _processed_events.add(evt_id)
 
     text = event.message.text.strip()
 
-    print(f"DEBUG: User ID: {user_id}")
-    sys.stdout.flush()
+    _hot_log.debug(f"User ID: {user_id}")
 
     # Get employee data and state
     employee_data, _ = get_employee_data(user_id)
@@ -1756,14 +4767,13 @@ def handle_message(event):
                 messages=[V3TextMessage(text="ระบบกำลังเชื่อมต่อ Google Sheets ช้ากว่าปกติ กรุณาลองอีกครั้งในสักครู่ครับ")]
             )
         )
-        print("DEBUG: Reply temporary: Sheets unavailable; not treating as unregistered.")
-        sys.stdout.flush()
+        log.debug("Reply temporary: Sheets unavailable; not treating as unregistered.")
         return
     current_state = employee_data[EMPLOYEE_CURRENT_STATE_COL] if employee_data else "idle"
     current_transaction_id = employee_data[EMPLOYEE_CURRENT_TRANSACTION_ID_COL] if employee_data else ""
+    _set_log_context(transaction_id=current_transaction_id or None)
 
-    print(f"DEBUG: User {user_id} current_state: {current_state}, current_transaction_id: {current_transaction_id}")
-    sys.stdout.flush()
+    _hot_log.debug(f"User {user_id} current_state: {current_state}, current_transaction_id: {current_transaction_id}")
 
     # --- Registration: start or complete name collection ---
     # 1) ผู้ใช้พิมพ์คำสั่งเริ่มลงทะเบียน
@@ -1783,8 +4793,7 @@ def handle_message(event):
                     V3TextMessage(text="เริ่มลงทะเบียนแล้วครับ ✍️\nกรุณาพิมพ์ *ชื่อ-นามสกุล* ของคุณตอบกลับมา")
                 ])
             except Exception as e:
-                print(f"ERROR: start registration failed: {e}")
-                traceback.print_exc(); sys.stdout.flush()
+                log.error(f"start registration failed: {e}", exc_info=True)
                 _reply_or_push_messages(event, user_id, [
                     V3TextMessage(text="เริ่มลงทะเบียนไม่สำเร็จ กรุณาพิมพ์ “ลงทะเบียน” อีกครั้ง")
                 ])
@@ -1830,11 +4839,9 @@ def handle_message(event):
                     quick_reply=_build_role_quick_reply()
                 )
             ])
-            print(f"DEBUG: Registration name saved; awaiting role for {user_id}")
-            sys.stdout.flush()
+            log.debug(f"Registration name saved; awaiting role for {user_id}")
         except Exception as e:
-            print(f"ERROR: finalize registration failed: {e}")
-            traceback.print_exc(); sys.stdout.flush()
+            log.error(f"finalize registration failed: {e}", exc_info=True)
             _reply_or_push_messages(event, user_id, [
                 V3TextMessage(text="บันทึกข้อมูลไม่สำเร็จ กรุณาพิมพ์ชื่ออีกครั้ง")
             ])
@@ -1870,11 +4877,9 @@ def handle_message(event):
                     )
                 )
             ])
-            print(f"DEBUG: Registration role set for {user_id}: {role_txt}")
-            sys.stdout.flush()
+            log.debug(f"Registration role set for {user_id}: {role_txt}")
         except Exception as e:
-            print(f"ERROR: set registration role failed: {e}")
-            traceback.print_exc(); sys.stdout.flush()
+            log.error(f"set registration role failed: {e}", exc_info=True)
             _reply_or_push_messages(event, user_id, [
                 V3TextMessage(text="บันทึกตำแหน่งงานไม่สำเร็จ กรุณาเลือกใหม่อีกครั้ง", quick_reply=_build_role_quick_reply())
             ])
@@ -1894,7 +4899,7 @@ def handle_message(event):
                     messages=[V3TextMessage(text="ยกเลิกเช็คอินให้แล้วครับ")]
                 )
             )
-            print(f"DEBUG: User cancelled check-in. transaction_id={current_transaction_id}"); sys.stdout.flush(); return
+            log.debug(f"User cancelled check-in. transaction_id={current_transaction_id}"); return
         if current_transaction_id and current_state in ("waiting_for_submit_location", "waiting_for_submit_images"):
             _finalize_submission(user_id, current_transaction_id, "cancelled")
             line_bot_api.reply_message(
@@ -1903,24 +4908,24 @@ def handle_message(event):
                     messages=[V3TextMessage(text="ยกเลิกการส่งงานให้แล้วครับ")]
                 )
             )
-            print(f"DEBUG: User cancelled submission. transaction_id={current_transaction_id}"); sys.stdout.flush(); return
+            log.debug(f"User cancelled submission. transaction_id={current_transaction_id}"); return
         line_bot_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
                 messages=[V3TextMessage(text="ตอนนี้ไม่มีรายการที่ค้างอยู่")]
             )
         )
-        print("DEBUG: Cancel requested but no active flow."); sys.stdout.flush(); return
+        log.debug("Cancel requested but no active flow."); return
 
     # Start check-in flow on text command
     if text in ("เช็คอิน", "checkin"):
         # Create a new transaction now, store in Employees, and provide LIFF link to capture GPS with metadata
-        transaction_id = str(uuid.uuid4())
+        transaction_id = _new_txn(user_id, "checkin")
         update_employee_state(user_id, "waiting_for_checkin_location", transaction_id)
 
         # Build LIFF URL (fall back to plain instruction if LIFF_ID not set)
         if LIFF_ID:
-            liff_url = f"https://liff.line.me/{LIFF_ID}?txn={transaction_id}"
+            liff_url = f"https://liff.line.me/{LIFF_ID}?txn={transaction_id}&t={_txn_link_token(transaction_id, user_id)}"
             reply_msg = V3TextMessage(
                 text="กดปุ่มด้านล่างเพื่อส่งตำแหน่งจากมือถือ หรือยกเลิก",
                 quick_reply=QuickReply(items=[
@@ -1942,20 +4947,19 @@ def handle_message(event):
                 messages=[reply_msg]
             )
         )
-        print(f"DEBUG: Replied: ask for Location via {'LIFF' if LIFF_ID else 'plain location'}, transaction_id={transaction_id}")
-        sys.stdout.flush()
+        log.debug(f"Replied: ask for Location via {'LIFF' if LIFF_ID else 'plain location'}, transaction_id={transaction_id}")
         return
 
     # --- Start submission flow on text command ---
     elif text in ("ส่งงาน", "submit", "ส่งงานนะ"):
         # Start SUBMISSION flow: ask user to share location via LIFF first
-        transaction_id = str(uuid.uuid4())
+        transaction_id = _new_txn(user_id, "submission")
         # Reuse the current-transaction field to track submission flow (separate state)
         update_employee_state(user_id, "waiting_for_submit_location", transaction_id)
 
-        # Build LIFF URL (same LIFF, different purpose). We pass txn only; server state decides semantics.
+        # Build LIFF URL (same LIFF, different purpose). We pass txn (+ signed token); server state decides semantics.
         if LIFF_ID:
-            liff_url = f"https://liff.line.me/{LIFF_ID}?txn={transaction_id}"
+            liff_url = f"https://liff.line.me/{LIFF_ID}?txn={transaction_id}&t={_txn_link_token(transaction_id, user_id)}"
             reply_msg = V3TextMessage(
                 text="กรุณากดปุ่มเพื่อแชร์ตำแหน่งของคุณก่อนส่งงาน",
                 quick_reply=QuickReply(items=[
@@ -1977,8 +4981,7 @@ def handle_message(event):
                 messages=[reply_msg]
             )
         )
-        print(f"DEBUG: Replied: ask for Submission Location via {'LIFF' if LIFF_ID else 'plain location'}, transaction_id={transaction_id}")
-        sys.stdout.flush()
+        log.debug(f"Replied: ask for Submission Location via {'LIFF' if LIFF_ID else 'plain location'}, transaction_id={transaction_id}")
         return
 
     if not employee_data:  # User not registered
@@ -1993,8 +4996,7 @@ def handle_message(event):
                 )]
             )
         )
-        print("DEBUG: Prompted user to register (no record in Employees).")
-        sys.stdout.flush()
+        log.debug("Prompted user to register (no record in Employees).")
         return
 
     # --- ผู้ใช้สั่ง "จบ" ให้ปิดงานเป็น done ---
@@ -2005,14 +5007,12 @@ def handle_message(event):
     if current_state == "waiting_for_submit_images" and current_transaction_id and _is_finish_submit_text(text):
         _finalize_submission(user_id, current_transaction_id, "done")
         _reply_or_push_messages(event, user_id, [V3TextMessage(text="ส่งงานเรียบร้อย ✅ บันทึกภาพครบแล้ว")])
-        print(f"DEBUG: User finished submission via text. transaction_id={current_transaction_id}")
-        sys.stdout.flush()
+        log.debug(f"User finished submission via text. transaction_id={current_transaction_id}")
         return
 
     if current_state == "waiting_for_checkin_images" and current_transaction_id and _is_finish_checkin_text(text):
         _finalize_checkin(user_id, current_transaction_id, "done", reply_token=event.reply_token, send_summary=True)
-        print(f"DEBUG: User finished early via quick menu. transaction_id={current_transaction_id}")
-        sys.stdout.flush()
+        log.debug(f"User finished early via quick menu. transaction_id={current_transaction_id}")
         return
 
     if current_state == "waiting_for_submit_images":
@@ -2042,8 +5042,7 @@ def handle_message(event):
                 ]
             )
         )
-        print("DEBUG: Replied: waiting_for_checkin_images → user sent TEXT (ask for image).")
-        sys.stdout.flush()
+        log.debug("Replied: waiting_for_checkin_images → user sent TEXT (ask for image).")
         return
 
     # Default reply for other texts
@@ -2053,194 +5052,179 @@ def handle_message(event):
             messages=[V3TextMessage(text="พิมพ์ “เช็คอิน” หรือ “ส่งงาน” เพื่อเริ่มต้น หรือส่งตำแหน่ง (Location) ได้เลย")]
         )
     )
-    print("DEBUG: Replied: default text help.")
-    sys.stdout.flush()
+    log.debug("Replied: default text help.")
     return
 
 #
 # --- Location Handler: รับพิกัดจาก LIFF แล้วเดิน flow ต่อทันที ---
 @handler.add(MessageEvent, message=LocationMessageContent)
 def handle_location_message(event):
-    ensure_google_services()
-
     evt_id = getattr(event, "webhook_event_id", None) or getattr(event.message, "id", None)
     if evt_id and evt_id in _processed_events:
-        print(f"DEBUG: Duplicate location event ignored: {evt_id}")
-        sys.stdout.flush()
+        _hot_log.debug(f"Duplicate location event ignored: {evt_id}")
         return
     if evt_id:
         _processed_events.add(evt_id)
 
     user_id = event.source.user_id
+    _note_reply_token(user_id, event.reply_token)
     lat = event.message.latitude
     lon = event.message.longitude
     addr = getattr(event.message, "address", "") or ""
     meta = _parse_meta_from_address(addr)  # คาดรูปแบบ "(txn=...|acc=...|ts=...)"
     txn  = meta.get("txn", "")
-    acc  = meta.get("acc", "")
-    tsms = meta.get("ts", "")
+    _set_log_context(user_id=user_id, transaction_id=txn or None)
+
+    # txn ที่ไม่ได้ออกให้ผู้ใช้คนนี้ / หมดอายุ → ปฏิเสธทันที ไม่ต้องอ่านชีต
+    flow, txn_check = _check_txn(txn, user_id)
+    if txn_check not in ("valid", "legacy"):
+        _hot_log.debug(f"Location refused before I/O: txn {txn_check}")
+        text = ("ลิงก์ส่งตำแหน่งหมดอายุแล้ว กรุณาเริ่มใหม่ด้วยคำสั่งเดิม" if txn_check == "expired"
+                else "ไม่พบรหัสอ้างอิงธุรกรรมของตำแหน่ง (txn) กรุณาเริ่มใหม่อีกครั้งด้วยคำสั่งเดิม")
+        line_bot_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token,
+                                                       messages=[V3TextMessage(text=text)]))
+        return
+
+    ensure_google_services()
+    _code, messages, _info = _process_location(user_id, lat, lon, txn, meta.get("acc", ""), meta.get("ts", ""), flow)
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=messages
+        )
+    )
+
+
+# Flow a signed txn must carry for the location step of each state
+_LOCATION_STATE_FLOWS = {"waiting_for_checkin_location": "checkin", "waiting_for_submit_location": "submission"}
+
+
+@_holds_row_positions
+def _process_location(user_id, lat, lon, txn, acc, tsms, flow=None):
+    """
+    Location step shared by the chat location message and the LIFF POST (/liff/location):
+    checks txn (and its signed flow, None for a legacy uuid) / accuracy / age, matches the site, upserts the CheckIns or Submissions row and
+    moves the employee to the image step. Returns (code, messages for the user, info) where code is
+    "ok" or the reason it was refused (see _LOCATION_HTTP_STATUS).
+    """
+    def refuse(code, text):
+        return code, [V3TextMessage(text=text)], {}
 
     # อ่านสถานะพนักงานก่อน
     employee_data, _ = get_employee_data(user_id)
     if employee_data == "__SHEETS_ERROR__":
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[V3TextMessage(text="ระบบชีตช้าชั่วคราว ลองส่งตำแหน่งอีกครั้งภายหลังครับ")]
-            )
-        )
-        return
+        return refuse("sheets_error", "ระบบชีตช้าชั่วคราว ลองส่งตำแหน่งอีกครั้งภายหลังครับ")
     if not employee_data:
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[V3TextMessage(text="ยังไม่ได้ลงทะเบียน ไม่สามารถใช้งานได้ครับ")]
-            )
-        )
-        return
+        return refuse("not_registered", "ยังไม่ได้ลงทะเบียน ไม่สามารถใช้งานได้ครับ")
 
     cur_state = employee_data[EMPLOYEE_CURRENT_STATE_COL] if len(employee_data) > EMPLOYEE_CURRENT_STATE_COL else "idle"
     cur_txn   = employee_data[EMPLOYEE_CURRENT_TRANSACTION_ID_COL] if len(employee_data) > EMPLOYEE_CURRENT_TRANSACTION_ID_COL else ""
 
     # ต้องมี txn ตรงกัน (กันส่งพิกัดเก่า/ข้าม flow)
     if not txn or (cur_txn and txn != cur_txn):
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[V3TextMessage(text="ไม่พบรหัสอ้างอิงธุรกรรมของตำแหน่ง (txn) กรุณาเริ่มใหม่อีกครั้งด้วยคำสั่งเดิม")]
-            )
-        )
-        return
+        return refuse("txn_mismatch", "ไม่พบรหัสอ้างอิงธุรกรรมของตำแหน่ง (txn) กรุณาเริ่มใหม่อีกครั้งด้วยคำสั่งเดิม")
+    # ลิงก์เช็คอินใช้กับขั้นส่งงานไม่ได้ (และกลับกัน)
+    if flow and _LOCATION_STATE_FLOWS.get(cur_state, flow) != flow:
+        _hot_log.debug(f"Location refused: {flow} txn while {cur_state}")
+        return refuse("txn_mismatch", "ลิงก์นี้เป็นของขั้นตอนอื่น กรุณาเริ่มใหม่อีกครั้งด้วยคำสั่งเดิม")
 
     # ตรวจความแม่นยำ/อายุพิกัดจากมือถือ
     try:
-        acc_val = int(acc) if acc else 999999
+        acc_val = int(acc) if acc not in (None, "") else 999999
     except Exception:
         acc_val = 999999
     if acc_val > MAX_GPS_ACCURACY_M:
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[V3TextMessage(text=f"ความแม่นยำ {acc_val}m สูงเกินกำหนด ({MAX_GPS_ACCURACY_M}m) กรุณาอยู่กลางแจ้ง/เปิด GPS แล้วลองใหม่")]
-            )
-        )
-        return
+        return refuse("low_accuracy", f"ความแม่นยำ {acc_val}m สูงเกินกำหนด ({MAX_GPS_ACCURACY_M}m) กรุณาอยู่กลางแจ้ง/เปิด GPS แล้วลองใหม่")
     if tsms and not _is_recent_ts_ms(tsms, MAX_LOCATION_AGE_SEC):
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[V3TextMessage(text="ตำแหน่งจากมือถือเก่าเกินไป กรุณากดส่งใหม่อีกครั้ง")]
-            )
-        )
-        return
+        return refuse("stale", "ตำแหน่งจากมือถือเก่าเกินไป กรุณากดส่งใหม่อีกครั้ง")
 
     # แยก flow: เช็คอิน vs ส่งงาน
     if cur_state in ("waiting_for_checkin_location",):
         # จับคู่ไซต์ด้วย checkin_radius
         loc_name, site_group, matched, dist_m = match_site_by_location(lat, lon)
         if not matched and SITE_NO_MATCH_POLICY.lower() == "reject":
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[V3TextMessage(text=f"นอกเขตรัศมีเช็คอิน (ระยะ ~{int(dist_m or 0)} m) กรุณาเข้าใกล้จุดเช็คอินแล้วส่งใหม่")]
-                )
-            )
-            return
+            return refuse("out_of_range", f"นอกเขตรัศมีเช็คอิน (ระยะ ~{int(dist_m or 0)} m) กรุณาเข้าใกล้จุดเช็คอินแล้วส่งใหม่")
 
         # upsert แถว CheckIns ให้ “1 checkin_id = 1 record”
         emp_name = employee_data[EMPLOYEE_NAME_COL] if len(employee_data) > EMPLOYEE_NAME_COL else ""
-        row_idx = upsert_checkin_row_idempotent(txn, user_id, loc_name or f"{lat},{lon}", site_group or "", dist_m or 0, emp_name)
+        upsert_checkin_row_idempotent(txn, user_id, loc_name or f"{lat},{lon}", site_group or "", dist_m or 0, emp_name)
         # ไปสถานะรอรูป + แจ้งผู้ใช้
         update_employee_state(user_id, "waiting_for_checkin_images", txn)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    V3TextMessage(
-                        text=(f"ตำแหน่งรับแล้ว ✓\nสถานที่: {loc_name or 'พิกัดที่ส่งมา'} "
-                              f"(ห่าง ~{int(dist_m or 0)} m)\nโปรดส่งรูปภาพหลักฐาน (ส่งทีละ 1 รูป สูงสุด 3 รูป)"),
-                        quick_reply=QuickReply(items=[
-                            QuickReplyItem(action=CameraAction(label="📸 ถ่ายภาพเช็คอิน")),
-                            QuickReplyItem(action=CameraRollAction(label="🖼 เลือกจากคลังภาพ")),
-                            QuickReplyItem(action=MessageAction(label="✅ จบการเช็คอิน", text="จบการเช็คอิน")),
-                            QuickReplyItem(action=MessageAction(label="ยกเลิก", text="ยกเลิกเช็คอิน")),
-                        ]),
-                    )
-                ]
+        return "ok", [
+            V3TextMessage(
+                text=(f"ตำแหน่งรับแล้ว ✓\nสถานที่: {loc_name or 'พิกัดที่ส่งมา'} "
+                      f"(ห่าง ~{int(dist_m or 0)} m)\nโปรดส่งรูปภาพหลักฐาน (ส่งทีละ 1 รูป สูงสุด 3 รูป)"),
+                quick_reply=QuickReply(items=[
+                    QuickReplyItem(action=CameraAction(label="📸 ถ่ายภาพเช็คอิน")),
+                    QuickReplyItem(action=CameraRollAction(label="🖼 เลือกจากคลังภาพ")),
+                    QuickReplyItem(action=MessageAction(label="✅ จบการเช็คอิน", text="จบการเช็คอิน")),
+                    QuickReplyItem(action=MessageAction(label="ยกเลิก", text="ยกเลิกเช็คอิน")),
+                ]),
             )
-        )
-        return
+        ], {"flow": "checkin", "site": loc_name or "", "distance_m": int(dist_m or 0), "matched": bool(matched)}
 
     elif cur_state in ("waiting_for_submit_location",):
         # จับคู่ไซต์ด้วย submission_radius
         loc_name, site_group, matched, dist_m = match_site_by_location_for_submission(lat, lon)
         if not matched and SITE_NO_MATCH_POLICY.lower() == "reject":
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[V3TextMessage(text=f"อยู่นอกเขตส่งงาน (ระยะ ~{int(dist_m or 0)} m) กรุณาเข้าใกล้จุดส่งงานแล้วส่งใหม่")]
-                )
-            )
-            return
+            return refuse("out_of_range", f"อยู่นอกเขตส่งงาน (ระยะ ~{int(dist_m or 0)} m) กรุณาเข้าใกล้จุดส่งงานแล้วส่งใหม่")
 
         # upsert แถว Submissions
         emp_name = employee_data[EMPLOYEE_NAME_COL] if len(employee_data) > EMPLOYEE_NAME_COL else ""
-        _ = upsert_submission_row_idempotent(txn, user_id, loc_name or f"{lat},{lon}", site_group or "", dist_m or 0, emp_name)
+        upsert_submission_row_idempotent(txn, user_id, loc_name or f"{lat},{lon}", site_group or "", dist_m or 0, emp_name)
         # ไปสถานะรอรูป + แจ้งผู้ใช้
         update_employee_state(user_id, "waiting_for_submit_images", txn)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    V3TextMessage(
-                        text=(f"ตำแหน่งส่งงานรับแล้ว ✓\nสถานที่: {loc_name or 'พิกัดที่ส่งมา'} "
-                              f"(ห่าง ~{int(dist_m or 0)} m)\nโปรดส่งรูปงาน (ส่งทีละ 1 รูป สูงสุด 3 รูป)"),
-                        quick_reply=QuickReply(items=[
-                            QuickReplyItem(action=CameraAction(label="📸 ถ่ายรูปงาน")),
-                            QuickReplyItem(action=CameraRollAction(label="🖼 เลือกจากคลังภาพ")),
-                            QuickReplyItem(action=MessageAction(label="✅ จบการส่งงาน", text="จบการส่งงาน")),
-                            QuickReplyItem(action=MessageAction(label="ยกเลิก", text="ยกเลิกส่งงาน")),
-                        ]),
-                    )
-                ]
+        return "ok", [
+            V3TextMessage(
+                text=(f"ตำแหน่งส่งงานรับแล้ว ✓\nสถานที่: {loc_name or 'พิกัดที่ส่งมา'} "
+                      f"(ห่าง ~{int(dist_m or 0)} m)\nโปรดส่งรูปงาน (ส่งทีละ 1 รูป สูงสุด 3 รูป)"),
+                quick_reply=QuickReply(items=[
+                    QuickReplyItem(action=CameraAction(label="📸 ถ่ายรูปงาน")),
+                    QuickReplyItem(action=CameraRollAction(label="🖼 เลือกจากคลังภาพ")),
+                    QuickReplyItem(action=MessageAction(label="✅ จบการส่งงาน", text="จบการส่งงาน")),
+                    QuickReplyItem(action=MessageAction(label="ยกเลิก", text="ยกเลิกส่งงาน")),
+                ]),
             )
-        )
-        return
+        ], {"flow": "submission", "site": loc_name or "", "distance_m": int(dist_m or 0), "matched": bool(matched)}
 
     # ถ้า state ไม่ตรงกับสอง flow ข้างบน
-    line_bot_api.reply_message(
-        ReplyMessageRequest(
-            reply_token=event.reply_token,
-            messages=[V3TextMessage(text="กรุณาเริ่มด้วย “เช็คอิน” หรือ “ส่งงาน” ก่อน แล้วค่อยส่งตำแหน่งครับ")]
-        )
-    )
+    return refuse("wrong_state", "กรุณาเริ่มด้วย “เช็คอิน” หรือ “ส่งงาน” ก่อน แล้วค่อยส่งตำแหน่งครับ")
 
 @handler.add(MessageEvent, message=ImageMessageContent)
 def handle_image_message(event):
+    with _image_trace() as trace:
+        _handle_image_message(event, trace)
+
+def _handle_image_message(event, trace):
     # Ensure services are ready
     ensure_google_services()
 
     user_id = event.source.user_id
+    _set_log_context(user_id=user_id, transaction_id=None)
+    _note_reply_token(user_id, event.reply_token)
 
     # ---- De-dup guard: avoid double-processing when LINE retries/redelivers ----
     evt_id = getattr(event, "webhook_event_id", None) or getattr(event.message, "id", None)
     if evt_id and evt_id in _processed_events:
-        print(f"DEBUG: Duplicate image event ignored: {evt_id}")
-        sys.stdout.flush()
+        _hot_log.debug(f"Duplicate image event ignored: {evt_id}")
+        trace["outcome"] = "duplicate"
         return
     if evt_id:
         _processed_events.add(evt_id)
 
     # ---- Load employee context once ----
-    employee_data, _ = get_employee_data(user_id)
+    with _span("sheets_employee"):
+        employee_data, _ = get_employee_data(user_id)
     if employee_data == "__SHEETS_ERROR__":
+        trace["outcome"] = "error"
         _reply_or_push_messages(event, user_id, [
             V3TextMessage(text="ตอนนี้เชื่อมต่อชีตไม่สำเร็จ กรุณาส่งรูปอีกครั้งภายหลังสักครู่")
         ])
-        print("DEBUG: Image path aborted due to Sheets error."); sys.stdout.flush()
+        log.debug("Image path aborted due to Sheets error.")
         return
 
     if not employee_data:
+        trace["outcome"] = "rejected"
         _reply_or_push_messages(event, user_id, [
             V3TextMessage(
                 text="ยังไม่ได้ลงทะเบียนใช้งานครับ\nพิมพ์ \"ลงทะเบียน\" เพื่อเริ่ม",
@@ -2249,39 +5233,50 @@ def handle_image_message(event):
                 ])
             )
         ])
-        print("DEBUG: Replied: not registered (Image) → prompted to register."); sys.stdout.flush()
+        log.debug("Replied: not registered (Image) → prompted to register.")
         return
 
     current_state = employee_data[EMPLOYEE_CURRENT_STATE_COL] if len(employee_data) > EMPLOYEE_CURRENT_STATE_COL else "idle"
     current_transaction_id = employee_data[EMPLOYEE_CURRENT_TRANSACTION_ID_COL] if len(employee_data) > EMPLOYEE_CURRENT_TRANSACTION_ID_COL else ""
+    _set_log_context(transaction_id=current_transaction_id or None)
+    if current_state == "waiting_for_submit_images":
+        trace["flow"] = "submission"
+    elif current_state == "waiting_for_checkin_images":
+        trace["flow"] = "checkin"
 
     # ---- Pre-check timeout on event path ----
     if _check_and_handle_timeout(user_id, reply_token=event.reply_token):
+        trace["outcome"] = "timeout"
         return
 
     # ---- Validate state ----
     if current_state not in ("waiting_for_checkin_images", "waiting_for_submit_images") or not current_transaction_id:
+        trace["outcome"] = "rejected"
         _reply_or_push_messages(event, user_id, [
             V3TextMessage(text="กรุณาเริ่มขั้นตอนให้ถูกต้องก่อน (เช็คอินหรือส่งงาน) แล้วจึงส่งรูปครับ")
         ])
-        print("DEBUG: Replied: image received but not in waiting-for-images state."); sys.stdout.flush()
+        log.debug("Replied: image received but not in waiting-for-images state.")
         return
 
     # ---- Download image bytes from LINE ----
     try:
-        message_id = event.message.id
-        resp = blob_api.get_message_content(message_id)
-        if hasattr(resp, "iter_content"):
-            image_bytes = b"".join(chunk for chunk in resp.iter_content(chunk_size=1024))
-        elif hasattr(resp, "read"):
-            image_bytes = resp.read()
-        elif isinstance(resp, (bytes, bytearray)):
-            image_bytes = bytes(resp)
-        else:
-            image_bytes = bytes(resp)
+        with _span("line_download"):
+            message_id = event.message.id
+            # The asyncio server mode (asgi.py) may already have fetched the content without a thread
+            image_bytes = _prefetched_image_bytes.pop(message_id, None)
+            if image_bytes is None:
+                resp = blob_api.get_message_content(message_id)
+                if hasattr(resp, "iter_content"):
+                    image_bytes = b"".join(chunk for chunk in resp.iter_content(chunk_size=1024))
+                elif hasattr(resp, "read"):
+                    image_bytes = resp.read()
+                elif isinstance(resp, (bytes, bytearray)):
+                    image_bytes = bytes(resp)
+                else:
+                    image_bytes = bytes(resp)
     except Exception as e:
-        print(f"ERROR: Unable to download image from LINE: {e}")
-        traceback.print_exc(); sys.stdout.flush()
+        log.error(f"Unable to download image from LINE: {e}", exc_info=True)
+        trace["outcome"] = "error"
         _reply_or_push_messages(event, user_id, [
             V3TextMessage(text="ดาวน์โหลดรูปจาก LINE ไม่สำเร็จ กรุณาลองใหม่อีกครั้ง")
         ])
@@ -2290,11 +5285,12 @@ def handle_image_message(event):
     # ---- Decode & compress image (flow-specific quality) ----
     is_submission_flow = (current_state == "waiting_for_submit_images")
     try:
-        out_bio, ext, mime = (prepare_image_for_submission(image_bytes) if is_submission_flow
-                              else prepare_image_for_checkin(image_bytes))
+        with _span("pillow"):
+            out_bio, ext, mime = (prepare_image_for_submission(image_bytes) if is_submission_flow
+                                  else prepare_image_for_checkin(image_bytes))
     except Exception as e:
-        print(f"ERROR: Pillow failed to process image: {e}")
-        traceback.print_exc(); sys.stdout.flush()
+        log.error(f"Pillow failed to process image: {e}", exc_info=True)
+        trace["outcome"] = "error"
         _reply_or_push_messages(event, user_id, [
             V3TextMessage(text="ประมวลผลรูปภาพไม่สำเร็จ กรุณาลองส่งใหม่ (รองรับ JPEG/PNG/GIF)")
         ])
@@ -2302,42 +5298,44 @@ def handle_image_message(event):
 
     # ---- Ensure Drive is authorized ----
     if drive_service is None:
+        trace["outcome"] = "error"
         _reply_or_push_messages(event, user_id, [
             V3TextMessage(text="ยังไม่ได้อนุญาตการอัปโหลด Google Drive กรุณาเปิดลิงก์ /authorize ในเบราว์เซอร์และยืนยันก่อนครับ")
         ])
-        print("DEBUG: Drive not authorized; abort image handling."); sys.stdout.flush()
+        log.debug("Drive not authorized; abort image handling.")
         return
 
     # ---- Upload to Google Drive ----
     try:
         prefix = "submission_image" if is_submission_flow else "checkin_image"
         file_name = f"{prefix}_{current_transaction_id}_{uuid.uuid4()}.{ext}"
+        from googleapiclient.http import MediaIoBaseUpload
         media = MediaIoBaseUpload(out_bio, mimetype=mime, resumable=True)
         file_metadata = {"name": file_name}
         if GOOGLE_DRIVE_FOLDER_ID:
             file_metadata["parents"] = [GOOGLE_DRIVE_FOLDER_ID]
 
-        created = _exec_with_timeout(
-            lambda: drive_service.files().create(body=file_metadata, media_body=media, fields="id, webViewLink").execute(),
-            DRIVE_EXECUTE_TIMEOUT_SEC,
-            "Drive files.create"
-        )
+        with _span("drive_create"):
+            created = _drive_exec(
+                lambda: drive_service.files().create(body=file_metadata, media_body=media, fields="id, webViewLink").execute(),
+                "Drive files.create",
+                bytes_out=out_bio.getbuffer().nbytes
+            )
         file_id = created.get("id")
         uploaded_url = created.get("webViewLink")
 
         # Best-effort: make public
         try:
-            _exec_with_timeout(
-                lambda: drive_service.permissions().create(fileId=file_id, body={"type": "anyone", "role": "reader"}).execute(),
-                DRIVE_EXECUTE_TIMEOUT_SEC,
-                "Drive permissions.create"
-            )
+            with _span("drive_permission"):
+                _drive_exec(
+                    lambda: drive_service.permissions().create(fileId=file_id, body={"type": "anyone", "role": "reader"}).execute(),
+                    "Drive permissions.create"
+                )
         except Exception as e:
-            print(f"WARNING: set public permission failed: {e}")
-            traceback.print_exc(); sys.stdout.flush()
+            log.warning(f"set public permission failed: {e}", exc_info=True)
     except Exception as e:
-        print(f"ERROR: Drive upload failed: {e}")
-        traceback.print_exc(); sys.stdout.flush()
+        log.error(f"Drive upload failed: {e}", exc_info=True)
+        trace["outcome"] = "error"
         _reply_or_push_messages(event, user_id, [
             V3TextMessage(text="อัปโหลดรูปไปยัง Drive ไม่สำเร็จ กรุณาลองใหม่อีกครั้ง")
         ])
@@ -2365,8 +5363,8 @@ def handle_image_message(event):
                 )
             ])
         except Exception as e:
-            print(f"ERROR: update CheckIns with image failed: {e}")
-            traceback.print_exc(); sys.stdout.flush()
+            log.error(f"update CheckIns with image failed: {e}", exc_info=True)
+            trace["outcome"] = "error"
             _reply_or_push_messages(event, user_id, [
                 V3TextMessage(text="บันทึกรูปในชีตไม่สำเร็จ กรุณาลองใหม่อีกครั้ง")
             ])
@@ -2375,7 +5373,8 @@ def handle_image_message(event):
         # SUBMISSION flow
         try:
             try:
-                image_hash_hex = _compute_image_ahash_from_jpeg_bytes(out_bio)
+                with _span("image_hash"):
+                    image_hash_hex = _compute_image_ahash_from_jpeg_bytes(out_bio)
             except Exception:
                 image_hash_hex = ""
 
@@ -2390,18 +5389,16 @@ def handle_image_message(event):
             # --- 2.2 Auto-finalize: ครบ 3 รูป → ปิดงาน ---
             if filled >= 3:
                 try:
-                    _finalize_submission(user_id, current_transaction_id, "done")
+                    with _span("finalize"):
+                        _finalize_submission(user_id, current_transaction_id, "done")
                 except Exception as e:
-                    print(f"WARNING: auto-finalize after 3 images failed: {e}")
-                    traceback.print_exc()
-                    sys.stdout.flush()
+                    log.warning(f"auto-finalize after 3 images failed: {e}", exc_info=True)
                 _reply_or_push_messages(
                     event,
                     user_id,
                     [V3TextMessage(text="ส่งงานเรียบร้อย ✅ ได้รับรูปครบ 3 รูปแล้ว")]
                 )
-                print(f"DEBUG: Auto-finalized submission {current_transaction_id} after 3 images.")
-                sys.stdout.flush()
+                log.debug(f"Auto-finalized submission {current_transaction_id} after 3 images.")
                 return
 
             # ยังไม่ครบ 3 → แจ้งจำนวนที่เหลือเสมอ
@@ -2421,8 +5418,8 @@ def handle_image_message(event):
                 )
             ])
         except Exception as e:
-            print(f"ERROR: update Submissions with image failed: {e}")
-            traceback.print_exc(); sys.stdout.flush()
+            log.error(f"update Submissions with image failed: {e}", exc_info=True)
+            trace["outcome"] = "error"
             _reply_or_push_messages(event, user_id, [
                 V3TextMessage(text="บันทึกรูปงานในชีตไม่สำเร็จ กรุณาลองใหม่อีกครั้ง")
             ])
@@ -2436,6 +5433,7 @@ def _compute_image_ahash_from_jpeg_bytes(jpeg_bio: io.BytesIO) -> str:
     Returns hex string of 16 chars (64 bits).
     """
     try:
+        from PIL import Image
         jpeg_bio.seek(0)
         with Image.open(jpeg_bio) as im:
             im = im.convert("L").resize((8, 8), Image.LANCZOS)
@@ -2454,26 +5452,39 @@ def _find_duplicate_in_submissions(hash_hex: str, exclude_submit_id: str):
     """
     Scan Submissions sheet for any image hash (M..O columns) matching hash_hex.
     Returns (dup_submit_id, dup_row_index_1based, dup_image_slot_1to3) or (None, None, None) if not found.
+    Matches in other shards return the row as "Submissions@n!row", matches in archive tabs
+    (all of them unless ARCHIVE_DUP_MONTHS is set) as "Submissions_YYYY_MM!row".
     NOTE: This relies on hashes being stored for previous submissions.
     """
     if not hash_hex:
         return (None, None, None)
-    rows = get_sheet_data(SUBMISSIONS_SHEET_NAME)
-    if not rows or len(rows) < 2:
+    # Only the id column and the hash columns M..O (one batchGet per shard, shards in parallel)
+    shard_sheets = _shard_sheets(SUBMISSIONS_SHEET_NAME)
+    results = _fan_out(lambda s: get_sheet_ranges(s, ["A2:A", "M2:O"]), shard_sheets)
+    if not any(results):
         return (None, None, None)
-    # Header assumed in row1; data from row2
-    for i, r in enumerate(rows[1:], start=2):
-        if not r or len(r) == 0:
+    target = hash_hex.lower()
+    for sheet, parts in zip(shard_sheets, results):
+        if not parts:
             continue
-        submit_id = r[0] if len(r) > 0 else ""
-        if not submit_id or submit_id == exclude_submit_id:
-            continue
-        # Hash columns: M (12), N (13), O (14) in 0-based indexing
-        for slot in range(3):
-            col = 12 + slot
-            if len(r) > col and r[col]:
-                if str(r[col]).strip().lower() == hash_hex.lower():
-                    return (submit_id, i, slot + 1)
+        ids, hashes = parts
+        _note_sheet_rows(sheet, len(ids) + 1)
+        # Header assumed in row1; data from row2
+        for k, h in enumerate(hashes):
+            if not h:
+                continue
+            submit_id = ids[k][0] if k < len(ids) and ids[k] else ""
+            if not submit_id or submit_id == exclude_submit_id:
+                continue
+            # Hash columns: M, N, O -> slots 1..3
+            for slot in range(3):
+                if len(h) > slot and h[slot]:
+                    if str(h[slot]).strip().lower() == target:
+                        return (submit_id, k + 2 if sheet == SUBMISSIONS_SHEET_NAME else f"{sheet}!{k + 2}", slot + 1)
+    # Older submissions live in the monthly archive tabs; the row is then reported as "Tab!row"
+    hit = _archived_submission_hashes().get(target)
+    if hit and hit[0] != exclude_submit_id:
+        return hit
     return (None, None, None)
 
 # --- Reusable Image Preparation Helpers (resize + encode JPEG) ---
@@ -2482,6 +5493,7 @@ def _prepare_image_bytes(image_bytes: bytes, max_dim: int, quality: int):
     Decode image bytes, fix orientation, resize to max_dim (preserve aspect), convert to RGB,
     and encode to JPEG with given quality. Returns (io.BytesIO, ext, mime).
     """
+    from PIL import Image
     try:
         with Image.open(io.BytesIO(image_bytes)) as im:
             # Normalize orientation if EXIF present
@@ -2578,19 +5590,73 @@ def _reply_after_image(user_reply_token, filled_count: int, flow: str):
 
 # --- Startup: Run Flask app and scheduler if this is the main module ---
 
-if __name__ == "__main__":
-    import atexit
+# --- App factory / warm-up (used by wsgi.py, asgi.py and __main__) ---
+_READINESS = {"ready": False, "started_at": None, "warmed_at": None, "warm_sec": None, "errors": {}}
 
-    # Ensure Google services are ready (Sheets/Drive)
+def warm_up_services(timeout_sec=None):
+    """
+    Build the Google clients and prefetch Employees, Roles and Locations (one reference-data
+    batchGet; the other two tasks wait on it and parse) so the first webhook after a deploy hits
+    warm caches. Marks the process ready when all succeed.
+    """
+    start = time.time()
+    _READINESS["started_at"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    errors = {}
     try:
         ensure_google_services()
     except Exception as e:
-        print(f"ERROR: ensure_google_services failed at startup: {e}")
-        import traceback, sys
-        traceback.print_exc(); sys.stdout.flush()
+        errors["google_services"] = str(e)
+    if sheets_service is None:
+        errors.setdefault("google_services", "Sheets service not initialized")
+        _READINESS["errors"] = errors
+        return False
 
-    # Start Background Scheduler for timeout scanning
+    tasks = {
+        "employees": lambda: get_sheet_data("Employees"),
+        "roles": _get_roles_from_sheet,
+        "locations": load_locations,
+    }
+    futures = {name: _background_executor.submit(fn) for name, fn in tasks.items()}
+    wait_sec = timeout_sec or SHEETS_EXECUTE_TIMEOUT_SEC * SHEETS_MAX_ATTEMPTS
+    for name, fut in futures.items():
+        try:
+            if fut.result(timeout=max(0.1, wait_sec - (time.time() - start))) is None:
+                errors[name] = "no data"
+        except Exception as e:
+            errors[name] = str(e) or type(e).__name__
+    _READINESS["errors"] = errors
+    _READINESS["ready"] = not errors
+    _READINESS["warm_sec"] = round(time.time() - start, 2)
+    if not errors:
+        _READINESS["warmed_at"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    log.info(f"warm-up finished in {_READINESS['warm_sec']}s ready={_READINESS['ready']} errors={errors}")
+    return _READINESS["ready"]
+
+def create_app(run_scheduler=None, warm=True):
+    """
+    Application factory for production WSGI servers (see wsgi.py).
+    Warms Google clients/caches in the background (readiness reported on /readyz) and starts
+    the timeout scheduler unless RUN_SCHEDULER=0.
+    """
+    if run_scheduler is None:
+        run_scheduler = os.getenv("RUN_SCHEDULER", "1") == "1"
+    if warm:
+        def _warm_until_ready():
+            delay = 2.0
+            while not warm_up_services():
+                time.sleep(delay)
+                delay = min(delay * 2, 60.0)
+        threading.Thread(target=_warm_until_ready, name="warm-up", daemon=True).start()
+    if run_scheduler:
+        start_background_scheduler()
+    return app
+
+def start_background_scheduler():
+    """Start the timeout-scan scheduler once per process and register its shutdown (used by every entry point)."""
+    global scheduler
+    import atexit
     try:
+        from apscheduler.schedulers.background import BackgroundScheduler
         if scheduler is None:
             scheduler = BackgroundScheduler(timezone=APP_TIMEZONE, job_defaults={"max_instances": 1, "coalesce": True})
             scheduler.add_job(_scan_and_timeout_overdue_checkins,
@@ -2600,27 +5666,46 @@ if __name__ == "__main__":
                               max_instances=1,
                               coalesce=True,
                               replace_existing=True)
+            scheduler.add_job(_refresh_push_quota,
+                              trigger="interval",
+                              seconds=PUSH_QUOTA_REFRESH_SEC,
+                              id="refresh_push_quota",
+                              next_run_time=datetime.now(timezone.utc),  # first read right away
+                              max_instances=1,
+                              coalesce=True,
+                              replace_existing=True)
+            if ARCHIVE_ENABLED:
+                scheduler.add_job(_archive_closed_rows,
+                                  trigger="cron",
+                                  hour=ARCHIVE_HOUR,
+                                  minute=0,
+                                  id="archive_closed_rows",
+                                  max_instances=1,
+                                  coalesce=True,
+                                  misfire_grace_time=3600,
+                                  replace_existing=True)
             scheduler.start()
-            print(f"DEBUG: Scheduler started (interval={SCHEDULER_INTERVAL_SECONDS}s, tz={APP_TIMEZONE})")
+            log.info(f"Scheduler started (interval={SCHEDULER_INTERVAL_SECONDS}s, tz={APP_TIMEZONE})")
+            atexit.register(_shutdown_scheduler)
     except Exception as e:
-        print(f"ERROR: Failed to start scheduler: {e}")
-        import traceback, sys
-        traceback.print_exc(); sys.stdout.flush()
+        log.error(f"Failed to start scheduler: {e}", exc_info=True)
 
-    # Ensure scheduler shuts down cleanly on exit
-    def _shutdown_scheduler():
-        global scheduler
-        try:
-            if scheduler:
-                scheduler.shutdown(wait=False)
-                print("DEBUG: Scheduler shut down")
-        except Exception:
-            pass
-    atexit.register(_shutdown_scheduler)
+def _shutdown_scheduler():
+    """Ensure scheduler shuts down cleanly on exit."""
+    try:
+        if scheduler:
+            scheduler.shutdown(wait=False)
+            log.info("Scheduler shut down")
+    except Exception:
+        pass
+
+if __name__ == "__main__":
+    # Build Google services, warm caches (in background) and start the timeout scheduler
+    create_app()
 
     # Start Flask development server
     port = int(os.getenv("PORT", "8000"))
     host = os.getenv("HOST", "0.0.0.0")
     debug_flag = os.getenv("FLASK_DEBUG", "0") == "1"
-    print(f"DEBUG: Starting Flask on {host}:{port} (debug={debug_flag})")
+    log.info(f"Starting Flask on {host}:{port} (debug={debug_flag})")
     app.run(host=host, port=port, debug=debug_flag, use_reloader=False)
@@ -0,0 +1,17 @@
+# wsgi.py
+# Production WSGI entry point (gunicorn / uwsgi) for the LINE bot in main.py.
+#
+#   gunicorn -w 1 --threads 16 -b 0.0.0.0:8000 wsgi:app
+#   uwsgi --http :8000 --wsgi-file wsgi.py --callable app --threads 16 --enable-threads
+#
+# Only a single process is supported (-w 1 / one instance), scaled with threads. Per-transaction
+# locks, image-slot reservations, the txn -> shard map, held reply tokens, processed webhook event
+# ids, the queued Sheets writes and the caches all live in process memory; a second process would
+# not see them and would double-process events and write rows concurrently. RUN_SCHEDULER=0 only
+# turns the scheduler off (e.g. for a one-off shell); it does not make more processes safe.
+# Point the load balancer's readiness check at /readyz (503 until caches are warm) and its
+# liveness check at /healthz.
+
+from main import create_app
+
+app = application = create_app()